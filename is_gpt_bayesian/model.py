@@ -2,16 +2,25 @@ import os
 import openai
 import logging
 import pickle
+import hashlib
 import pprint
 import numpy as np
 import json
 from pathlib import Path
 import pandas as pd
 import asyncio
-from is_gpt_bayesian.utils import time_utils, path_utils
+import time
+from concurrent.futures import ThreadPoolExecutor
+from is_gpt_bayesian.utils import time_utils, path_utils, rate_limit_utils, token_utils, io_utils, manifest_utils, metrics_utils, schema_utils
+from is_gpt_bayesian.processing import prompt_processing
 
 logger = logging.getLogger(__name__)
 
+RESPONSE_USAGE_COLUMNS = ['prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'reasoning_tokens']
+
+# batch statuses the API has not finished with, a cancelling batch still ends up cancelled with its output
+BATCH_IN_FLIGHT_STATUSES = ['validating', 'in_progress', 'finalizing', 'cancelling']
+
 
 class OpenAISession():
 
@@ -21,39 +30,69 @@ class OpenAISession():
                         # 'gpt-4o-mini' # for testing
                         ]
 
+    # batch API limits per job, larger model groups are split into several jobs
+    batch_max_requests = 50_000
+    batch_max_bytes = 200 * 1024 ** 2
+    batch_max_tokens = None # optional cap on estimated tokens per job
+
+    # Batch API enqueued token limits per model, which depend on the usage tier, e.g. {'gpt-4o': 90_000}
+    # jobs that do not fit wait as queued until earlier batches of the model finish, other models are sent right away
+    batch_max_enqueued_tokens = {}
+
+    # non-batch dispatcher, None means adopting the limits reported in the x-ratelimit-* response headers
+    non_batch_max_in_flight = 16
+    non_batch_requests_per_minute = None
+    non_batch_tokens_per_minute = None
+    non_batch_max_retries = 5
+    non_batch_backoff_base_delay = 1
+    non_batch_backoff_max_delay = 60
 
-    def __init__(self, run_name):
+
+    # batch polling
+    retrieve_max_workers = 8
+    watch_min_poll_interval = 30
+    watch_max_poll_interval = 600
+    download_chunk_size = 1024 ** 2
+    resubmit_expired = True # requests an expired batch did not run are resent by retrieve_batches
+
+
+    def __init__(self, run_name, response_cache=None, artifact_format='csv', metrics=None):
         self.client = openai.OpenAI()
-        self.async_client = openai.AsyncOpenAI()
         self.run_name = run_name
         self.jobs = []
+        self.response_cache = response_cache
+        self.artifact_format = artifact_format # format of the specs and results frames, 'csv' or 'parquet'
+        self.manifest = manifest_utils.RunManifest(path_utils.run_manifest_file_path(self.run_name))
+        self.metrics = metrics if metrics is not None else metrics_utils.RunMetrics(self.run_name)
         logger.info(f'OpenAI session created with run_name {self.run_name}.')
 
 
-    def generate_batch_files(self, specs_df) -> dict:
+    def generate_batch_files(self, specs_df, use_cache=True) -> dict:
+        started_at, stage_key = time.perf_counter(), self.metrics.start_stage()
+        n_jobs, n_requests, n_bytes = len(self.jobs), 0, 0
         
-        run_specs_filename = path_utils.run_specs_file_path(self.run_name)
+        run_specs_filename = path_utils.artifact_file_path(path_utils.run_specs_file_path(self.run_name), self.artifact_format)
         path_utils.rename_with_index(run_specs_filename)
-        specs_df.to_csv(run_specs_filename)
+        io_utils.write_frame(specs_df, run_specs_filename, self.artifact_format)
         make_file_read_only(run_specs_filename)
         logger.info(f'Run specs has been specified:\n {specs_df}')
         logger.info(f'Run specs has been saved to: {run_specs_filename}.')
 
+        # specs carry prompt_template / prompt_key, the text only exists in the batch files and the run prompts file
+        prompt_table_df = self._update_prompt_table(specs_df)
+
         # split by models
-        for model_name, model_specs_df in specs_df.groupby('model'):
-            
-            # check length
-            if len(model_specs_df) > 50_000:
-                raise ValueError('Cannot process batches > 50,000 queries.')
+        for model_name, model_specs_df in specs_df.groupby('model', observed=True):
 
-            # create jsonl file
-            jsonl_list = []
-            for idx, one_spec in model_specs_df.iterrows():
+            # create requests
+            requests = []
+            model_prompts = prompt_processing.materialize_prompts(model_specs_df, prompt_table_df)
+            for (idx, one_spec), prompt in zip(model_specs_df.iterrows(), model_prompts):
                 request = {"custom_id": f"request-{idx+1}",
                            "method"   : "POST",
                            "url"      : "/v1/chat/completions",
                            "body"     : {"model"   : model_name,
-                                         "messages": [{"role": "user", "content": one_spec['prompt']}],
+                                         "messages": [{"role": "user", "content": prompt}],
                                          }
                            }
                 if 'temperature' in one_spec:
@@ -61,40 +100,180 @@ class OpenAISession():
                 if 'seed' in one_spec:
                     request['body']['seed'] = one_spec['seed']
 
-                jsonl_list.append(request)
+                requests.append((idx, request))
+
+            # serve what the response cache already has, only the misses are sent
+            if self.response_cache is not None and use_cache:
+                requests = self._generate_cached_job(model_name, model_specs_df, requests)
+
+            # create jsonl lines, split into shards that fit the batch API limits
+            shards = []
+            shard_idx, shard_lines, shard_bytes, shard_tokens = [], [], 0, 0
+            for idx, request in requests:
+                line = json.dumps(request) + '\n'
+                line_bytes = len(line.encode('utf-8'))
+                line_tokens = token_utils.estimate_request_tokens(request['body'])
+
+                if shard_lines and self._exceeds_batch_limits(model_name, 
+                                                              len(shard_lines) + 1, 
+                                                              shard_bytes + line_bytes, 
+                                                              shard_tokens + line_tokens):
+                    shards.append((shard_idx, shard_lines))
+                    shard_idx, shard_lines, shard_bytes, shard_tokens = [], [], 0, 0
+
+                shard_idx.append(idx)
+                shard_lines.append(line)
+                shard_bytes += line_bytes
+                shard_tokens += line_tokens
+            if shard_lines:
+                shards.append((shard_idx, shard_lines))
+
+            if len(shards) > 1:
+                logger.info(f"Model {model_name} has {len(model_specs_df)} queries, split into {len(shards)} batch jobs.")
             
-            # create job path
-            job_path = path_utils.job_path(run_name=self.run_name, job_name=model_name)
-            path_utils.create_path(job_path, exist_ok=False)
-            logger.info(f"Directory created {job_path}.")
+            for shard_num, (shard_idx, shard_lines) in enumerate(shards, start=1):
+
+                # create job path
+                job_name = model_name if len(shards) == 1 else f"{model_name}__shard_{shard_num}_of_{len(shards)}"
+                job_path = path_utils.job_path(run_name=self.run_name, job_name=job_name)
+                path_utils.create_path(job_path, exist_ok=False)
+                logger.info(f"Directory created {job_path}.")
+
+                # save specs_df 
+                job_specs_filename = io_utils.write_frame(model_specs_df.loc[shard_idx], 
+                                                          path_utils.job_specs_file_path(job_path), 
+                                                          self.artifact_format)
+                make_file_read_only(job_specs_filename)
+                logger.info(f"Specs dataframe saved to {job_specs_filename}.")
+
+                # save source file
+                job_source_filename = path_utils.job_source_file_path(job_path)
+                with open(job_source_filename, "w") as file:
+                    file.writelines(shard_lines)
+                make_file_read_only(job_source_filename)
+                logger.info(f"Source file saved to {job_source_filename}")
+                n_requests += len(shard_lines)
+                n_bytes += os.path.getsize(job_source_filename)
+                
+                self.manifest.update(job_path, model=model_name, source_file=job_source_filename, 
+                                     request_total=len(shard_lines), request_tokens=shard_tokens)
+                self.jobs.append(job_path)
+
+        self.metrics.add('serialize', time.perf_counter() - started_at, stage_key=stage_key, 
+                         requests=n_requests, bytes=n_bytes, jobs=len(self.jobs) - n_jobs)
+        return self.jobs
+        
 
-            # save specs_df 
-            job_specs_filename  = path_utils.job_specs_file_path(job_path)
-            model_specs_df.to_csv(job_specs_filename)
-            make_file_read_only(job_specs_filename)
-            logger.info(f"Specs dataframe saved to {job_specs_filename}.")
+    def _update_prompt_table(self, specs_df):
+        # specs written before prompt keys existed carry the text itself
+        if 'prompt' in specs_df.columns:
+            return None
+
+        prompt_table_df = prompt_processing.prompt_table(specs_df)
+        run_prompts_filename = path_utils.artifact_file_path(path_utils.run_prompts_file_path(self.run_name), self.artifact_format)
+        if os.path.exists(run_prompts_filename):
+            # earlier sends of the run, e.g. before resend_invalid
+            run_prompts_df = pd.concat([io_utils.read_frame(run_prompts_filename), prompt_table_df], axis=0, ignore_index=True)
+            run_prompts_df = run_prompts_df.drop_duplicates(['prompt_key'], ignore_index=True)
+        else:
+            run_prompts_df = prompt_table_df
+        io_utils.write_frame(run_prompts_df, run_prompts_filename, self.artifact_format)
+        logger.info(f'{len(prompt_table_df)} distinct prompts of the specs saved to {run_prompts_filename}.')
+        return prompt_table_df
 
-            # save source file
-            job_source_filename = path_utils.job_source_file_path(job_path)
-            with open(job_source_filename, "w") as file:
-                for obj in jsonl_list:
-                    file.write(json.dumps(obj) + '\n')
-            make_file_read_only(job_source_filename)
-            logger.info(f"Source file saved to {job_source_filename}")
-            
-            self.jobs.append(job_path)
 
-        return self.jobs
-        
+    def _generate_cached_job(self, model_name, model_specs_df, requests):
+        cached_responses = self.response_cache.lookup([request['body'] for _, request in requests])
+        hits = [(idx, request, response) for (idx, request), response in zip(requests, cached_responses) if response is not None]
+        misses = [(idx, request) for (idx, request), response in zip(requests, cached_responses) if response is None]
+        if not hits:
+            return misses
+
+        # cached responses go to a job of their own, which is completed from the start and never sent
+        job_path = path_utils.job_path(run_name=self.run_name, job_name=f"{model_name}__cached")
+        path_utils.create_path(job_path, exist_ok=False)
+
+        job_specs_filename = io_utils.write_frame(model_specs_df.loc[[idx for idx, _, _ in hits]], 
+                                                  path_utils.job_specs_file_path(job_path), 
+                                                  self.artifact_format)
+        make_file_read_only(job_specs_filename)
+
+        job_source_filename = path_utils.job_source_file_path(job_path)
+        job_response_filename = path_utils.job_response_file_path(job_path)
+        with open(job_source_filename, "w") as source_file, open(job_response_filename, "w") as response_file:
+            for _, request, response in hits:
+                source_file.write(json.dumps(request) + '\n')
+                # the cached_ prefix of the batch_id keeps the response out of the cost of this run
+                response_file.write(json.dumps(dict(response, id=f"cached_{response.get('id')}", custom_id=request['custom_id'])) + '\n')
+        make_file_read_only(job_source_filename)
+        make_file_read_only(job_response_filename)
+
+        self.manifest.update(job_path, model=model_name, source_file=job_source_filename)
+        self._save_job_info(job_path, {"status": "completed",
+                                       "created_at": time_utils.get_unix_utc_timestamp(),
+                                       "completed_at": time_utils.get_unix_utc_timestamp(),
+                                       "request_counts": {"total": len(hits), "completed": len(hits), "failed": 0},
+                                       "metadata": {
+                                           "description": "this was a response cache job"
+                                       }})
+        logger.info(f"{len(hits)} of {len(requests)} queries for model {model_name} served from the response cache, saved to {job_path}.")
+
+        return misses
+
+
+    def _exceeds_batch_limits(self, model_name, n_requests, n_bytes, n_tokens):
+        # non-batch models are sent query by query, the batch API limits do not apply
+        if model_name in OpenAISession.non_batch_models:
+            return False
+        return n_requests > OpenAISession.batch_max_requests or \
+               n_bytes > OpenAISession.batch_max_bytes or \
+               (OpenAISession.batch_max_tokens is not None and n_tokens > OpenAISession.batch_max_tokens)
+
 
     def send_batches(self):
         summary = {}
 
         for job_path in self.jobs:
-            summary.update(self.send_one_batch(job_path))
+            summary.update(self.send_or_queue_batch(job_path))
         logger.info(f'---------- JOBS SENT SUMMARY\n{pprint.pformat(summary)}')
 
 
+    def send_or_queue_batch(self, job_path):
+        job = self.manifest.job(job_path)
+        max_enqueued_tokens = OpenAISession.batch_max_enqueued_tokens.get(job['model'])
+        if max_enqueued_tokens is None or job['model'] in OpenAISession.non_batch_models:
+            return self.send_one_batch(job_path)
+
+        # a job is sent once it fits next to the unfinished batches of its model, or when there are none
+        request_tokens = job['request_tokens'] or 0
+        enqueued_tokens = self.manifest.enqueued_tokens(job['model'])
+        if enqueued_tokens == 0 or enqueued_tokens + request_tokens <= max_enqueued_tokens:
+            if request_tokens > max_enqueued_tokens:
+                logger.warning(f"Job {job_path} has ~{request_tokens} tokens, over the enqueued limit of {max_enqueued_tokens} for {job['model']} on its own. "
+                               f"Set batch_max_tokens to shard it.")
+            return self.send_one_batch(job_path)
+
+        if job['status'] != 'queued':
+            job_info = self._load_job_info(job_path)
+            job_info.update({"status": "queued",
+                             "queued_at": time_utils.get_unix_utc_timestamp()})
+            self._save_job_info(job_path, job_info)
+            self.metrics.increment('batches_queued')
+            logger.info(f"Job {job_path} queued, {enqueued_tokens} of {max_enqueued_tokens} tokens enqueued for {job['model']}.")
+        return {job_path: 'queued'}
+
+
+    def release_queued_jobs(self):
+        # queued jobs in job order, until the budgets freed by finished batches are filled again
+        summary = {}
+        for job_path, status in self.manifest.statuses().items():
+            if status == 'queued' and self.send_or_queue_batch(job_path)[job_path] != 'queued':
+                summary[job_path] = self.manifest.job(job_path)['status']
+        if summary:
+            logger.info(f'---------- QUEUED JOBS RELEASED\n{pprint.pformat(summary)}')
+        return summary
+
+
     def send_one_batch(self, job_path):
 
         source_filename = path_utils.job_source_file_path(job_path)
@@ -102,6 +281,7 @@ class OpenAISession():
         # check if batch has the same model
         with open(source_filename, "r") as file:
             source_file_models = [json.loads(line)['body']['model'] for line in file]
+            n_requests = len(source_file_models)
             source_file_models = set(source_file_models)
 
         if len(source_file_models) != 1:
@@ -110,27 +290,27 @@ class OpenAISession():
         # check if batch is non-batch model
         if source_file_models.pop() in OpenAISession.non_batch_models:
             logger.info(f"ASYNC JOB STARTED: Non-batch model {job_path}")
-            asyncio.run(self._send_and_retrieve_non_batch(job_path))
+            with self.metrics.stage('non_batch', requests=n_requests):
+                asyncio.run(self._send_and_retrieve_non_batch(job_path))
             logger.info(f"ASYNC JOB STARTED: Non-batch model {job_path}")
             return {job_path: 'Non-batch model sent and retrieved.'}
         else:
-            # create file object
-            batch_input_file = self.client.files.create(file=open(source_filename, "rb"),
-                                                        purpose="batch"
-                                                        )
-
-            # send batch job
-            batch_obj = self.client.batches.create(input_file_id=batch_input_file.id,
-                                                   endpoint="/v1/chat/completions",
-                                                   completion_window="24h",
-                                                   metadata={"description": "eval job"}
-                                                   )
+            with self.metrics.stage('upload', requests=n_requests, bytes=os.path.getsize(source_filename)):
+                # create file object
+                batch_input_file = self.client.files.create(file=open(source_filename, "rb"),
+                                                            purpose="batch"
+                                                            )
+
+                # send batch job
+                batch_obj = self.client.batches.create(input_file_id=batch_input_file.id,
+                                                       endpoint="/v1/chat/completions",
+                                                       completion_window="24h",
+                                                       metadata={"description": "eval job"}
+                                                       )
             logger.info(f"Batch job {batch_obj.id} sent to OpenAI.")
             
             # save info file
-            job_info_filename = path_utils.job_info_file_path(job_path)
-            with open(job_info_filename, "w") as file:
-                json.dump(_obj_to_json_dict_helper(batch_obj), file, indent=4)
+            job_info_filename = self._save_job_info(job_path, _obj_to_json_dict_helper(batch_obj))
             logger.info(f"Info file saved to {job_info_filename}.")
 
             return {job_path: 'sent'}
@@ -138,42 +318,109 @@ class OpenAISession():
 
     async def _send_and_retrieve_non_batch(self, job_path):
 
-        # read source file
         source_filename = path_utils.job_source_file_path(job_path)
-        with open(source_filename, "r") as file:
-            job_source_list = [json.loads(line) for line in file]
-        
-        # send queries
+        job_response_filename = path_utils.job_response_file_path(job_path)
+        job_error_filename = path_utils.job_error_file_path(job_path)
+
+        # responses already on disk from a previous, interrupted run of this job
+        completed_custom_ids = _read_custom_ids_helper(job_response_filename)
+        if completed_custom_ids:
+            logger.info(f"Resuming {job_path}, {len(completed_custom_ids)} responses already saved to {job_response_filename}.")
+
+        # save info file before sending, so an interrupted job shows up as not completed
         job_info = {"status": "started",
                     "created_at": time_utils.get_unix_utc_timestamp(),
                     "metadata": {
                         "description": "this was a non-batch model job"
                     }}
-        tasks = [self._send_one_query(**one_query['body']) for one_query in job_source_list]
-        responses = await asyncio.gather(*tasks)
+        self._save_job_info(job_path, job_info)
 
-        # write to response file
-        job_response_filename = path_utils.job_response_file_path(job_path)
-        with open(job_response_filename, "w") as file:
-            for completion_obj, one_query in zip(responses, job_source_list):
-                response = self.completion_object_to_batch_response(completion_obj, custom_id=one_query['custom_id'])
-                if response:
-                    file.write(json.dumps(response) + '\n')
-        make_file_read_only(job_response_filename)
+        # send queries
+        rate_limiter = rate_limit_utils.AsyncRateLimiter(requests_per_minute=OpenAISession.non_batch_requests_per_minute,
+                                                         tokens_per_minute=OpenAISession.non_batch_tokens_per_minute)
 
-        # save info file
-        job_info_filename = path_utils.job_info_file_path(job_path)
-        with open(job_info_filename, "w") as file:
-            job_info.update(
-                    {"status": "completed",
-                     "completed_at": time_utils.get_unix_utc_timestamp()}
-                )
-            json.dump(job_info, file, indent=4)
+        request_counts = {"total": 0, "completed": len(completed_custom_ids), "failed": 0}
+
+        with open(source_filename, "r") as source_file, \
+             open(job_response_filename, "a") as response_file, \
+             open(job_error_filename, "w") as error_file:
+            
+            # the source file is streamed, only the queries in flight are held in memory
+            def pending_queries():
+                for line in source_file:
+                    one_query = json.loads(line)
+                    request_counts['total'] += 1
+                    if one_query['custom_id'] not in completed_custom_ids:
+                        yield one_query
+            queries = pending_queries()
+
+            # a fixed pool of workers pulling from the same iterator bounds the number of requests in flight
+            async def worker(async_client):
+                for one_query in queries:
+                    try:
+                        completion_obj = await self._send_one_query(async_client, rate_limiter, **one_query['body'])
+                        response = self.completion_object_to_batch_response(completion_obj, custom_id=one_query['custom_id'])
+                        if response is None:
+                            raise ValueError('Completion object could not be converted to a batch response.')
+                    except Exception as e:
+                        # record the failure and carry on, the rest of the job is unaffected
+                        logger.warning(f"Query {one_query['custom_id']} of {job_path} failed: {e}")
+                        error_file.write(json.dumps(_exception_to_batch_error_helper(e, one_query['custom_id'])) + '\n')
+                        error_file.flush()
+                        request_counts['failed'] += 1
+                        continue
+                    
+                    # append and flush each response as it arrives, a crash only loses the queries in flight
+                    response_file.write(json.dumps(response) + '\n')
+                    response_file.flush()
+                    request_counts['completed'] += 1
+
+            # a client per job, its connection pool belongs to the event loop asyncio.run creates for the job
+            async with openai.AsyncOpenAI(max_retries=0) as async_client: # retries are handled per query by the non-batch dispatcher
+                await asyncio.gather(*[worker(async_client) for _ in range(OpenAISession.non_batch_max_in_flight)])
+
+        # the error file is rewritten by each pass, failures of earlier passes were answered by this one or failed again
+        self.manifest.replace_failures(job_path, _read_job_errors_helper(job_error_filename))
+
+        # save info file, partially failed jobs are resent by resend_failed_jobs, which only sends what is missing
+        if request_counts['failed'] == 0:
+            make_file_read_only(job_response_filename)
+            job_info.update({"status": "completed",
+                             "completed_at": time_utils.get_unix_utc_timestamp()})
+        else:
+            logger.warning(f"{request_counts['failed']} queries of {job_path} failed, see {job_error_filename}.")
+            job_info.update({"status": "failed",
+                             "failed_at": time_utils.get_unix_utc_timestamp()})
+        job_info['request_counts'] = request_counts
+        self.metrics.increment('non_batch_failed_requests', request_counts['failed'])
+        job_info_filename = self._save_job_info(job_path, job_info)
         logger.info(f"Info file saved to {job_info_filename}.") 
 
 
-    async def _send_one_query(self, **kwargs):
-        return await self.async_client.chat.completions.create(**kwargs)
+    async def _send_one_query(self, async_client, rate_limiter, **kwargs):
+        for attempt in range(OpenAISession.non_batch_max_retries + 1):
+            await rate_limiter.acquire(token_utils.estimate_request_tokens(kwargs))
+            try:
+                raw_response = await async_client.chat.completions.with_raw_response.create(**kwargs)
+            except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+                # out of quota will not recover by waiting
+                if attempt == OpenAISession.non_batch_max_retries or getattr(e, 'code', None) == 'insufficient_quota':
+                    raise
+                delay = rate_limit_utils.backoff_delay(attempt, 
+                                                       OpenAISession.non_batch_backoff_base_delay, 
+                                                       OpenAISession.non_batch_backoff_max_delay)
+                # a 429 slows down every worker, not only this one
+                if isinstance(e, openai.RateLimitError):
+                    self.metrics.increment('rate_limited')
+                    rate_limiter.update_from_headers(e.response.headers)
+                    delay = max(delay, rate_limit_utils.parse_retry_after(e.response.headers))
+                    rate_limiter.pause(delay)
+                logger.info(f"Retrying query in {delay:.1f}s after {type(e).__name__} (attempt {attempt + 1}).")
+                self.metrics.increment('retries')
+                await asyncio.sleep(delay)
+                continue
+            rate_limiter.update_from_headers(raw_response.headers)
+            return raw_response.parse()
     
 
     def completion_object_to_batch_response(self, completion, custom_id):
@@ -229,68 +476,220 @@ class OpenAISession():
         return response
 
 
-    def load_jobs(self):
-        self.jobs = path_utils.get_subdirs(path_utils.run_path(self.run_name), return_posix=True)
+    def load_jobs(self, rescan=False):
+        # the manifest lists the jobs, listing the run directory is cheap, parsing the job files is what it saves
+        job_paths = [job_path for job_path in path_utils.get_subdirs(path_utils.run_path(self.run_name), return_posix=True)
+                     if os.path.basename(job_path).startswith('job__')]
+        if rescan:
+            self.jobs = self.manifest.rebuild(job_paths)
+        elif set(job_paths) != set(self.manifest.job_paths()):
+            # job directories from before the manifest existed, or gone since
+            self.jobs = self.manifest.rebuild(job_paths, skip_indexed=True)
+        else:
+            self.jobs = self.manifest.job_paths()
         logger.info(f'Session {self.run_name} loaded previous jobs info:')
         logger.info(f'---------- JOBS LOADED SUMMARY\n{pprint.pformat(self.jobs)}')
         return self.jobs
     
 
-    def retrieve_batches(self):
+    def retrieve_batches(self, job_paths=None):
         summary = {}
-        for job_path in self.jobs:
-            summary.update(self.retrieve_one_batch(job_path))
+        job_paths = self.jobs if job_paths is None else job_paths
+        with ThreadPoolExecutor(max_workers=OpenAISession.retrieve_max_workers) as executor:
+            for job_summary in executor.map(self.retrieve_one_batch, job_paths):
+                summary.update(job_summary)
         logger.info(f'---------- JOBS RETRIEVED SUMMARY\n{pprint.pformat(summary)}')
 
+        # only what expired batches did not run is sent again
+        if OpenAISession.resubmit_expired:
+            expired_job_paths = [job_path for job_path, status in summary.items() 
+                                 if status == 'salvaged' and self._load_job_info(job_path).get('batch_status') == 'expired']
+            if expired_job_paths:
+                resent_job_paths = self.resend_failed_requests(job_paths=expired_job_paths)
+                summary.update({job_path: self.manifest.job(job_path)['status'] for job_path in resent_job_paths})
+
+        # batches that finished make room for queued jobs
+        summary.update(self.release_queued_jobs())
+        return summary
+
+
+    def watch_batches(self, timeout=None):
+        started_at = time.monotonic()
+        next_poll_at = {job_path: started_at for job_path in self.jobs}
+        progress = {}
+
+        while next_poll_at:
+            now = time.monotonic()
+            due_jobs = [job_path for job_path, poll_at in next_poll_at.items() if poll_at <= now]
+            summary = self.retrieve_batches(due_jobs)
+
+            for job_path in due_jobs:
+                # done, completed jobs were downloaded by retrieve_one_batch
+                if summary[job_path] not in BATCH_IN_FLIGHT_STATUSES:
+                    del next_poll_at[job_path]
+                    continue
+
+                job = self.manifest.job(job_path)
+                request_counts = {'total': job['request_total'] or 0,
+                                  'completed': job['request_completed'] or 0,
+                                  'failed': job['request_failed'] or 0}
+                interval = self._next_poll_interval(progress.get(job_path), now, request_counts)
+                progress[job_path] = (now, request_counts.get('completed', 0), interval)
+                next_poll_at[job_path] = now + interval
+
+            # queued jobs released by retrieve_batches are watched from now on
+            for job_path in summary.keys() - set(due_jobs):
+                if summary[job_path] in BATCH_IN_FLIGHT_STATUSES:
+                    next_poll_at[job_path] = now + OpenAISession.watch_min_poll_interval
+
+            if not next_poll_at:
+                break
+            if timeout is not None and time.monotonic() - started_at > timeout:
+                logger.warning(f'Stopped watching after {timeout}s, {len(next_poll_at)} jobs are still in progress.')
+                break
+            time.sleep(max(0, min(next_poll_at.values()) - time.monotonic()))
+
+        return not next_poll_at
+
+
+    def _next_poll_interval(self, previous_progress, now, request_counts):
+        min_interval = OpenAISession.watch_min_poll_interval
+        max_interval = OpenAISession.watch_max_poll_interval
+        if previous_progress is None:
+            return min_interval
+
+        previous_time, previous_completed, previous_interval = previous_progress
+        completed = request_counts.get('completed', 0)
+        remaining = request_counts.get('total', 0) - completed - request_counts.get('failed', 0)
+
+        # moving, poll again around half way to the estimated finish
+        if completed > previous_completed and remaining > 0:
+            rate = (completed - previous_completed) / (now - previous_time)
+            return min(max_interval, max(min_interval, remaining / rate / 2))
+        # not moving (or about to finalize), back off
+        return min(max_interval, max(min_interval, previous_interval * 2))
+
 
     def retrieve_one_batch(self, job_path):
 
-        # read info file
-        job_info_filename = path_utils.job_info_file_path(job_path)
-        with open(job_info_filename, "r") as file:
-            job_info = json.load(file)
+        job = self.manifest.job(job_path)
 
         # check job status
         # - job was in progress
-        if job_info['status'] in ['validating', 'in_progress', 'finalizing']:
+        if job['status'] in BATCH_IN_FLIGHT_STATUSES:
             
             # check job
-            batch_obj = self.client.batches.retrieve(job_info['id'])
-            job_info_filename = path_utils.job_info_file_path(job_path)
-            with open(job_info_filename, "w") as file:
-                json.dump(_obj_to_json_dict_helper(batch_obj), file, indent=4)
-            logger.info(f"Info file saved to {job_info_filename}.") 
+            with self.metrics.stage('poll'):
+                batch_obj = self.client.batches.retrieve(job['job_id'])
+            job_info = _obj_to_json_dict_helper(batch_obj)
 
             # job still in progress
-            if batch_obj.status in ['validating', 'in_progress', 'finalizing']:
+            if batch_obj.status in BATCH_IN_FLIGHT_STATUSES:
                 logger.info(f"Run: {self.run_name}, job: {job_path} is {batch_obj.status}.")
             
-            # job completed
+            # job completed, files are downloaded before the info file is saved, so an interrupted download is retried
             elif batch_obj.status == 'completed':
-                job_response = self.client.files.content(batch_obj.output_file_id).content.decode('utf-8')
                 job_response_filename = path_utils.job_response_file_path(job_path)
-                with open(job_response_filename, "w") as file:
-                    file.write(str(job_response))
-                make_file_read_only(job_response_filename)
+                # every request failed, there is only an error file
+                if batch_obj.output_file_id:
+                    job_info['output_file'] = self._download_file(batch_obj.output_file_id, job_response_filename)
+                if batch_obj.error_file_id:
+                    job_info['error_file'] = self._download_file(batch_obj.error_file_id, path_utils.job_error_file_path(job_path))
+                    self.manifest.record_failures(job_path, _read_job_errors_helper(path_utils.job_error_file_path(job_path)))
                 logger.info(f"Run: {self.run_name}, job: {job_path} is now completed and response is saved to {job_response_filename}.")
 
+            # rejected for the enqueued token limit, queued again if the limit of the model is known and the job fits it
+            elif batch_obj.status == 'failed' and _token_limit_exceeded_helper(batch_obj) and \
+                 (job['request_tokens'] or 0) <= OpenAISession.batch_max_enqueued_tokens.get(job['model'], -1):
+                job_info['status'] = 'queued'
+                job_info['queued_at'] = time_utils.get_unix_utc_timestamp()
+                logger.info(f"Run: {self.run_name}, job: {job_path} hit the enqueued token limit and is queued again.")
+
+            # ended before all requests ran, whatever output exists is kept and the rest recorded as failed
+            elif batch_obj.status in ['expired', 'cancelled'] or \
+                 (batch_obj.status == 'failed' and (batch_obj.output_file_id or batch_obj.error_file_id)):
+                job_info.update(self._salvage_batch(job_path, batch_obj))
+                logger.warning(f"Run: {self.run_name}, job: {job_path} is {batch_obj.status}, "
+                               f"{job_info['request_counts']['completed']} of {job_info['request_counts']['total']} requests salvaged.")
+
             # job unknown status, treat as error
             else:
                 logger.warning(f"[UNKNOWN STATUS] Run: {self.run_name}, job: {job_path} is {batch_obj.status}.")
 
-            return {job_path: batch_obj.status}
+            job_info_filename = self._save_job_info(job_path, job_info)
+            logger.info(f"Info file saved to {job_info_filename}.") 
+
+            return {job_path: job_info['status']}
+
+        # - job is waiting for enqueued token budget, released by retrieve_batches
+        elif job['status'] == 'queued':
+            logger.info(f'Run: {self.run_name}, job: {job_path} is queued.')
+
+            return {job_path: 'queued'}
 
         # - job was completed, nothing to do
-        elif job_info['status'] == 'completed':
-            logger.info(f'Run: {self.run_name}, job: {job_path} was previous completed.')
+        elif job['status'] in ['completed', 'salvaged']:
+            logger.info(f'Run: {self.run_name}, job: {job_path} was previous {job["status"]}.')
 
-            return {job_path: 'completed'}
+            return {job_path: job['status']}
 
         # - unknown job status, treat as error
         else:
-            logger.warning(f"[UNKNOWN STATUS] Run: {self.run_name}, job: {job_path} was previouly {job_info['status']}.")
+            logger.warning(f"[UNKNOWN STATUS] Run: {self.run_name}, job: {job_path} was previouly {job['status']}.")
 
-            return {job_path: job_info['status']}
+            return {job_path: job['status']}
+
+
+    def _salvage_batch(self, job_path, batch_obj):
+        job_response_filename = path_utils.job_response_file_path(job_path)
+        job_error_filename = path_utils.job_error_file_path(job_path)
+        salvage_info = {"status": "salvaged",
+                        "batch_status": batch_obj.status,
+                        "salvaged_at": time_utils.get_unix_utc_timestamp()}
+        if batch_obj.output_file_id:
+            salvage_info['output_file'] = self._download_file(batch_obj.output_file_id, job_response_filename)
+        if batch_obj.error_file_id:
+            salvage_info['error_file'] = self._download_file(batch_obj.error_file_id, job_error_filename)
+
+        completed_custom_ids = set()
+        if os.path.exists(job_response_filename):
+            with open(job_response_filename, "r") as file:
+                completed_custom_ids = {json.loads(line)['custom_id'] for line in file if line.strip()}
+        failures = _read_job_errors_helper(job_error_filename)
+
+        # requests in neither file never ran
+        answered_custom_ids = completed_custom_ids | {failure['custom_id'] for failure in failures}
+        n_requests = 0
+        with open(path_utils.job_source_file_path(job_path), "r") as file:
+            for line in file:
+                n_requests += 1
+                custom_id = json.loads(line)['custom_id']
+                if custom_id not in answered_custom_ids:
+                    failures.append({'custom_id': custom_id, 
+                                     'code': f'batch_{batch_obj.status}', 
+                                     'message': f'Not run before the batch was {batch_obj.status}.'})
+        self.manifest.record_failures(job_path, failures)
+
+        salvage_info['request_counts'] = {"total": n_requests, "completed": len(completed_custom_ids), "failed": len(failures)}
+        return salvage_info
+
+
+    def _download_file(self, file_id, filename):
+        # stream in chunks to a temp file and rename it, a partial download never looks like a response file
+        tmp_filename = f"{filename}.tmp"
+        sha256 = hashlib.sha256()
+        nbytes = 0
+        with self.metrics.stage('download', bytes=0) as record, \
+             self.client.files.with_streaming_response.content(file_id) as response, open(tmp_filename, "wb") as file:
+            for chunk in response.iter_bytes(chunk_size=OpenAISession.download_chunk_size):
+                file.write(chunk)
+                sha256.update(chunk)
+                nbytes += len(chunk)
+            record['bytes'] = nbytes
+        os.replace(tmp_filename, filename)
+        make_file_read_only(filename)
+        logger.info(f"File {file_id} downloaded to {filename} ({nbytes} bytes).")
+        return {"id": file_id, "bytes": nbytes, "sha256": sha256.hexdigest()}
 
 
     def resend_failed_jobs(self):
@@ -298,20 +697,103 @@ class OpenAISession():
         if self.all_completed():
             logger.info('ALL JOBS ARE COMPLETED. NO FAILED JOBS.')
 
-        for job_path in self.jobs:
-
-            # read info file
-            info_filename = path_utils.job_info_file_path(job_path)
-            with open(info_filename, "r") as file:
-                job_info = json.load(file)
+        for job_path, status in self.manifest.statuses().items():
 
             # if in error, resend batch
-            if job_info['status'] not in ['completed', 'validating', 'in_progress', 'finalizing']:
-                logger.info(f'Re-sending {job_info['status']} job {job_path} ...')
-                self.send_one_batch(job_path)
+            # salvaged jobs only resend what did not run, through resend_failed_requests
+            if status not in ['completed', 'salvaged', 'queued', *BATCH_IN_FLIGHT_STATUSES]:
+                logger.info(f'Re-sending {status} job {job_path} ...')
+                self.send_or_queue_batch(job_path)
+
+
+    def resend_failed_requests(self, job_paths=None):
+        """
+        Sends only the requests that failed within completed or salvaged batch jobs (of job_paths,
+        None for all), as one new job per model.
+        Their custom_ids, and so their obs_idx, are kept, so process_reponses counts the new
+        response as the last query of the row. Failed non-batch jobs resume through resend_failed_jobs.
+        """
+        # jobs retrieved before their failures were recorded
+        recorded_job_paths = {failure['job_path'] for failure in self.manifest.failures()}
+        for job in self.manifest.jobs():
+            if job['status'] in ['completed', 'salvaged'] and job['error_file'] is not None and job['job_path'] not in recorded_job_paths:
+                self.manifest.record_failures(job['job_path'], _read_job_errors_helper(job['error_file']))
+
+        statuses = self.manifest.statuses()
+        failed_custom_ids = {}
+        for failure in self.manifest.failures(unresent_only=True):
+            if statuses.get(failure['job_path']) in ['completed', 'salvaged'] and (job_paths is None or failure['job_path'] in job_paths):
+                failed_custom_ids.setdefault(failure['job_path'], set()).add(failure['custom_id'])
+
+        # failures a later pass of the job answered, its response file is the record of what succeeded
+        for job_path in list(failed_custom_ids):
+            answered_custom_ids = failed_custom_ids[job_path] & _read_custom_ids_helper(path_utils.job_response_file_path(job_path), repair=False)
+            if answered_custom_ids:
+                logger.warning(f"{len(answered_custom_ids)} failed requests of {job_path} have a response since, they are not resent.")
+                self.manifest.delete_failures(job_path, answered_custom_ids)
+                failed_custom_ids[job_path] -= answered_custom_ids
+                if not failed_custom_ids[job_path]:
+                    del failed_custom_ids[job_path]
+        if not failed_custom_ids:
+            logger.info('NO FAILED REQUESTS TO RESEND.')
+            return {}
+
+        # failed requests by model, as specs rows and source lines, a request failed in several jobs is sent once
+        resend_jobs = {}
+        for job_path, custom_ids in failed_custom_ids.items():
+            resend_job = resend_jobs.setdefault(self.manifest.job(job_path)['model'], {'job_paths': [], 'specs_dfs': [], 'lines': {}})
+            resend_job['job_paths'].append(job_path)
+            job_specs_df = io_utils.read_frame(path_utils.job_specs_file_path(job_path))
+            resend_job['specs_dfs'].append(job_specs_df.loc[[int(custom_id.replace('request-', '')) - 1 for custom_id in custom_ids]])
+            with open(path_utils.job_source_file_path(job_path), "r") as file:
+                for line in file:
+                    custom_id = json.loads(line)['custom_id']
+                    if custom_id in custom_ids:
+                        resend_job['lines'].setdefault(custom_id, line)
 
+        summary = {}
+        for model_name, resend_job in resend_jobs.items():
+            # numbered, several resends of a model can fall within the same second
+            n_resends = sum(f"/job__{model_name}__resend_" in job_path for job_path in statuses)
+            job_path = path_utils.job_path(run_name=self.run_name, job_name=f"{model_name}__resend_{n_resends + 1}")
+            path_utils.create_path(job_path, exist_ok=False)
 
-    def process_reponses(self):
+            job_specs_df = pd.concat(resend_job['specs_dfs'], axis=0)
+            job_specs_filename = io_utils.write_frame(job_specs_df[~job_specs_df.index.duplicated()], 
+                                                      path_utils.job_specs_file_path(job_path), 
+                                                      self.artifact_format)
+            make_file_read_only(job_specs_filename)
+
+            job_source_filename = path_utils.job_source_file_path(job_path)
+            with open(job_source_filename, "w") as file:
+                file.writelines(resend_job['lines'].values())
+            make_file_read_only(job_source_filename)
+
+            request_tokens = sum(token_utils.estimate_request_tokens(json.loads(line)['body']) for line in resend_job['lines'].values())
+            self.manifest.update(job_path, model=model_name, source_file=job_source_filename, 
+                                 request_total=len(resend_job['lines']), request_tokens=request_tokens)
+            for failed_job_path in resend_job['job_paths']:
+                self.manifest.mark_resent(failed_job_path, failed_custom_ids[failed_job_path], job_path)
+            self.jobs.append(job_path)
+            logger.info(f"{len(resend_job['lines'])} failed requests of {len(resend_job['job_paths'])} {model_name} jobs resent as {job_path}.")
+
+            summary.update(self.send_or_queue_batch(job_path))
+
+        logger.info(f'---------- FAILED REQUESTS RESENT SUMMARY\n{pprint.pformat(summary)}')
+        return summary
+
+
+    def process_reponses(self, incremental=False):
+        """
+        Stacks the results of the jobs as the run results, counting the queries of each row.
+        With incremental, the run results are brought up to date by fold_new_responses and read back.
+        """
+        if incremental:
+            self.fold_new_responses()
+            run_results_filename = io_utils.find_frame(path_utils.run_results_file_path(self.run_name))
+            return io_utils.read_frame(run_results_filename) if run_results_filename is not None else None
+
+        started_at, stage_key = time.perf_counter(), self.metrics.start_stage()
         summary = {}
         result_dfs = []
 
@@ -324,21 +806,120 @@ class OpenAISession():
 
         if result_dfs:
             run_results_filename = path_utils.run_results_file_path(self.run_name)
-            run_results_df = pd.concat(result_dfs, axis=0).sort_values(['created_time'], na_position='first')
-            groupby_cols = ['obs_idx', 'trial_id', 'subject_id', 'model', 'instruction'] + \
-                run_results_df.columns.intersection(['temperature', 'seed']).to_list()
-            run_results_df['with_response'] = run_results_df['textual_response'].notna().astype(int)
-            run_results_df['query_idx'] = run_results_df.groupby(groupby_cols)['with_response'].cumsum()
-            run_results_df['query_total_count'] = run_results_df.groupby(groupby_cols)['query_idx'].transform('max')
+            # jobs have categories of their own, which concat falls back to object for
+            run_results_df = schema_utils.apply_schema(pd.concat(result_dfs, axis=0)).sort_values(['created_time'], na_position='first')
+            groupby_cols = _query_groupby_cols_helper(run_results_df)
+            run_results_df['with_response'] = run_results_df['textual_response'].notna().astype('int8')
+            run_results_df['query_idx'] = run_results_df.groupby(groupby_cols, observed=True)['with_response'].cumsum()
+            run_results_df['query_total_count'] = run_results_df.groupby(groupby_cols, observed=True)['query_idx'].transform('max')
             run_results_df.loc[run_results_df['query_idx']==0, 'query_idx'] = np.nan
             run_results_df.loc[run_results_df['query_total_count']==0, 'query_total_count'] = np.nan
-            run_results_df = run_results_df.drop(columns=['with_response'])
-            run_results_df.to_csv(run_results_filename)
+            # requests that failed without a response line and were answered by a resent job since
+            resent = run_results_df['batch_id'].isna() & run_results_df['query_total_count'].notna()
+            run_results_df = schema_utils.apply_schema(run_results_df[~resent].drop(columns=['with_response']))
+            run_results_filename = io_utils.write_frame(run_results_df, run_results_filename, self.artifact_format)
+            # the file no longer is the one incremental passes folded into, the next one starts over
+            self.manifest.clear_aggregation()
             logger.info(f'Completed results saved to {run_results_filename}.')
 
+            if self.response_cache is not None:
+                self.response_cache.evict()
+            self.metrics.add('process_reponses', time.perf_counter() - started_at, stage_key=stage_key, rows=len(run_results_df))
+
             if self.all_completed():
                 logger.info('ALL JOBS ARE COMPLETED. SHOULD CHECK IF RESEND_INVALID IS NECESSARY.')
             return run_results_df
+
+
+    def fold_new_responses(self):
+        """
+        Appends the results of the jobs completed or salvaged since the last pass to the run results,
+        continuing the query counters of each group kept in the manifest, so a pass reads only the new
+        job results. Rows already in the run results are rewritten only when a new response changes
+        the query_total_count of their group, e.g. the answer of a resent request.
+        Unlike process_reponses, jobs still running are left out until they finish, and queries are
+        counted in the order their jobs were folded in. Returns the rows added, None if there were none.
+        """
+        started_at, stage_key = time.perf_counter(), self.metrics.start_stage()
+        run_results_filename = path_utils.artifact_file_path(path_utils.run_results_file_path(self.run_name), self.artifact_format)
+
+        # a results file written since, by process_reponses or a pass that did not finish, is folded again from scratch
+        aggregation = self.manifest.aggregation()
+        if aggregation is not None and (aggregation['results_file'] != run_results_filename or
+                                        not os.path.exists(run_results_filename) or
+                                        os.path.getsize(run_results_filename) != aggregation['results_bytes']):
+            logger.warning(f'{run_results_filename} changed since the last pass, the run results are folded again from all jobs.')
+            self.manifest.clear_aggregation()
+            aggregation = None
+
+        summary = {}
+        result_dfs = []
+        folded_job_paths = []
+        jobs = {job['job_path']: job for job in self.manifest.jobs()}
+        for job_path in self.jobs:
+            if jobs[job_path]['aggregated_at'] is not None or jobs[job_path]['status'] not in ['completed', 'salvaged']:
+                continue
+            job_summary, job_result_df = self.process_one_response(job_path)
+            summary.update(job_summary)
+            if job_result_df is not None:
+                result_dfs.append(job_result_df)
+                folded_job_paths.append(job_path)
+        logger.info(f'---------- RESULTS SUMMARY\n{pprint.pformat(summary)}')
+
+        if not result_dfs:
+            logger.info(f'No newly completed jobs, run results are up to date.')
+            return None
+
+        new_results_df = schema_utils.apply_schema(pd.concat(result_dfs, axis=0)).sort_values(['created_time'], na_position='first')
+        groupby_cols = _query_groupby_cols_helper(new_results_df)
+        group_keys = _group_keys_helper(new_results_df[groupby_cols])
+        previous_counts = pd.Series(self.manifest.query_counts(group_keys.unique()) if aggregation is not None else {}, dtype=float)
+
+        # counted on from the responses of the group in earlier passes, rows without a response line
+        # sort first in process_reponses, so they come before any response of the group
+        with_response = new_results_df['textual_response'].notna().astype('int8')
+        new_results_df['query_idx'] = with_response.groupby(group_keys.to_numpy()).cumsum() + group_keys.map(previous_counts).fillna(0)
+        new_results_df.loc[new_results_df['created_time'].isna(), 'query_idx'] = 0
+        query_counts = new_results_df.groupby(group_keys.to_numpy())['query_idx'].max()
+        query_counts = np.maximum(query_counts, previous_counts.reindex(query_counts.index).fillna(0))
+        new_results_df['query_total_count'] = group_keys.map(query_counts)
+        new_results_df.loc[new_results_df['query_idx']==0, 'query_idx'] = np.nan
+        new_results_df.loc[new_results_df['query_total_count']==0, 'query_total_count'] = np.nan
+        # requests that failed without a response line and were answered by a resent job since
+        resent = new_results_df['batch_id'].isna() & new_results_df['query_total_count'].notna()
+
+        # groups of earlier passes whose query_total_count changed
+        changed_counts = query_counts[query_counts.index.isin(previous_counts.index)]
+        changed_counts = changed_counts[changed_counts != previous_counts.reindex(changed_counts.index)]
+        changed_group = (~group_keys.duplicated() & group_keys.isin(changed_counts.index)).to_numpy()
+        changed_groups_df = new_results_df.loc[changed_group, groupby_cols].assign(changed_total_count=group_keys[changed_group].map(changed_counts).to_numpy())
+        new_results_df = schema_utils.apply_schema(new_results_df[~resent])
+
+        if aggregation is None:
+            io_utils.write_frame(new_results_df, run_results_filename, self.artifact_format)
+        elif changed_groups_df.empty and self.artifact_format == 'csv' and \
+             set(io_utils.read_frame_columns(run_results_filename)) == set(new_results_df.columns):
+            # only new groups, the rows are appended in the column order of the file
+            new_results_df[io_utils.read_frame_columns(run_results_filename)].to_csv(run_results_filename, mode='a', header=False)
+        else:
+            run_results_df = io_utils.read_frame(run_results_filename)
+            if not changed_groups_df.empty:
+                changed_total_count = run_results_df[groupby_cols].merge(changed_groups_df, on=groupby_cols, how='left')['changed_total_count'].to_numpy()
+                changed = ~np.isnan(changed_total_count)
+                run_results_df.loc[changed, 'query_total_count'] = np.where(changed_total_count[changed] > 0, changed_total_count[changed], np.nan)
+                run_results_df = run_results_df[~(changed & (changed_total_count > 0) & run_results_df['batch_id'].isna().to_numpy())]
+            io_utils.write_frame(schema_utils.apply_schema(pd.concat([run_results_df, new_results_df], axis=0)), run_results_filename, self.artifact_format)
+
+        self.manifest.record_aggregation(folded_job_paths, query_counts.astype(int).to_dict(), run_results_filename)
+        logger.info(f'Results of {len(folded_job_paths)} jobs ({len(new_results_df)} rows) folded into {run_results_filename}.')
+
+        if self.response_cache is not None:
+            self.response_cache.evict()
+        self.metrics.add('fold_new_responses', time.perf_counter() - started_at, stage_key=stage_key, rows=len(new_results_df))
+
+        if self.all_completed():
+            logger.info('ALL JOBS ARE COMPLETED. SHOULD CHECK IF RESEND_INVALID IS NECESSARY.')
+        return new_results_df
         
 
     def process_one_response(self, job_path):
@@ -352,46 +933,59 @@ class OpenAISession():
             return {job_path: 'Response file not found.'}, None
         
         # previously completed
-        if os.path.exists(job_results_filename):
-            job_results_df = pd.read_csv(job_results_filename, index_col=0)
-            return {job_path: f'Responses previously proceed. Saved as {job_results_filename}'}, job_results_df
+        job = self.manifest.job(job_path)
+        if job['results_file'] is not None and os.path.exists(job['results_file']):
+            job_results_df = io_utils.read_frame(job['results_file'])
+            return {job_path: f"Responses previously proceed. Saved as {job['results_file']}"}, job_results_df
 
         # just compelted
-        with open(job_response_filename, 'r') as file:
-            job_response_content = file.read()
-        job_response_content = [json.loads(r) for r in job_response_content.split('\n') if r != ""]
+        with self.metrics.stage('parse', bytes=os.path.getsize(job_response_filename)) as record:
+            job_response_content_df = _read_job_response_helper(job_response_filename)
+            record['requests'] = len(job_response_content_df)
         
         # read specs df
-        job_results_df = pd.read_csv(job_specs_filename, index_col=0)
+        job_results_df = io_utils.read_frame(job_specs_filename)
 
         if any(col in job_results_df.columns for col in ['batch_id', 'request_id', 'textual_response']):
             raise RuntimeError('The specs df may have invalid columns, this may happen when resending queries that previously had invalid responses. Please check')
 
-        job_response_content_df = pd.DataFrame({'batch_id': [r['id'] for r in job_response_content],
-                                                'request_id': [r['response']['request_id'] for r in job_response_content],
-                                                'created_time': [r['response']['body']['created'] for r in job_response_content],
-                                                'textual_response': [r['response']['body']['choices'][-1]['message']['content'] for r in job_response_content]},
-                                                index=[r['custom_id'] for r in job_response_content])
-        job_response_content_df.index = job_response_content_df.index.str.replace('request-', '').astype(int) - 1
-
         job_results_df = job_results_df.join(job_response_content_df)
-        job_results_df.to_csv(job_results_filename)
+
+        # partially failed jobs are not saved, their responses still change when resent
+        if job['status'] not in ['completed', 'salvaged']:
+            return {job_path: f"Partial results, job is {job['status']}."}, job_results_df
+
+        job_results_filename = io_utils.write_frame(job_results_df, job_results_filename, self.artifact_format)
         make_file_read_only(job_results_filename)
+        self.manifest.update(job_path, results_file=job_results_filename)
         logger.info(f'Results file saved to {job_results_filename}')
 
+        if self.response_cache is not None:
+            self.response_cache.index_job(job_path)
+
         return {job_path: f'Results saved to {job_results_filename}.'}, job_results_df
     
 
     def all_completed(self):
         self.load_jobs()
-        all_jobs_status = []
-        for job_path in self.jobs:
-            # read info file
-            job_info_filename = path_utils.job_info_file_path(job_path)
-            with open(job_info_filename, "r") as file:
-                job_info = json.load(file)
-            all_jobs_status.append(job_info['status'] == 'completed')
-        return all(all_jobs_status)
+        return self.manifest.all_completed()
+
+
+    def _load_job_info(self, job_path):
+        job_info_filename = path_utils.job_info_file_path(job_path)
+        if not os.path.exists(job_info_filename):
+            return {}
+        with open(job_info_filename, "r") as file:
+            return json.load(file)
+
+
+    def _save_job_info(self, job_path, job_info):
+        # the info file keeps the full job record, the manifest indexes it
+        job_info_filename = path_utils.job_info_file_path(job_path)
+        with open(job_info_filename, "w") as file:
+            json.dump(job_info, file, indent=4)
+        self.manifest.update_from_info(job_path, job_info)
+        return job_info_filename
 
 
 def _obj_to_json_dict_helper(obj):
@@ -401,9 +995,121 @@ def _obj_to_json_dict_helper(obj):
             return True
         except (TypeError, OverflowError):
             return False
-    return {k: v if is_json_serializable(v) else str(v) for k,v in vars(obj).items()}
+    # nested models such as request_counts are kept as dicts, so they can be read back
+    items = {k: v.model_dump() if isinstance(v, openai.BaseModel) else v for k,v in vars(obj).items()}
+    return {k: v if is_json_serializable(v) else str(v) for k,v in items.items()}
     
 
+def _query_groupby_cols_helper(results_df):
+    # the queries of a row, counted by query_idx / query_total_count
+    return ['obs_idx', 'trial_id', 'subject_id', 'model', 'instruction'] + \
+        results_df.columns.intersection(['temperature', 'seed']).to_list()
+
+
+def _group_keys_helper(group_df):
+    # one json text per row, NaN (e.g. no seed) as null and numpy scalars as plain numbers, so keys match across passes
+    return pd.Series([json.dumps([None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value
+                                  for value in row])
+                      for row in group_df.itertuples(index=False)], index=group_df.index)
+
+
+def _token_limit_exceeded_helper(batch_obj):
+    errors = batch_obj.errors.data if batch_obj.errors is not None and batch_obj.errors.data else []
+    return any(error.code == 'token_limit_exceeded' for error in errors)
+
+
+def _exception_to_batch_error_helper(exception, custom_id):
+    # same layout as the lines of a batch error file
+    response = None
+    if isinstance(exception, openai.APIStatusError):
+        response = {"status_code": exception.status_code,
+                    "request_id": exception.request_id,
+                    "body": exception.body}
+    return {"id": None,
+            "custom_id": custom_id,
+            "response": response,
+            "error": {"code": getattr(exception, 'code', None) or type(exception).__name__,
+                      "message": str(exception)}}
+
+
+def _read_job_response_helper(job_response_filename):
+    # count lines first, so the columns can be preallocated and filled in a single streaming pass
+    with open(job_response_filename, "rb") as file:
+        n_lines = sum(chunk.count(b'\n') for chunk in iter(lambda: file.read(1024 ** 2), b'')) + 1
+
+    index = np.empty(n_lines, dtype=np.int64)
+    columns = {'batch_id': np.empty(n_lines, dtype=object),
+               'request_id': np.empty(n_lines, dtype=object),
+               'created_time': np.full(n_lines, np.nan),
+               'textual_response': np.empty(n_lines, dtype=object)}
+    columns.update({col: np.full(n_lines, np.nan) for col in RESPONSE_USAGE_COLUMNS})
+
+    n = 0
+    with open(job_response_filename, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            response = r.get('response') or {}
+            body = response.get('body') or {}
+            choices = body.get('choices')
+            usage = body.get('usage') or {}
+            usage_details = {**(usage.get('prompt_tokens_details') or {}), 
+                             **(usage.get('completion_tokens_details') or {}), 
+                             **usage}
+
+            index[n] = int(r['custom_id'].replace('request-', '')) - 1
+            columns['batch_id'][n] = r['id']
+            columns['request_id'][n] = response.get('request_id')
+            columns['created_time'][n] = body.get('created', np.nan)
+            columns['textual_response'][n] = choices[-1]['message']['content'] if choices else None
+            for col in RESPONSE_USAGE_COLUMNS:
+                columns[col][n] = usage_details.get(col) if usage_details.get(col) is not None else np.nan
+            n += 1
+
+    job_response_content_df = pd.DataFrame({col: values[:n] for col, values in columns.items()}, index=index[:n])
+    if job_response_content_df['created_time'].notna().all():
+        job_response_content_df['created_time'] = job_response_content_df['created_time'].astype(np.int64)
+    return job_response_content_df
+
+
+def _read_job_errors_helper(job_error_filename):
+    # one failure per line of a batch error file, with the error of the line or else of the response body
+    failures = []
+    if not os.path.exists(job_error_filename):
+        return failures
+    with open(job_error_filename, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            response = r.get('response') or {}
+            body = response.get('body') if isinstance(response.get('body'), dict) else {}
+            error = r.get('error') or body.get('error') or body
+            failures.append({'custom_id': r['custom_id'],
+                             'status_code': response.get('status_code'),
+                             'code': error.get('code') or error.get('type'),
+                             'message': error.get('message')})
+    return failures
+
+
+def _read_custom_ids_helper(jsonl_filename, repair=True):
+    if not os.path.exists(jsonl_filename):
+        return set()
+    custom_ids = set()
+    with open(jsonl_filename, "rb+" if repair else "rb") as file:
+        offset = 0
+        for line in file:
+            # a line without newline is a write torn by a crash, drop it so appending starts on a clean line
+            if not line.endswith(b'\n'):
+                if repair:
+                    file.truncate(offset)
+                break
+            offset += len(line)
+            custom_ids.add(json.loads(line)['custom_id'])
+    return custom_ids
+
+
 def make_file_read_only(file_path):
     path = Path(file_path)
     if not path.exists():
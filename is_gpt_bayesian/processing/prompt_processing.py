@@ -1,3 +1,108 @@
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# Prompt fragments are compiled once at import. Only the fields listed in *_PROMPT_FIELDS
+# enter a prompt, so prompt_keys hashes each distinct combination of them a single time and
+# prompt_table renders each distinct prompt a single time.
+
+EG_PROMPT_FIELDS = ['pay', 'nballs', 'ndraws_from_cage', 'cage_A_balls_marked_N', 'cage_B_balls_marked_N',
+                    'nballs_prior_cage', 'priors', 'ndraws', 'instruction']
+
+EG_INTRODUCTIONS = {
+    1: "You are participating in a decision-making experiment, where you can earn money based on the number of correct decisions you make.",
+    0: "You are participating in a decision-making experiment.",
+}
+
+EG_EXPLANATION_TEMPLATE = \
+"""
+
+There are two identical bingo cages, Cage A and Cage B, each containing {nballs} balls. Cage A contains {cage_A_balls_marked_N} balls labeled "N" and {cage_A_balls_marked_G} balls labeled "G", while Cage B contains {cage_B_balls_marked_N} balls labeled "N" and {cage_B_balls_marked_G} balls labeled "G".
+
+A {nballs_prior_cage}-sided die is used to determine which of the two cages will be used to generate draws. If a random roll of the die shows 1 through {priors}, I will use Cage A; if it shows {priors_plus_one} through {nballs_prior_cage}, I will use Cage B. You will not know the outcome of the roll of the die or which cage I use.
+
+Once a cage is chosen at random based on the roll of the die, it is used to generate draws with replacement.
+
+I have drawn a total of {ndraws_from_cage} balls with replacement. The result is {ndraws} "N" balls and {ndraws_G} "G" balls.
+After observing this outcome, which cage do you think generated the observations? Your decision is correct if the balls were drawn from that cage.
+"""
+
+EG_INSTRUCTIONS = {
+    'reasoning': \
+"""
+YOU ARE WELCOME TO ALSO DESCRIBE YOUR REASONING, BROKEN INTO SEPARATE STEPS, TO EXPLAIN HOW YOU ARRIVED AT YOUR FINAL ANSWER. 
+Please state your answer in the following format at the end.
+"Final answer: Cage A." or "Final answer: Cage B.".
+""",
+    'no reasoning': \
+"""
+PLEASE JUST REPORT YOU FINAL ANSWER AND DO NOT PROVIDE ANY REASONING AS TO HOW YOU ARRIVED AT YOUR FINAL ANSWER. 
+Please state your answer in the following format.
+"Final answer: Cage A." or "Final answer: Cage B.".
+""",
+}
+
+HS_PROMPT_FIELDS = ['Prior Pr(A)', 'ndraws_from_cage', 'outcome', 'outcome_expand', 'instruction']
+
+HS_INTRODUCTION = "This is an experiment in the economics of decision making. Various agencies have provided funds for the experiment. Your earnings will depend partly on your decisions and partly on chance. If you are careful and make good decisions, you may earn a considerable amount of money, which will be paid to you, privately, in cash, at the end of the experiment. In addition to the money that you earn during the experiment, you will also receive $6. This payment is to compensate you for showing up today."
+
+HS_PRIOR_A_THRESHOLDS = {
+    "1/2": 3,
+    "2/3": 4,
+}
+
+HS_EXPLANATION_TEMPLATE = \
+"""
+
+This experiment involves two stages. In stage 1 we will show you some information including the result of a drawing of {num_draws_str}{with_replacement_str} from one of two possible cages, each containing different numbers of light and dark balls. Then at the start of stage 2 you will report a number P between 0 and 1. After your report, we will draw a random number U that is equally likely to be any number between 0 and 1. Your payoff from this experiment will either be $1000 or $0 depending on your report P and the random number U.
+
+Let's describe the two stages in more detail now. In stage 1 we will show you {num_draws_str} that are drawn at random{with_replacement_str} from one of two possible urns labelled A and B.
+
+Urn A contains 2 light balls and 1 dark ball.
+Urn B contains 1 light ball and 2 dark balls. 
+
+We select the urn, A or B, from which we draw the sample of {num_draws_str} by the outcome of throwing a 6 sided die.
+We do not show you the outcome of this throw of the die but we do tell you the rule we use to select urn A or B.
+
+If the outcome of the die throw is 1 to {prior_A_threshold} we select urn A.
+If the outcome of the die throw is {prior_A_threshold_plus_one} to 6, we use urn B to draw the random sample of {num_draws_str}{with_replacement_str}.
+
+Once you see the outcome of the sample of {num_draws_str}, stage 1 is over and stage 2 begins.
+
+At the start of stage 2 we ask you to report a number P between 0 and 1. Your payoff from this experiment depend on another random number, which we call U, which we draw after you report the number P. We draw the random number U in a way that every possible number between 0 and 1 has an equal chance of being selected.
+
+Here is how you will be paid from participating in this experiment. There are two possible cases:
+
+Case 1. If the number U is less than or equal to P then you will receive $1000 if the sample of {num_draws_str} we showed you in stage 1 was from urn A and $0 otherwise.
+Case 2. If the number U is between the number P you report and 1, you will receive $1000 with probability equal to the realized value of U, but with probability 1-U you will get $0.
+
+OK, this is the setup. Let's now start begin this experiment, starting with stage 1.
+
+We have tossed the die (the outcome we don't show to you) and selected one of these urns according to the rule given above (i.e. urn A if the die throw was 1 to {prior_A_threshold}, and urn B otherwise). We have drawn {num_draws_str}{with_replacement_str} from the selected urn and the outcome is {outcome_list}, i.e., {outcome_expand}.
+
+Now, we are at stage 2 where we are asking you, given the information from stage 1 to report a number P between 0 and 1 that in conjunction with the random number U will determine if you get either $1000 or $0 according to the rule given in cases 1 and 2 above.
+
+Please report a number P between 0 and 1 that maximizes your probability of winning $1000 in this experiment.
+"""
+
+HS_INSTRUCTIONS = {
+    'reasoning': \
+"""
+YOU ARE WELCOME TO ALSO DESCRIBE YOUR REASONING, BROKEN INTO SEPARATE STEPS, TO EXPLAIN HOW YOU ARRIVED AT YOUR FINAL ANSWER P. 
+Please state your answer in the following format at the end.
+Final answer: [your P value here].
+""",
+    'no reasoning': \
+"""
+PLEASE JUST REPORT P AND DO NOT PROVIDE ANY REASONING AS TO HOW YOU ARRIVED AT THE VALUE P. 
+Please state your answer in the following format.
+Final answer: [your P value here].
+""",
+}
+
+
 def prompt_eg(row):
     """
     nballs:
@@ -24,43 +129,26 @@ def prompt_eg(row):
     """
 
     # Introduction
-    if row['pay'] == 1:
-        introduction = "You are participating in a decision-making experiment, where you can earn money based on the number of correct decisions you make."
-    elif row['pay'] == 0:
-        introduction = "You are participating in a decision-making experiment."
-    else:
+    introduction = EG_INTRODUCTIONS.get(row['pay'])
+    if introduction is None:
         raise ValueError('Invalid pay value.')
         
     # Explanation
-    explanation = \
-f"""
-
-There are two identical bingo cages, Cage A and Cage B, each containing {row['nballs']} balls. Cage A contains {row['cage_A_balls_marked_N']} balls labeled "N" and {row['nballs'] - row['cage_A_balls_marked_N']} balls labeled "G", while Cage B contains {row['cage_B_balls_marked_N']} balls labeled "N" and {row['nballs'] - row['cage_B_balls_marked_N']} balls labeled "G".
-
-A {row['nballs_prior_cage']}-sided die is used to determine which of the two cages will be used to generate draws. If a random roll of the die shows 1 through {row['priors']}, I will use Cage A; if it shows {row['priors'] + 1} through {row['nballs_prior_cage']}, I will use Cage B. You will not know the outcome of the roll of the die or which cage I use.
-
-Once a cage is chosen at random based on the roll of the die, it is used to generate draws with replacement.
-
-I have drawn a total of {row['ndraws_from_cage']} balls with replacement. The result is {row['ndraws']} "N" balls and {row['ndraws_from_cage'] - row['ndraws']} "G" balls.
-After observing this outcome, which cage do you think generated the observations? Your decision is correct if the balls were drawn from that cage.
-"""
+    explanation = EG_EXPLANATION_TEMPLATE.format(nballs=row['nballs'],
+                                                 cage_A_balls_marked_N=row['cage_A_balls_marked_N'],
+                                                 cage_A_balls_marked_G=row['nballs'] - row['cage_A_balls_marked_N'],
+                                                 cage_B_balls_marked_N=row['cage_B_balls_marked_N'],
+                                                 cage_B_balls_marked_G=row['nballs'] - row['cage_B_balls_marked_N'],
+                                                 nballs_prior_cage=row['nballs_prior_cage'],
+                                                 priors=row['priors'],
+                                                 priors_plus_one=row['priors'] + 1,
+                                                 ndraws_from_cage=row['ndraws_from_cage'],
+                                                 ndraws=row['ndraws'],
+                                                 ndraws_G=row['ndraws_from_cage'] - row['ndraws'])
 
     # Instructions
-    if row['instruction'] == 'reasoning':
-        instruction = \
-"""
-YOU ARE WELCOME TO ALSO DESCRIBE YOUR REASONING, BROKEN INTO SEPARATE STEPS, TO EXPLAIN HOW YOU ARRIVED AT YOUR FINAL ANSWER. 
-Please state your answer in the following format at the end.
-"Final answer: Cage A." or "Final answer: Cage B.".
-"""
-    elif row['instruction'] == 'no reasoning':
-        instruction = \
-"""
-PLEASE JUST REPORT YOU FINAL ANSWER AND DO NOT PROVIDE ANY REASONING AS TO HOW YOU ARRIVED AT YOUR FINAL ANSWER. 
-Please state your answer in the following format.
-"Final answer: Cage A." or "Final answer: Cage B.".
-""" 
-    else:
+    instruction = EG_INSTRUCTIONS.get(row['instruction'])
+    if instruction is None:
         raise ValueError('Invalid instruction value.')
 
     return introduction + explanation + instruction
@@ -78,15 +166,12 @@ def prompt_hs(row):
     """
 
     # Introduction
-    introduction = "This is an experiment in the economics of decision making. Various agencies have provided funds for the experiment. Your earnings will depend partly on your decisions and partly on chance. If you are careful and make good decisions, you may earn a considerable amount of money, which will be paid to you, privately, in cash, at the end of the experiment. In addition to the money that you earn during the experiment, you will also receive $6. This payment is to compensate you for showing up today."
+    introduction = HS_INTRODUCTION
 
     # Explanation
-    if row['Prior Pr(A)'] == "1/2":
-        prior_A_threshold = 3
-    elif row['Prior Pr(A)'] == "2/3":
-        prior_A_threshold = 4
-    else:
-        raise ValueError(f'Invalid prior value {row['prior']}')
+    prior_A_threshold = HS_PRIOR_A_THRESHOLDS.get(row['Prior Pr(A)'])
+    if prior_A_threshold is None:
+        raise ValueError(f"Invalid prior value {row['Prior Pr(A)']}")
     
     if row['ndraws_from_cage'] == 1:
         num_draws_str = f"1 ball"
@@ -95,55 +180,78 @@ def prompt_hs(row):
         num_draws_str = f"{row['ndraws_from_cage']} balls"
         with_replacement_str = " with replacement"
 
-    explanation = \
-f"""
+    explanation = HS_EXPLANATION_TEMPLATE.format(num_draws_str=num_draws_str,
+                                                 with_replacement_str=with_replacement_str,
+                                                 prior_A_threshold=prior_A_threshold,
+                                                 prior_A_threshold_plus_one=prior_A_threshold + 1,
+                                                 outcome_list=', '.join(list(row['outcome'])),
+                                                 outcome_expand=row['outcome_expand'])
+    
+    # Instructions
+    instruction = HS_INSTRUCTIONS.get(row['instruction'])
+    if instruction is None:
+        raise ValueError('Invalid instruction value.')
 
-This experiment involves two stages. In stage 1 we will show you some information including the result of a drawing of {num_draws_str}{with_replacement_str} from one of two possible cages, each containing different numbers of light and dark balls. Then at the start of stage 2 you will report a number P between 0 and 1. After your report, we will draw a random number U that is equally likely to be any number between 0 and 1. Your payoff from this experiment will either be $1000 or $0 depending on your report P and the random number U.
+    return introduction + explanation + instruction
 
-Let's describe the two stages in more detail now. In stage 1 we will show you {num_draws_str} that are drawn at random{with_replacement_str} from one of two possible urns labelled A and B.
 
-Urn A contains 2 light balls and 1 dark ball.
-Urn B contains 1 light ball and 2 dark balls. 
+PROMPT_FIELDS = {prompt_eg: EG_PROMPT_FIELDS,
+                 prompt_hs: HS_PROMPT_FIELDS}
 
-We select the urn, A or B, from which we draw the sample of {num_draws_str} by the outcome of throwing a 6 sided die.
-We do not show you the outcome of this throw of the die but we do tell you the rule we use to select urn A or B.
+# prompt_template ids of the specs frames
+PROMPT_TEMPLATES = {prompt_fnc.__name__: prompt_fnc for prompt_fnc in PROMPT_FIELDS}
 
-If the outcome of the die throw is 1 to {prior_A_threshold} we select urn A.
-If the outcome of the die throw is {prior_A_threshold+1} to 6, we use urn B to draw the random sample of {num_draws_str}{with_replacement_str}.
 
-Once you see the outcome of the sample of {num_draws_str}, stage 1 is over and stage 2 begins.
+def prompt_keys(data_df, prompt_fnc) -> pd.Series:
+    """
+    Key of the prompt of each row, a hash of the template and the prompt fields, so the same
+    prompt has the same key in every run and nothing is rendered.
+    """
+    fields = PROMPT_FIELDS.get(prompt_fnc)
+    if fields is None:
+        raise ValueError(f'Invalid prompt_fnc {prompt_fnc.__name__}, must be one of {list(PROMPT_TEMPLATES)}.')
+    if len(data_df) == 0:
+        return pd.Series(index=data_df.index, dtype=np.int64)
 
-At the start of stage 2 we ask you to report a number P between 0 and 1. Your payoff from this experiment depend on another random number, which we call U, which we draw after you report the number P. We draw the random number U in a way that every possible number between 0 and 1 has an equal chance of being selected.
+    codes, first_positions = _distinct_rows_helper(data_df, fields)
+    keys = np.array([_prompt_key_helper(prompt_fnc.__name__, row) for row in data_df[fields].iloc[first_positions].itertuples(index=False)],
+                    dtype=np.int64)
 
-Here is how you will be paid from participating in this experiment. There are two possible cases:
+    return pd.Series(keys[codes], index=data_df.index)
 
-Case 1. If the number U is less than or equal to P then you will receive $1000 if the sample of {num_draws_str} we showed you in stage 1 was from urn A and $0 otherwise.
-Case 2. If the number U is between the number P you report and 1, you will receive $1000 with probability equal to the realized value of U, but with probability 1-U you will get $0.
 
-OK, this is the setup. Let's now start begin this experiment, starting with stage 1.
+def prompt_table(specs_df) -> pd.DataFrame:
+    """
+    One row per distinct prompt of the specs (prompt_template, prompt_key, prompt), rendered from
+    the prompt fields of the first row with that key.
+    """
+    first_rows_df = specs_df.drop_duplicates(['prompt_key'])
+    prompts = [PROMPT_TEMPLATES[template](row) for template, (_, row) in zip(first_rows_df['prompt_template'], first_rows_df.iterrows())]
+    return pd.DataFrame({'prompt_template': first_rows_df['prompt_template'].astype(object).to_numpy(),
+                         'prompt_key': first_rows_df['prompt_key'].to_numpy(),
+                         'prompt': prompts})
 
-We have tossed the die (the outcome we don't show to you) and selected one of these urns according to the rule given above (i.e. urn A if the die throw was 1 to {prior_A_threshold}, and urn B otherwise). We have drawn {num_draws_str}{with_replacement_str} from the selected urn and the outcome is {', '.join(list(row['outcome']))}, i.e., {row['outcome_expand']}.
 
-Now, we are at stage 2 where we are asking you, given the information from stage 1 to report a number P between 0 and 1 that in conjunction with the random number U will determine if you get either $1000 or $0 according to the rule given in cases 1 and 2 above.
+def materialize_prompts(specs_df, prompt_table_df=None) -> pd.Series:
+    """
+    Prompt text of each specs row, from prompt_table_df if given. Specs written before prompt
+    keys existed carry the text itself.
+    """
+    if 'prompt' in specs_df.columns:
+        return specs_df['prompt']
+    if prompt_table_df is None:
+        prompt_table_df = prompt_table(specs_df)
+    return specs_df['prompt_key'].map(prompt_table_df.set_index('prompt_key')['prompt'])
 
-Please report a number P between 0 and 1 that maximizes your probability of winning $1000 in this experiment.
-"""
-    
-    # Instructions
-    if row['instruction'] == "reasoning":
-        instruction = \
-"""
-YOU ARE WELCOME TO ALSO DESCRIBE YOUR REASONING, BROKEN INTO SEPARATE STEPS, TO EXPLAIN HOW YOU ARRIVED AT YOUR FINAL ANSWER P. 
-Please state your answer in the following format at the end.
-Final answer: [your P value here].
-"""
 
-    elif row['instruction'] == "no reasoning":
-        instruction = \
-"""
-PLEASE JUST REPORT P AND DO NOT PROVIDE ANY REASONING AS TO HOW YOU ARRIVED AT THE VALUE P. 
-Please state your answer in the following format.
-Final answer: [your P value here].
-"""
-    return introduction + explanation + instruction
+def _distinct_rows_helper(data_df, fields):
+    # group code of each row and the position of the first row of each group
+    codes = data_df.groupby(fields, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    _, first_positions = np.unique(codes, return_index=True)
+    return codes, first_positions
+
 
+def _prompt_key_helper(template, values):
+    # json of plain values, numpy scalars and NaN hash the same as python numbers and None, 60 bits fit int64
+    values = [None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value for value in values]
+    return int(hashlib.md5(json.dumps([template, *values]).encode()).hexdigest()[:15], 16)
@@ -1,5 +1,9 @@
 import re
-from is_gpt_bayesian.utils import time_utils, path_utils
+import numpy as np
+import pandas as pd
+from scipy.special import xlogy, xlog1py
+from functools import partial
+from is_gpt_bayesian.utils import time_utils, path_utils, parallel_utils
 import unicodedata
 
 
@@ -93,6 +97,29 @@ def parse_single_char_fraction(ch: str) -> float | None:
         return None
     
 
+# every Unicode character named "VULGAR FRACTION ..." (U+00BC-U+00BE, U+2150-U+215F, U+2189)
+# that parse_single_char_fraction recognizes
+VULGAR_FRACTIONS = {chr(code_point): parse_single_char_fraction(chr(code_point))
+                    for code_point in [*range(0x00BC, 0x00BF), *range(0x2150, 0x2160), 0x2189]
+                    if parse_single_char_fraction(chr(code_point)) is not None}
+
+# the text after the last '\n', same as split('\n')[-1]
+LAST_LINE_PATTERN = re.compile(r'\A(?:.*\n)?(.*)\Z', re.DOTALL)
+FINAL_ANSWER_PATTERN = re.compile(r'final answer', re.IGNORECASE)
+# everything after the last "final answer", \A keeps the greedy prefix from being retried at every position
+AFTER_LAST_FINAL_ANSWER_PATTERN = re.compile(r'\A.*final answer(.*)', re.IGNORECASE | re.DOTALL)
+LATEX_FRACTION_PATTERN = re.compile(
+    r'\\d?frac\s*\{\s*([0-9]*\.?[0-9]+)\s*\}\s*\{\s*([0-9]*\.?[0-9]+)\s*\}',
+    re.IGNORECASE
+)
+FRACTION_PATTERN = re.compile(
+    r'([0-9]*\.?[0-9]+)\s*[/⁄]\s*([0-9]*\.?[0-9]+)'
+)
+DECIMAL_PATTERN = re.compile(r'\d+\.\d+')
+INTEGER_PATTERN = re.compile(r'\d+')
+VULGAR_FRACTION_PATTERN = re.compile('[' + ''.join(VULGAR_FRACTIONS) + ']')
+
+
 def response_hs(textual_response):
     """
     1) Find the LAST occurrence of "final answer" in the text (case-insensitive).
@@ -112,7 +139,7 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 1) Find the last occurrence of "final answer" (case-insensitive)
     # ---------------------------------------------------------
-    matches = list(re.finditer(r'final answer', textual_response, re.IGNORECASE))
+    matches = list(FINAL_ANSWER_PATTERN.finditer(textual_response))
     if not matches:
         return None  # No occurrence at all
 
@@ -134,11 +161,7 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 2a) LaTeX fraction: \dfrac{2}{3} or \frac{2.5}{3.5}
     # ---------------------------------------------------------
-    latex_fraction_pattern = re.compile(
-        r'\\d?frac\s*\{\s*([0-9]*\.?[0-9]+)\s*\}\s*\{\s*([0-9]*\.?[0-9]+)\s*\}',
-        re.IGNORECASE
-    )
-    latex_fraction_match = latex_fraction_pattern.search(line_of_interest)
+    latex_fraction_match = LATEX_FRACTION_PATTERN.search(line_of_interest)
     if latex_fraction_match:
         numerator_str, denominator_str = latex_fraction_match.groups()
         try:
@@ -151,10 +174,7 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 2b) Plain fraction with optional decimals, using '/' or '⁄'
     # ---------------------------------------------------------
-    fraction_pattern = re.compile(
-        r'([0-9]*\.?[0-9]+)\s*[/⁄]\s*([0-9]*\.?[0-9]+)'
-    )
-    fraction_match = fraction_pattern.search(line_of_interest)
+    fraction_match = FRACTION_PATTERN.search(line_of_interest)
     if fraction_match:
         numerator_str, denominator_str = fraction_match.groups()
         try:
@@ -167,7 +187,7 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 2c) Decimal
     # ---------------------------------------------------------
-    decimal_match = re.search(r'\d+\.\d+', line_of_interest)
+    decimal_match = DECIMAL_PATTERN.search(line_of_interest)
     if decimal_match:
         try:
             return float(decimal_match.group(0))
@@ -177,7 +197,7 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 2d) Integer
     # ---------------------------------------------------------
-    int_match = re.search(r'\d+', line_of_interest)
+    int_match = INTEGER_PATTERN.search(line_of_interest)
     if int_match:
         try:
             return float(int_match.group(0))
@@ -187,15 +207,11 @@ def response_hs(textual_response):
     # ---------------------------------------------------------
     # 2e) Single-character fraction (vulgar fractions)
     # ---------------------------------------------------------
-    # We look for any single non-whitespace character, and test if it's a fraction.
-    # E.g. "½", "⅓", "⅔", etc. We'll scan all single chars in the substring.
-    # If we find a recognized fraction, we return it.
+    # The first character that is a recognized fraction, e.g. "½", "⅓", "⅔", etc.
+    # (see VULGAR_FRACTIONS, precomputed with parse_single_char_fraction).
     for ch in line_of_interest:
-        if ch.isspace():
-            continue
-        fraction_value = parse_single_char_fraction(ch)
-        if fraction_value is not None:
-            return fraction_value
+        if ch in VULGAR_FRACTIONS:
+            return VULGAR_FRACTIONS[ch]
 
     # ---------------------------------------------------------
     # If none matched, return None
@@ -203,10 +219,92 @@ def response_hs(textual_response):
     return None
 
 
-def process_eg_result_df(results_df, response_processing_fnc, run_name, ungroup_by):
+def response_eg_batch(textual_responses) -> pd.Series:
+    """
+    Series version of response_eg, same results. Last lines repeat a lot ("Cage A", ...),
+    so they are classified once per distinct line.
+    """
+    # positional index, rows queried more than once repeat their label in the run results
+    # non-str responses come out of str methods as NaN
+    last_lines = pd.Series(textual_responses.to_numpy(dtype=object)).str.extract(LAST_LINE_PATTERN, expand=False).dropna()
+
+    unique_lines = pd.Series(pd.unique(last_lines), dtype=object)
+    processed_lines = unique_lines.str.replace(' ', '', regex=False).str.lower()
+    has_A = processed_lines.str.contains(answer_A, regex=False)
+    has_B = processed_lines.str.contains(answer_B, regex=False)
+    has_equal = processed_lines.str.contains('equal', regex=False) | processed_lines.str.contains('indifferent', regex=False)
+    line_results = np.select([has_A & has_B, has_A, has_B, has_equal], [None, '1', '0', '0.5'], default=None)
+
+    results = np.full(len(textual_responses), None, dtype=object)
+    results[last_lines.index.to_numpy()] = line_results[pd.Index(unique_lines).get_indexer(last_lines)]
+    return pd.Series(results, index=textual_responses.index, dtype=object)
+
+
+def response_hs_batch(textual_responses) -> pd.Series:
+    """
+    Series version of response_hs, same results. Each tier of response_hs is one vectorized
+    str.extract over the responses that no earlier tier matched.
+    """
+    # positional index, rows queried more than once repeat their label in the run results
+    # nothing after the last "final answer" leaves only the phrase itself to parse, which holds no number
+    substrings = pd.Series(textual_responses.to_numpy(dtype=object)).str.extract(AFTER_LAST_FINAL_ANSWER_PATTERN, expand=False).str.strip()
+    substrings = substrings[substrings.notna() & (substrings != '')]
+
+    results = np.full(len(textual_responses), np.nan)
+    for pattern in [LATEX_FRACTION_PATTERN, FRACTION_PATTERN, DECIMAL_PATTERN, INTEGER_PATTERN]:
+        if substrings.empty:
+            break
+        if pattern.groups:
+            groups = substrings.str.extract(pattern)
+            matched = groups[0].notna()
+            numerators = groups.loc[matched, 0].map(_to_float_helper)
+            denominators = groups.loc[matched, 1].map(_to_float_helper)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = (numerators / denominators).where(denominators != 0)
+        else:
+            values = substrings.str.extract(f'({pattern.pattern})', expand=False)
+            matched = values.notna()
+            values = values[matched].map(_to_float_helper)
+        # the first tier that matches decides, even when its value is unusable
+        results[values.index.to_numpy()] = values.to_numpy(dtype=float)
+        substrings = substrings[~matched]
+
+    vulgar_fractions = substrings.str.extract(f'({VULGAR_FRACTION_PATTERN.pattern})', expand=False).dropna()
+    results[vulgar_fractions.index.to_numpy()] = vulgar_fractions.map(VULGAR_FRACTIONS).to_numpy(dtype=float)
+
+    return pd.Series(results, index=textual_responses.index, dtype=float)
+
+
+def _to_float_helper(number_str) -> float:
+    try:
+        return float(number_str)
+    except ValueError:
+        return np.nan
+
+
+BATCH_RESPONSE_FNCS = {response_eg: response_eg_batch,
+                       response_hs: response_hs_batch}
+
+
+def parse_responses(textual_responses, response_processing_fnc, n_jobs=1) -> pd.Series:
+    """
+    n_jobs:
+        > 1 (or None for all cores) parses chunks of the responses in that many processes.
+    """
+    if n_jobs != 1:
+        return parallel_utils.map_string_chunks(textual_responses,
+                                                partial(parse_responses, response_processing_fnc=response_processing_fnc),
+                                                n_jobs=n_jobs)
+    # whole column at once when there is a batch version of the parser
+    if response_processing_fnc in BATCH_RESPONSE_FNCS:
+        return BATCH_RESPONSE_FNCS[response_processing_fnc](textual_responses)
+    return textual_responses.apply(response_processing_fnc)
+
+
+def process_eg_result_df(results_df, response_processing_fnc, run_name, ungroup_by, n_jobs=1):
     # stacked
     results_df_stacked = results_df.copy()
-    results_df_stacked['processed_response'] = results_df_stacked['textual_response'].apply(response_processing_fnc)
+    results_df_stacked['processed_response'] = parse_responses(results_df_stacked['textual_response'], response_processing_fnc, n_jobs=n_jobs)
     try:
         if results_df_stacked['processed_response'] == results_df_stacked['processed_response'].astype(int).astype(float):
             results_df_stacked['processed_response'] = results_df_stacked['processed_response'].astype(int)
@@ -214,20 +312,21 @@ def process_eg_result_df(results_df, response_processing_fnc, run_name, ungroup_
         results_df_stacked['processed_response'] = results_df_stacked['processed_response'].astype(float)
 
     # adding output columns
-    results_df_stacked['posterior_prob'] = results_df_stacked.apply(eg_posterior_probability, axis=1)
+    results_df_stacked['posterior_prob'] = eg_posterior_probabilities(results_df_stacked)
     
     # unstacked
     results_df_last_query = results_df_stacked[results_df_stacked['query_idx'] == results_df_stacked['query_total_count']]
     
     columns_name_list = ['subject_id', 'subject_uuid', 'temperature']
     values_name_list = ['processed_response']
-    del_name_list = ['obs_idx', 'batch_id', 'prompt', 'request_id', 'textual_response', 'created_time', 'query_idx', 'query_total_count']       
+    del_name_list = ['obs_idx', 'batch_id', 'prompt', 'prompt_template', 'prompt_key', 'request_id', 'textual_response', 'created_time', 'query_idx', 'query_total_count',
+                     'prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'reasoning_tokens']
 
     if ungroup_by:
 
         unstacked_ungrouped_results_df_dict = {}
 
-        for group_name, group_results_df in results_df_last_query.groupby(ungroup_by):
+        for group_name, group_results_df in results_df_last_query.groupby(ungroup_by, observed=True):
             results_df_unstacked_ungrouped_filename = path_utils.run_final_unstacked_ungrouped_file_path(run_name, '__'.join(group_name))
             results_df_unstacked_ungrouped_mat_filename = path_utils.run_final_unstacked_ungrouped_mat_file_path(run_name, '__'.join(group_name))
             results_df_unstacked_ungrouped_subject_filename = path_utils.run_final_unstacked_ungrouped_subject_file_path(run_name, '__'.join(group_name))
@@ -235,7 +334,7 @@ def process_eg_result_df(results_df, response_processing_fnc, run_name, ungroup_
             results_df_unstacked = group_results_df.pivot(
                 index=[col for col in group_results_df.columns if col not in columns_name_list + values_name_list + del_name_list],
                 columns=columns_name_list, 
-                values=values_name_list)
+                values=values_name_list).sort_index() # categorical keys come out of pivot in order of appearance
             # mat value
             results_df_unstacked_mat = results_df_unstacked.copy()
             results_df_unstacked_mat.columns = results_df_unstacked_mat.columns.get_level_values('subject_id').rename(None)
@@ -254,17 +353,17 @@ def process_eg_result_df(results_df, response_processing_fnc, run_name, ungroup_
         results_df_unstacked = results_df_last_query.pivot(
             index=[col for col in results_df_last_query.columns if col not in columns_name_list + values_name_list + del_name_list],
             columns=columns_name_list, 
-            values=values_name_list)
+            values=values_name_list).sort_index()
         
         return ({path_utils.run_final_stacked_file_path(run_name): results_df_stacked}, 
                 {path_utils.run_final_unstacked_file_path(run_name): results_df_unstacked}
                 )
     
 
-def process_hs_result_df(results_df, response_processing_fnc, run_name, ungroup_by):
+def process_hs_result_df(results_df, response_processing_fnc, run_name, ungroup_by, n_jobs=1):
     # stacked
     results_df_stacked = results_df.copy()
-    results_df_stacked['processed_response'] = results_df_stacked['textual_response'].apply(response_processing_fnc)
+    results_df_stacked['processed_response'] = parse_responses(results_df_stacked['textual_response'], response_processing_fnc, n_jobs=n_jobs)
     try:
         if results_df_stacked['processed_response'] == results_df_stacked['processed_response'].astype(int).astype(float):
             results_df_stacked['processed_response'] = results_df_stacked['processed_response'].astype(int)
@@ -272,7 +371,7 @@ def process_hs_result_df(results_df, response_processing_fnc, run_name, ungroup_
         results_df_stacked['processed_response'] = results_df_stacked['processed_response'].astype(float)
 
     # adding output columns
-    results_df_stacked['posterior_prob'] = results_df_stacked.apply(hs_posterior_probability, axis=1)
+    results_df_stacked['posterior_prob'] = hs_posterior_probabilities(results_df_stacked)
 
     # processed
     results_df_stacked_processed = results_df_stacked[results_df_stacked['query_idx'] == results_df_stacked['query_total_count']]
@@ -311,4 +410,38 @@ def hs_posterior_probability(row):
                (B_light_prob ** row['L_draws_from_cage']) * \
                ((1-B_light_prob) ** row['D_draws_from_cage']) * (1-prior)
     
-    return likelihood * prior / marginal
\ No newline at end of file
+    return likelihood * prior / marginal
+
+
+def two_urn_posterior_probability(prior_A, p_A, p_B, n_marked, n_unmarked):
+    """
+    Posterior probability of urn A after drawing, with replacement, n_marked marked balls and
+    n_unmarked other balls, where p_A / p_B are the shares of marked balls in urn A / urn B.
+
+    Takes scalars or arrays and works in log space, so long draw sequences do not underflow.
+    """
+    prior_A, p_A, p_B, n_marked, n_unmarked = (np.asarray(x, dtype=float) for x in (prior_A, p_A, p_B, n_marked, n_unmarked))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # xlogy / xlog1py keep 0 * log(0) == 0, matching 0 ** 0 == 1 in the likelihoods
+        log_A = np.log(prior_A) + xlogy(n_marked, p_A) + xlog1py(n_unmarked, -p_A)
+        log_B = np.log1p(-prior_A) + xlogy(n_marked, p_B) + xlog1py(n_unmarked, -p_B)
+        return np.exp(log_A - np.logaddexp(log_A, log_B))
+
+
+def eg_posterior_probabilities(results_df):
+    posterior = two_urn_posterior_probability(prior_A=results_df['priors'] / results_df['nballs_prior_cage'],
+                                              p_A=results_df['cage_A_balls_marked_N'] / results_df['nballs'],
+                                              p_B=results_df['cage_B_balls_marked_N'] / results_df['nballs'],
+                                              n_marked=results_df['ndraws'],
+                                              n_unmarked=results_df['ndraws_from_cage'] - results_df['ndraws'])
+    return pd.Series(posterior, index=results_df.index)
+
+
+def hs_posterior_probabilities(results_df):
+    posterior = two_urn_posterior_probability(prior_A=results_df['Prior Pr(A)'].map({'1/2': 1 / 2, '2/3': 2 / 3}),
+                                              p_A=2 / 3,
+                                              p_B=1 / 3,
+                                              n_marked=results_df['L_draws_from_cage'],
+                                              n_unmarked=results_df['D_draws_from_cage'])
+    return pd.Series(posterior, index=results_df.index)
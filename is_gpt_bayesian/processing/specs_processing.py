@@ -1,8 +1,10 @@
+import os
 import pandas as pd
 import numpy as np
 import hashlib
+import importlib.util
 from scipy.io import loadmat
-from is_gpt_bayesian.utils import time_utils, path_utils
+from is_gpt_bayesian.utils import time_utils, path_utils, schema_utils
 from is_gpt_bayesian.processing import prompt_processing
 
 def md5_hash(s) -> int:
@@ -13,57 +15,47 @@ def random_uniform_on_grid(seed, grid) -> float:
     return rng.choice(grid)
 
 
+EG_DATA_COLUMNS = ['obs_idx', 'name', 'state', 'trial_id', 'subject_id', 'nsubjects', 'ntrials', 'pay', 'nballs', 
+                   'ndraws_from_cage', 'cage_A_balls_marked_N', 'cage_B_balls_marked_N', 'nballs_prior_cage', 
+                   'priors', 'ndraws']
+
+HS_SHEET_NAMES = ['Part 1 Holt and Smith', 
+                  'Part 2 Holt and Smith', 
+                  'Part 3 Holt and Smith', 
+                  'Part 4 Holt and Smith']
+
+
 def get_california_data() -> pd.DataFrame:
 
-    data_eg_path = path_utils.data_eg_path
+    specs_df = _load_design_cache(path_utils.data_eg_path, _parse_eg_designs)
+    specs_df = specs_df[specs_df['state'] == 'california'].reset_index(drop=True)
+    specs_df['subject_id'] = specs_df['name'] + ' - Subject ' + specs_df['subject_num'].astype(str)
 
-    data = loadmat(data_eg_path)
-    data = data['datastruct'][0]
+    return _finalize_eg_data_helper(specs_df)
 
-    specs_list = []
 
-    for design in data:
-        if design['state'][0] != 'california':
-            continue
-        specs_dict = {}
-        specs_dict['name'] = design['name'][0]
-        specs_dict['priors'] = design['priors'].squeeze()
-        specs_dict['ndraws'] = design['ndraws'].squeeze()
-        specs_dict['nsubjects'] = design['subjectchoices'].shape[0]
-        specs_dict['ntrials'] = design['subjectchoices'].shape[1]
-        specs_dict['pay'] = design['pay'][0][0]
-        specs_dict['nballs'] = design['nballs'][0][0]
-        specs_dict['ndraws_from_cage'] = design['ndraws_from_cage'][0][0]
-        specs_dict['cage_A_balls_marked_N'] = design['cage_A_balls_marked_N'][0][0]
-        specs_dict['cage_B_balls_marked_N'] = design['cage_B_balls_marked_N'][0][0]
-        specs_dict['nballs_prior_cage'] = design['nballs_prior_cage'][0][0]
-        specs_dict['state'] = design['state'][0]
+def get_wisconsin_data() -> pd.DataFrame:
 
-        design_df = pd.DataFrame.from_dict(specs_dict)
-        design_df['trial_id'] = np.arange(1, specs_dict['ntrials'] + 1)
-        design_df['trial_id'] = design_df['name'] + ' - Trial ' + design_df['trial_id'].astype(str)
-        design_df = pd.concat([design_df] * specs_dict['nsubjects'], ignore_index=True)
-        design_df['subject_id'] = np.repeat(np.arange(1, specs_dict['nsubjects'] + 1), repeats=specs_dict['ntrials'])
-        design_df['subject_id'] = design_df['name'] + ' - Subject ' + design_df['subject_id'].astype(str)
-        specs_list.append(design_df) 
+    specs_df = _load_design_cache(path_utils.data_eg_path, _parse_eg_designs)
+    specs_df = specs_df[specs_df['state'] == 'wisconsin'].reset_index(drop=True)
+    specs_df['subject_id'] = specs_df['name'].map({'DATA11': 'DATA11&12',
+                                                   'DATA12': 'DATA11&12',
+                                                   'DATA21': 'DATA21&22',
+                                                   'DATA22': 'DATA21&22'}) + ' - Subject ' + specs_df['subject_num'].astype(str)
 
-    specs_df = pd.concat(specs_list, ignore_index=True)
+    return _finalize_eg_data_helper(specs_df)
 
-    specs_df = pd.concat([pd.DataFrame({'obs_idx': range(len(specs_df))}),
-                          specs_df], axis=1)
-    
-    specs_df = specs_df[['obs_idx', 'name', 'state', 'trial_id', 'subject_id', 'nsubjects', 'ntrials', 'pay', 'nballs', 
-                        'ndraws_from_cage', 'cage_A_balls_marked_N', 'cage_B_balls_marked_N', 'nballs_prior_cage', 
-                        'priors', 'ndraws']]
-    
-    specs_df['subject_uuid'] = specs_df['subject_id'].apply(md5_hash)
+
+def get_hs_data() -> pd.DataFrame:
+
+    specs_df = _load_design_cache(path_utils.data_hs_path, _parse_hs_designs)
+    specs_df['subject_uuid'] = _subject_uuid_helper(specs_df['subject_id'])
     
     return specs_df
 
 
-def get_wisconsin_data() -> pd.DataFrame:
-
-    data_eg_path = path_utils.data_eg_path
+def _parse_eg_designs(data_eg_path) -> pd.DataFrame:
+    # all designs of both states, one row per subject x trial, state specific subject ids are added later
 
     data = loadmat(data_eg_path)
     data = data['datastruct'][0]
@@ -71,8 +63,6 @@ def get_wisconsin_data() -> pd.DataFrame:
     specs_list = []
 
     for design in data:
-        if design['state'][0] != 'wisconsin':
-            continue
         specs_dict = {}
         specs_dict['name'] = design['name'][0]
         specs_dict['priors'] = design['priors'].squeeze()
@@ -91,32 +81,15 @@ def get_wisconsin_data() -> pd.DataFrame:
         design_df['trial_id'] = np.arange(1, specs_dict['ntrials'] + 1)
         design_df['trial_id'] = design_df['name'] + ' - Trial ' + design_df['trial_id'].astype(str)
         design_df = pd.concat([design_df] * specs_dict['nsubjects'], ignore_index=True)
-        design_df['subject_id'] = np.repeat(np.arange(1, specs_dict['nsubjects'] + 1), repeats=specs_dict['ntrials'])
-        design_df['subject_id'] = design_df['name'].map({'DATA11': 'DATA11&12',
-                                                         'DATA12': 'DATA11&12',
-                                                         'DATA21': 'DATA21&22',
-                                                         'DATA22': 'DATA21&22'}) + ' - Subject ' + design_df['subject_id'].astype(str)
+        design_df['subject_num'] = np.repeat(np.arange(1, specs_dict['nsubjects'] + 1), repeats=specs_dict['ntrials'])
         specs_list.append(design_df) 
 
-    specs_df = pd.concat(specs_list, ignore_index=True)
+    return pd.concat(specs_list, ignore_index=True)
 
-    specs_df = pd.concat([pd.DataFrame({'obs_idx': range(len(specs_df))}),
-                          specs_df], axis=1)
-    
-    specs_df = specs_df[['obs_idx', 'name', 'state', 'trial_id', 'subject_id', 'nsubjects', 'ntrials', 'pay', 'nballs', 
-                        'ndraws_from_cage', 'cage_A_balls_marked_N', 'cage_B_balls_marked_N', 'nballs_prior_cage', 
-                        'priors', 'ndraws']]
-    
-    specs_df['subject_uuid'] = specs_df['subject_id'].apply(md5_hash)
-    
-    return specs_df
 
+def _parse_hs_designs(holt_and_smith_data_path) -> pd.DataFrame:
 
-def get_hs_data() -> pd.DataFrame:
-
-    holt_and_smith_data_path = path_utils.data_hs_path
-    def _read_data_helper(holt_and_smith_data_path, sheet_name):
-        df = pd.read_excel(holt_and_smith_data_path, sheet_name=sheet_name)
+    def _read_data_helper(df, sheet_name):
         df = pd.melt(
                     df,
                     id_vars=df.columns[:2],
@@ -142,20 +115,53 @@ def get_hs_data() -> pd.DataFrame:
         
         return df
 
-    df1 = _read_data_helper(holt_and_smith_data_path, 'Part 1 Holt and Smith')
-    df2 = _read_data_helper(holt_and_smith_data_path, 'Part 2 Holt and Smith')
-    df3 = _read_data_helper(holt_and_smith_data_path, 'Part 3 Holt and Smith')
-    df4 = _read_data_helper(holt_and_smith_data_path, 'Part 4 Holt and Smith')
+    # all sheets in a single pass over the workbook
+    sheets = pd.read_excel(holt_and_smith_data_path, sheet_name=HS_SHEET_NAMES)
 
-    specs_df = pd.concat([df1, df2, df3, df4], ignore_index=True)
+    specs_df = pd.concat([_read_data_helper(sheets[sheet_name], sheet_name) for sheet_name in HS_SHEET_NAMES], ignore_index=True)
 
     specs_df = pd.concat([pd.DataFrame({'obs_idx': range(len(specs_df))}),
                           specs_df], axis=1)
     
     specs_df = specs_df[['obs_idx', 'sheet_name', 'trial_id', 'subject_id', 'Prior Pr(A)', 'prior', 'outcome', 'ndraws_from_cage', 'D_draws_from_cage', 'L_draws_from_cage', 'outcome_expand']]
 
-    specs_df['subject_uuid'] = specs_df['subject_id'].apply(md5_hash)
+    return specs_df
+
+
+def _finalize_eg_data_helper(specs_df) -> pd.DataFrame:
+
+    specs_df = pd.concat([pd.DataFrame({'obs_idx': range(len(specs_df))}),
+                          specs_df], axis=1)
     
+    specs_df = specs_df[EG_DATA_COLUMNS]
+    
+    specs_df['subject_uuid'] = _subject_uuid_helper(specs_df['subject_id'])
+    
+    return specs_df
+
+
+def _subject_uuid_helper(subject_ids) -> pd.Series:
+    # md5 once per distinct subject
+    return subject_ids.map({subject_id: md5_hash(subject_id) for subject_id in subject_ids.unique()})
+
+
+def _load_design_cache(source_path, parse_fnc) -> pd.DataFrame:
+    """
+    Parses a design source once and keeps a parquet snapshot of the result, keyed on the
+    hash of the source file, so later calls skip loadmat / read_excel. Without pyarrow
+    the source is parsed on every call.
+    """
+    with open(source_path, "rb") as file:
+        source_hash = hashlib.file_digest(file, 'sha256').hexdigest()[:16]
+    cache_filename = path_utils.design_cache_file_path(parse_fnc.__name__.strip('_'), source_hash)
+
+    if os.path.exists(cache_filename):
+        return pd.read_parquet(cache_filename)
+
+    specs_df = parse_fnc(source_path)
+    if importlib.util.find_spec('pyarrow') is not None:
+        path_utils.create_path(path_utils.design_cache_path)
+        specs_df.to_parquet(cache_filename, compression='zstd')
     return specs_df
 
 
@@ -183,10 +189,11 @@ def _get_specs_df(data_df,
         data_df = pd.merge(data_df,
                         pd.DataFrame(seeds, columns=['seed']),
                         how='cross')
-    # Add prompt column
-    data_df['prompt'] = data_df.apply(prompt_fnc, axis=1)
+    # Add prompt columns, the text is rendered from the prompt fields when the batch files are written
+    data_df['prompt_template'] = prompt_fnc.__name__
+    data_df['prompt_key'] = prompt_processing.prompt_keys(data_df, prompt_fnc)
 
-    return data_df
+    return schema_utils.apply_schema(data_df)
 
 
 def get_california_specs_df(temperature_lower_bound, temperature_upper_bound,
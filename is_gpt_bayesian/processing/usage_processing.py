@@ -0,0 +1,124 @@
+import logging
+import numpy as np
+import pandas as pd
+from is_gpt_bayesian.utils import token_utils
+from is_gpt_bayesian.processing import prompt_processing
+
+logger = logging.getLogger(__name__)
+
+
+# USD per 1M tokens: (input, cached input, output), dated versions are priced as their alias
+MODEL_PRICES = {'gpt-4o': (2.50, 1.25, 10.00),
+                'gpt-4o-mini': (0.15, 0.075, 0.60),
+                'gpt-4': (30.00, 30.00, 60.00),
+                'gpt-4-turbo': (10.00, 10.00, 30.00),
+                'gpt-3.5-turbo-0125': (0.50, 0.50, 1.50),
+                'o1': (15.00, 7.50, 60.00),
+                'o1-preview': (15.00, 7.50, 60.00),
+                'o1-mini': (3.00, 1.50, 12.00)}
+BATCH_DISCOUNT = 0.5
+
+USAGE_GROUP_COLUMNS = ['model', 'instruction']
+USAGE_TOKEN_COLUMNS = ['prompt_tokens', 'cached_tokens', 'completion_tokens', 'reasoning_tokens', 'total_tokens']
+
+
+def model_prices(model):
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    # e.g. gpt-4o-mini-2024-07-18, the longest alias wins over gpt-4o and gpt-4
+    aliases = [alias for alias in MODEL_PRICES if model.startswith(f'{alias}-')]
+    return MODEL_PRICES[max(aliases, key=len)] if aliases else None
+
+
+def usage_costs(usage_df, batch) -> pd.Series:
+    """
+    USD cost of each row of usage_df (model plus the token columns), batch rows at the batch discount.
+    Models without a price get NaN.
+    """
+    # plain strings, mapping a categorical model column would give a categorical of prices
+    models = usage_df['model'].astype(object)
+    unique_models = models.unique()
+    unknown_models = [model for model in unique_models if model_prices(model) is None]
+    if unknown_models:
+        logger.warning(f'No prices for models {unknown_models}, their cost is left empty.')
+    prices = {model: model_prices(model) or (np.nan, np.nan, np.nan) for model in unique_models}
+
+    input_price = models.map({model: price[0] for model, price in prices.items()})
+    cached_input_price = models.map({model: price[1] for model, price in prices.items()})
+    output_price = models.map({model: price[2] for model, price in prices.items()})
+
+    # completion tokens include the reasoning tokens
+    cached_tokens = usage_df['cached_tokens'].fillna(0)
+    cost = ((usage_df['prompt_tokens'] - cached_tokens) * input_price +
+            cached_tokens * cached_input_price +
+            usage_df['completion_tokens'] * output_price) / 1e6
+    return cost * np.where(batch, BATCH_DISCOUNT, 1)
+
+
+def usage_rollup(results_df, by=USAGE_GROUP_COLUMNS) -> pd.DataFrame:
+    """
+    Queries, responses, tokens and cost per group of the run results. Responses served from the
+    response cache keep the tokens of the run that paid for them, but cost nothing in this run and
+    are counted in n_cached_responses.
+    """
+    # results of jobs processed before usage was kept have no token columns
+    missing_columns = [col for col in USAGE_TOKEN_COLUMNS if col not in results_df.columns]
+    if missing_columns:
+        logger.warning(f'Run results have no {missing_columns} columns, their tokens and cost are left empty.')
+    usage_df = results_df.reindex(columns=list(dict.fromkeys(by + ['model'])) + USAGE_TOKEN_COLUMNS)
+    # float32 per row, run totals go past 2**24 and are summed in float64
+    usage_df[USAGE_TOKEN_COLUMNS] = usage_df[USAGE_TOKEN_COLUMNS].astype('float64')
+    usage_df['n_queries'] = 1
+    usage_df['n_responses'] = results_df['textual_response'].notna().astype(int)
+    # non-batch and cached responses are converted with a batch_id of their own prefix
+    batch_ids = results_df['batch_id'].astype(str)
+    cached = batch_ids.str.startswith('cached_')
+    usage_df['n_cached_responses'] = (cached & results_df['textual_response'].notna()).astype(int)
+    cost = usage_costs(usage_df, ~batch_ids.str.startswith('non_batch_'))
+    usage_df['cost_usd'] = cost.where(~cached, cost * 0) # unknown stays unknown
+
+    usage_rollup_df = usage_df.groupby(by, dropna=False, observed=True)[['n_queries', 'n_responses', 'n_cached_responses'] + USAGE_TOKEN_COLUMNS + ['cost_usd']] \
+                              .sum(min_count=1).reset_index()
+    return usage_rollup_df
+
+
+def estimate_usage(specs_df, completion_tokens=0, non_batch_models=(), by=USAGE_GROUP_COLUMNS) -> pd.DataFrame:
+    """
+    Pre-send estimate of tokens and cost per group of the run specs. Prompt tokens are counted with
+    the model tokenizer (tiktoken if installed), completion_tokens is the expected completion length,
+    a number or a dict by instruction, e.g. the means of a previous run's usage file.
+    """
+    # a run has few distinct prompts, each is rendered once and tokenized once per model
+    prompts = prompt_processing.materialize_prompts(specs_df)
+    distinct_prompts = pd.DataFrame({'model': specs_df['model'].astype(object), 'prompt': prompts}).drop_duplicates()
+    prompt_tokens = {(model, prompt): token_utils.count_prompt_tokens([{'role': 'user', 'content': prompt}], model)
+                     for model, prompt in distinct_prompts.itertuples(index=False)}
+
+    usage_df = specs_df[list(dict.fromkeys(by + ['model']))].copy()
+    usage_df['n_queries'] = 1
+    usage_df['prompt_tokens'] = [prompt_tokens[key] for key in zip(specs_df['model'], prompts)]
+    usage_df['cached_tokens'] = 0
+    if isinstance(completion_tokens, dict):
+        usage_df['completion_tokens'] = specs_df['instruction'].astype(object).map(completion_tokens).fillna(0)
+    else:
+        usage_df['completion_tokens'] = completion_tokens
+    usage_df['reasoning_tokens'] = 0
+    usage_df['total_tokens'] = usage_df['prompt_tokens'] + usage_df['completion_tokens']
+    usage_df['cost_usd'] = usage_costs(usage_df, ~specs_df['model'].isin(non_batch_models))
+
+    usage_estimate_df = usage_df.groupby(by, dropna=False, observed=True)[['n_queries'] + USAGE_TOKEN_COLUMNS + ['cost_usd']] \
+                                .sum(min_count=1).reset_index()
+    return usage_estimate_df
+
+
+def estimate_batch_jobs(usage_estimate_df, max_requests, max_tokens=None, non_batch_models=()) -> pd.Series:
+    """
+    Batch jobs per model the estimated run is split into by generate_batch_files (not counting the size limit in bytes).
+    """
+    per_model_df = usage_estimate_df.groupby('model', observed=True)[['n_queries', 'prompt_tokens']].sum()
+    n_jobs = np.ceil(per_model_df['n_queries'] / max_requests)
+    if max_tokens is not None:
+        n_jobs = np.maximum(n_jobs, np.ceil(per_model_df['prompt_tokens'] / max_tokens))
+    # non-batch models are sent as a single job
+    n_jobs[n_jobs.index.isin(non_batch_models)] = 1
+    return n_jobs.astype(int).rename('batch_jobs')
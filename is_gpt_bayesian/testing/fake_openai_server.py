@@ -0,0 +1,480 @@
+import os
+import re
+import json
+import time
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import email.message
+import email.parser
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from is_gpt_bayesian.utils import rate_limit_utils, token_utils
+
+logger = logging.getLogger(__name__)
+
+
+# answers in the formats response_eg / response_hs parse
+EG_RESPONSE_TEMPLATES = [
+    "Cage A has the higher posterior probability given the draws.\nFinal answer: Cage A.",
+    "Cage B has the higher posterior probability given the draws.\nFinal answer: Cage B.",
+]
+HS_RESPONSE_TEMPLATES = [
+    "The posterior probability follows from Bayes' rule.\n\nFinal answer: \\dfrac{{2}}{{3}}",
+    "Final answer: 0.5",
+]
+
+BATCH_EXPIRED_ERROR = {"code": "batch_expired",
+                       "message": "This request could not be executed before the completion window expired."}
+TOKEN_LIMIT_EXCEEDED_ERROR = {"code": "token_limit_exceeded",
+                              "message": "Enqueued token limit reached. Please try again once some in_progress batches have been completed.",
+                              "param": None, "line": None}
+SERVER_ERROR_BODY = {"error": {"message": "The server had an error while processing your request.",
+                               "type": "server_error", "param": None, "code": None}}
+
+
+class FakeOpenAIServer():
+    """
+    Local stand-in for the Files, Batches and Chat Completions endpoints OpenAISession uses,
+    for load and regression tests without the live API. Point the client at base_url, e.g.
+    through the OPENAI_BASE_URL environment variable.
+
+    latency / latency_jitter:
+        seconds each chat completion takes, plus a uniform random extra up to the jitter.
+    requests_per_minute / tokens_per_minute:
+        chat completion limits, enforced with 429s and reported in the x-ratelimit-* headers,
+        None for no limit and no headers.
+    rate_limit_error_rate:
+        share of chat completions answered with an injected 429 regardless of the limits.
+    validating_seconds / batch_requests_per_second / finalizing_seconds:
+        batch state progression, request_counts grow at batch_requests_per_second while in progress.
+    expire_after_seconds:
+        batches that would take longer expire at that point, with the requests done so far in the
+        output file and the rest as batch_expired in the error file. None to never expire.
+    batch_error_rate:
+        share of batch requests that fail with a 500 and go to the error file.
+    enqueued_token_limit:
+        estimated input tokens of unfinished batches, a batch that would exceed it fails in validation
+        with token_limit_exceeded. None for no limit.
+    response_templates:
+        list of str.format templates with {n} and {model}, one picked at random per response,
+        or a callable taking the request body and returning the response text.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, storage_path=None,
+                 latency=0.0, latency_jitter=0.0,
+                 requests_per_minute=None, tokens_per_minute=None, rate_limit_error_rate=0.0,
+                 validating_seconds=1.0, batch_requests_per_second=1000.0, finalizing_seconds=1.0,
+                 expire_after_seconds=None, batch_error_rate=0.0, enqueued_token_limit=None,
+                 response_templates=None, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.validating_seconds = validating_seconds
+        self.batch_requests_per_second = batch_requests_per_second
+        self.finalizing_seconds = finalizing_seconds
+        self.expire_after_seconds = expire_after_seconds
+        self.batch_error_rate = batch_error_rate
+        self.enqueued_token_limit = enqueued_token_limit
+        self.response_templates = response_templates or EG_RESPONSE_TEMPLATES + HS_RESPONSE_TEMPLATES
+
+        self.buckets = {'requests': rate_limit_utils.TokenBucket(requests_per_minute) if requests_per_minute else None,
+                        'tokens': rate_limit_utils.TokenBucket(tokens_per_minute) if tokens_per_minute else None}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.files = {}
+        self.batches = {}
+
+        self.owns_storage = storage_path is None
+        self.storage_path = tempfile.mkdtemp(prefix='fake_openai_') if storage_path is None else storage_path
+        os.makedirs(self.storage_path, exist_ok=True)
+
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler_helper(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f'Fake OpenAI server listening on {self.base_url}.')
+        return self
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.owns_storage:
+            shutil.rmtree(self.storage_path, ignore_errors=True)
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def _next_id(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return f"{prefix}-{self.counter}", self.counter
+
+
+    # ---------------------------------------------------------
+    # Files
+    # ---------------------------------------------------------
+
+    def create_file(self, content, filename, purpose):
+        file_id, _ = self._next_id('file')
+        file_path = os.path.join(self.storage_path, file_id)
+        with open(file_path, "wb") as file:
+            file.write(content)
+        return self._register_file(file_id, file_path, filename, purpose)
+
+
+    def _register_file(self, file_id, file_path, filename, purpose):
+        file_obj = {"id": file_id,
+                    "object": "file",
+                    "bytes": os.path.getsize(file_path),
+                    "created_at": int(time.time()),
+                    "filename": filename,
+                    "purpose": purpose,
+                    "status": "processed",
+                    "status_details": None}
+        with self.lock:
+            self.files[file_id] = dict(file_obj, path=file_path)
+        return file_obj
+
+
+    # ---------------------------------------------------------
+    # Batches
+    # ---------------------------------------------------------
+
+    def create_batch(self, request):
+        input_file = self.files.get(request.get('input_file_id'))
+        if input_file is None:
+            return None
+
+        batch_id, _ = self._next_id('batch')
+        with open(input_file['path'], "r") as file:
+            request_tokens = [token_utils.estimate_request_tokens(json.loads(line)['body']) for line in file if line.strip()]
+        n_requests = len(request_tokens)
+
+        # the timeline is fixed at creation, retrieve only reads the clock
+        run_seconds = n_requests / self.batch_requests_per_second
+        expires = self.expire_after_seconds is not None and \
+                  self.validating_seconds + run_seconds > self.expire_after_seconds
+        batch = {"id": batch_id,
+                 "object": "batch",
+                 "endpoint": request.get('endpoint'),
+                 "errors": None,
+                 "input_file_id": input_file['id'],
+                 "completion_window": request.get('completion_window', '24h'),
+                 "created_at": int(time.time()),
+                 "expires_at": int(time.time()) + 24 * 3600,
+                 "metadata": request.get('metadata'),
+                 "n_requests": n_requests,
+                 "n_executed": int((self.expire_after_seconds - self.validating_seconds) * self.batch_requests_per_second) if expires else n_requests,
+                 "expires": expires,
+                 "started_at": time.monotonic(),
+                 "output_file_id": None,
+                 "error_file_id": None,
+                 "n_succeeded": 0,
+                 "n_failed": 0,
+                 "n_tokens": sum(request_tokens),
+                 "rejected": False,
+                 "files_ready": threading.Event()}
+        batch['n_executed'] = max(0, min(batch['n_executed'], n_requests))
+        with self.lock:
+            enqueued_tokens = sum(other['n_tokens'] for other in self.batches.values()
+                                  if not other['rejected'] and self.batch_object(other)['status'] in ['validating', 'in_progress', 'finalizing'])
+            batch['rejected'] = self.enqueued_token_limit is not None and enqueued_tokens + batch['n_tokens'] > self.enqueued_token_limit
+            self.batches[batch_id] = batch
+
+        if batch['rejected']:
+            batch['errors'] = {"object": "list", "data": [TOKEN_LIMIT_EXCEEDED_ERROR]}
+            return self.batch_object(batch)
+
+        # results are written in the background, so they are ready by the time the batch completes
+        threading.Thread(target=self._write_batch_results, args=(batch,), daemon=True).start()
+        return self.batch_object(batch)
+
+
+    def _write_batch_results(self, batch):
+        input_file = self.files[batch['input_file_id']]
+        output_path = os.path.join(self.storage_path, f"{batch['id']}_output.jsonl")
+        error_path = os.path.join(self.storage_path, f"{batch['id']}_error.jsonl")
+
+        with open(input_file['path'], "r") as source_file, \
+             open(output_path, "w") as output_file, \
+             open(error_path, "w") as error_file:
+            for n, line in enumerate((line for line in source_file if line.strip()), start=1):
+                request = json.loads(line)
+                request_id = f"batch_req_{batch['id']}_{n}"
+                if n > batch['n_executed']:
+                    error_file.write(json.dumps({"id": request_id, "custom_id": request['custom_id'],
+                                                 "response": None, "error": BATCH_EXPIRED_ERROR}) + '\n')
+                    batch['n_failed'] += 1
+                elif self.random.random() < self.batch_error_rate:
+                    error_file.write(json.dumps({"id": request_id, "custom_id": request['custom_id'],
+                                                 "response": {"status_code": 500, "request_id": f"req_{request_id}", "body": SERVER_ERROR_BODY},
+                                                 "error": None}) + '\n')
+                    batch['n_failed'] += 1
+                else:
+                    output_file.write(json.dumps({"id": request_id, "custom_id": request['custom_id'],
+                                                  "response": {"status_code": 200, "request_id": f"req_{request_id}",
+                                                               "body": self.completion(request['body'], n)},
+                                                  "error": None}) + '\n')
+                    batch['n_succeeded'] += 1
+
+        if batch['n_succeeded']:
+            batch['output_file_id'] = self._register_file(f"file-{batch['id']}-output", output_path, "batch_output.jsonl", "batch_output")['id']
+        if batch['n_failed']:
+            batch['error_file_id'] = self._register_file(f"file-{batch['id']}-error", error_path, "batch_error.jsonl", "batch_output")['id']
+        batch['files_ready'].set()
+
+
+    def batch_object(self, batch):
+        elapsed = time.monotonic() - batch['started_at']
+        started = batch['created_at']
+        run_seconds = batch['n_executed'] / self.batch_requests_per_second
+        timestamps = {"in_progress_at": None, "finalizing_at": None, "completed_at": None, "failed_at": None,
+                      "expired_at": None, "cancelling_at": None, "cancelled_at": None}
+
+        if elapsed < self.validating_seconds:
+            status, n_done = 'validating', 0
+        elif batch['rejected']:
+            status, n_done = 'failed', 0
+            timestamps['failed_at'] = started + int(self.validating_seconds)
+        elif elapsed < self.validating_seconds + run_seconds or not batch['files_ready'].is_set():
+            status = 'in_progress'
+            n_done = min(batch['n_executed'], int((elapsed - self.validating_seconds) * self.batch_requests_per_second))
+            timestamps['in_progress_at'] = started + int(self.validating_seconds)
+        elif batch['expires']:
+            status, n_done = 'expired', batch['n_executed']
+            timestamps.update(in_progress_at=started + int(self.validating_seconds),
+                              expired_at=started + int(self.validating_seconds + run_seconds))
+        elif elapsed < self.validating_seconds + run_seconds + self.finalizing_seconds:
+            status, n_done = 'finalizing', batch['n_executed']
+            timestamps.update(in_progress_at=started + int(self.validating_seconds),
+                              finalizing_at=started + int(self.validating_seconds + run_seconds))
+        else:
+            status, n_done = 'completed', batch['n_executed']
+            timestamps.update(in_progress_at=started + int(self.validating_seconds),
+                              finalizing_at=started + int(self.validating_seconds + run_seconds),
+                              completed_at=started + int(self.validating_seconds + run_seconds + self.finalizing_seconds))
+
+        terminal = status in ['completed', 'expired']
+        return {**{key: batch[key] for key in ["id", "object", "endpoint", "errors", "input_file_id", "completion_window",
+                                               "created_at", "expires_at", "metadata"]},
+                "status": status,
+                "output_file_id": batch['output_file_id'] if terminal else None,
+                "error_file_id": batch['error_file_id'] if terminal else None,
+                **timestamps,
+                "request_counts": {"total": batch['n_requests'],
+                                   "completed": batch['n_succeeded'] if terminal else n_done,
+                                   "failed": batch['n_failed'] if terminal else 0}}
+
+
+    # ---------------------------------------------------------
+    # Chat completions
+    # ---------------------------------------------------------
+
+    def completion(self, body, n):
+        if callable(self.response_templates):
+            content = self.response_templates(body)
+        else:
+            content = self.random.choice(self.response_templates).format(n=n, model=body.get('model'))
+
+        return chat_completion_body(body, content, n)
+
+
+    def admit_completion(self, body):
+        """
+        Takes the request and token budget of a completion, returns (admitted, rate limit headers).
+        """
+        amounts = {'requests': 1, 'tokens': token_utils.estimate_request_tokens(body)}
+        with self.lock:
+            admitted = self.random.random() >= self.rate_limit_error_rate
+            buckets = {name: bucket for name, bucket in self.buckets.items() if bucket is not None}
+            if admitted and all(bucket.wait_time(amounts[name]) == 0 for name, bucket in buckets.items()):
+                for name, bucket in buckets.items():
+                    bucket.consume(amounts[name])
+            else:
+                admitted = False
+
+            headers = {}
+            for name, bucket in buckets.items():
+                reset_seconds = (bucket.capacity - bucket.level) * 60 / bucket.capacity
+                headers[f'x-ratelimit-limit-{name}'] = str(int(bucket.capacity))
+                headers[f'x-ratelimit-remaining-{name}'] = str(max(0, int(bucket.level)))
+                headers[f'x-ratelimit-reset-{name}'] = f"{reset_seconds:.3f}s"
+            if not admitted:
+                wait = max([bucket.wait_time(amounts[name]) for name, bucket in buckets.items()] + [0.05])
+                headers['retry-after-ms'] = str(int(wait * 1000))
+        return admitted, headers
+
+
+def chat_completion_body(body, content, n) -> dict:
+    # a chat.completion object answering the request body with content, usage estimated from the text
+    prompt_tokens = sum(token_utils.estimate_tokens(message.get('content')) for message in body.get('messages', []))
+    completion_tokens = token_utils.estimate_tokens(content)
+    # reasoning models bill hidden reasoning as completion tokens
+    reasoning_tokens = 4 * completion_tokens if str(body.get('model')).startswith('o1') else 0
+    return {"id": f"chatcmpl-{n}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model'),
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant", "content": content, "refusal": None},
+                         "logprobs": None,
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens + reasoning_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens + reasoning_tokens,
+                      "prompt_tokens_details": {"cached_tokens": 0, "audio_tokens": 0},
+                      "completion_tokens_details": {"reasoning_tokens": reasoning_tokens,
+                                                    "audio_tokens": 0,
+                                                    "accepted_prediction_tokens": 0,
+                                                    "rejected_prediction_tokens": 0}},
+            "service_tier": "default",
+            "system_fingerprint": "fp_fake"}
+
+
+def _make_handler_helper(server):
+
+    class FakeOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _send_json(self, status, obj, headers=None):
+            content = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def _send_error(self, status, message, error_type='invalid_request_error', code=None, headers=None):
+            self._send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": code}}, headers)
+
+        def do_GET(self):
+            if match := re.fullmatch(r'/v1/files/([^/]+)/content', self.path):
+                file_obj = server.files.get(match.group(1))
+                if file_obj is None:
+                    return self._send_error(HTTPStatus.NOT_FOUND, f"No such File object: {match.group(1)}")
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.path.getsize(file_obj['path'])))
+                self.end_headers()
+                with open(file_obj['path'], "rb") as file:
+                    shutil.copyfileobj(file, self.wfile, 1024 ** 2)
+            elif match := re.fullmatch(r'/v1/files/([^/]+)', self.path):
+                file_obj = server.files.get(match.group(1))
+                if file_obj is None:
+                    return self._send_error(HTTPStatus.NOT_FOUND, f"No such File object: {match.group(1)}")
+                self._send_json(HTTPStatus.OK, {k: v for k, v in file_obj.items() if k != 'path'})
+            elif match := re.fullmatch(r'/v1/batches/([^/]+)', self.path):
+                batch = server.batches.get(match.group(1))
+                if batch is None:
+                    return self._send_error(HTTPStatus.NOT_FOUND, f"No batch found with id '{match.group(1)}'.")
+                self._send_json(HTTPStatus.OK, server.batch_object(batch))
+            else:
+                self._send_error(HTTPStatus.NOT_FOUND, f"Invalid URL (GET {self.path})")
+
+        def do_POST(self):
+            body = self._read_body()
+            if self.path == '/v1/files':
+                fields = _parse_multipart_helper(self.headers.get('Content-Type', ''), body)
+                if 'file' not in fields:
+                    return self._send_error(HTTPStatus.BAD_REQUEST, "Missing file.")
+                content, filename = fields['file']
+                purpose = fields.get('purpose', (b'batch', None))[0].decode('utf-8')
+                self._send_json(HTTPStatus.OK, server.create_file(content, filename, purpose))
+            elif self.path == '/v1/batches':
+                batch_obj = server.create_batch(json.loads(body))
+                if batch_obj is None:
+                    return self._send_error(HTTPStatus.BAD_REQUEST, "Invalid input_file_id.")
+                self._send_json(HTTPStatus.OK, batch_obj)
+            elif self.path == '/v1/chat/completions':
+                request = json.loads(body)
+                admitted, headers = server.admit_completion(request)
+                request_id, n = server._next_id('req')
+                headers['x-request-id'] = request_id
+                if not admitted:
+                    return self._send_error(HTTPStatus.TOO_MANY_REQUESTS, "Rate limit reached, please try again later.",
+                                            error_type='requests', code='rate_limit_exceeded', headers=headers)
+                time.sleep(server.latency + server.random.uniform(0, server.latency_jitter))
+                self._send_json(HTTPStatus.OK, server.completion(request, n), headers)
+            else:
+                self._send_error(HTTPStatus.NOT_FOUND, f"Invalid URL (POST {self.path})")
+
+    return FakeOpenAIHandler
+
+
+def _parse_multipart_helper(content_type, body):
+    # name -> (content, filename) of each part of a multipart/form-data body
+    header = email.message.Message()
+    header['Content-Type'] = content_type
+    boundary = header.get_param('boundary')
+    if boundary is None:
+        return {}
+
+    fields = {}
+    for part in body.split(b'--' + boundary.encode('latin-1'))[1:-1]:
+        # each part sits between a CRLF after the boundary line and the CRLF before the next one
+        part_headers, _, content = part[2:-2].partition(b'\r\n\r\n')
+        part_message = email.parser.BytesHeaderParser().parsebytes(part_headers)
+        name = part_message.get_param('name', header='content-disposition')
+        fields[name] = (content, part_message.get_param('filename', header='content-disposition'))
+    return fields
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a fake OpenAI backend, point clients at it with OPENAI_BASE_URL.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency_jitter', type=float, default=0.0)
+    parser.add_argument('--requests_per_minute', type=float, default=None)
+    parser.add_argument('--tokens_per_minute', type=float, default=None)
+    parser.add_argument('--rate_limit_error_rate', type=float, default=0.0)
+    parser.add_argument('--validating_seconds', type=float, default=1.0)
+    parser.add_argument('--batch_requests_per_second', type=float, default=1000.0)
+    parser.add_argument('--finalizing_seconds', type=float, default=1.0)
+    parser.add_argument('--expire_after_seconds', type=float, default=None)
+    parser.add_argument('--batch_error_rate', type=float, default=0.0)
+    parser.add_argument('--enqueued_token_limit', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeOpenAIServer(**vars(args))
+    logger.info(f'Fake OpenAI server listening on {server.base_url}.')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
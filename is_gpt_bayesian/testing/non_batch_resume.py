@@ -0,0 +1,37 @@
+import os
+from is_gpt_bayesian.testing.fake_openai_server import FakeOpenAIServer, EG_RESPONSE_TEMPLATES
+from is_gpt_bayesian.testing import synthetic_data
+from is_gpt_bayesian.utils import time_utils
+
+
+def check_non_batch_resume(n_requests=200, model='o1-mini', seed=0):
+    """
+    Raises AssertionError unless a non-batch job that partly failed, and was resumed by
+    resend_failed_jobs to completed, is left without unresent failures in the manifest, so
+    resend_failed_requests does not send the requests the resumed pass answered a second time.
+    """
+    server = FakeOpenAIServer(latency=0.0, rate_limit_error_rate=0.2, response_templates=EG_RESPONSE_TEMPLATES, seed=seed).start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+    from is_gpt_bayesian.model import OpenAISession
+
+    max_retries = OpenAISession.non_batch_max_retries
+    OpenAISession.non_batch_max_retries = 0 # the rate limit errors of the first pass fail their queries
+    try:
+        session = OpenAISession(f"non_batch_resume__{time_utils.get_secondstamp()}")
+        session.generate_batch_files(synthetic_data.synthetic_specs_df(n_requests, [model], ['reasoning'], seed=seed))
+        session.send_batches()
+        job_path, = session.jobs
+        assert session.manifest.job(job_path)['status'] == 'failed', f'{job_path}: no query of the first pass failed.'
+        assert session.manifest.failures(job_path, unresent_only=True), f'{job_path}: failures of the first pass were not recorded.'
+
+        server.rate_limit_error_rate = 0.0
+        session.resend_failed_jobs()
+        assert session.manifest.job(job_path)['status'] == 'completed', f'{job_path}: resumed job did not complete.'
+
+        unresent_failures = session.manifest.failures(job_path, unresent_only=True)
+        assert not unresent_failures, f'{job_path}: completed, but {len(unresent_failures)} failures are left unresent.'
+        assert session.resend_failed_requests() == {}, f'{job_path}: requests answered by the resumed pass were resent.'
+    finally:
+        OpenAISession.non_batch_max_retries = max_retries
+        server.stop()
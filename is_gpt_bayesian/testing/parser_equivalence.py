@@ -0,0 +1,34 @@
+import warnings
+import numpy as np
+import pandas as pd
+from is_gpt_bayesian.processing import response_processing
+from is_gpt_bayesian.testing import synthetic_data
+
+
+# responses the synthetic ones do not cover, one per tier of response_hs and the ways parsing fails
+EDGE_CASE_RESPONSES = [None, np.nan, '', 'no answer', 'Final answer:', 'final answer', 'FINAL ANSWER: \\frac{1}{0}',
+                       'Final answer: \\dfrac{2.5}{3.5}', 'Final answer: 2⁄3', 'Final answer: 1 / 0', 'Final answer: 0.75',
+                       'Final answer: 2', 'Final answer: ⅔', 'Final answer: Cage A and Cage B',
+                       'reasoning\nFinal answer: Cage B.', 'Cage A\nthey are equal', 'Final answer: Cage A.\n']
+
+
+def check_batch_parsers(n_responses=2_000, seed=0):
+    """
+    Raises AssertionError unless response_eg_batch / response_hs_batch return what the row parsers
+    return, on synthetic and edge case responses whose index repeats labels, as the run results do
+    for rows queried more than once.
+    """
+    for design, response_fnc in [('eg', response_processing.response_eg), ('hs', response_processing.response_hs)]:
+        textual_responses = pd.concat([synthetic_data.synthetic_textual_responses(n_responses, design, seed=seed),
+                                       pd.Series(EDGE_CASE_RESPONSES, dtype=object)], ignore_index=True)
+        for index in [pd.RangeIndex(len(textual_responses)), pd.Index(np.arange(len(textual_responses)) // 2)]:
+            textual_responses.index = index
+            expected = textual_responses.apply(response_fnc)
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', FutureWarning)
+                results = response_processing.BATCH_RESPONSE_FNCS[response_fnc](textual_responses)
+
+            assert results.index.equals(expected.index), f'{response_fnc.__name__}: index differs.'
+            mismatched = ~((results == expected) | (results.isna() & expected.isna()))
+            assert not mismatched.any(), \
+                f'{response_fnc.__name__}: {mismatched.sum()} responses differ, e.g. {textual_responses[mismatched].iloc[:3].tolist()}.'
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import logging
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from is_gpt_bayesian.utils import time_utils, metrics_utils
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+BENCHMARK_MODELS = ['gpt-4o-mini']
+BENCHMARK_INSTRUCTIONS = ['reasoning', 'no reasoning']
+BENCHMARK_RUN_NAME = 'benchmark'
+
+
+# ===================================
+# Stages, each a setup (not timed) returning the args of the timed stage function
+# ===================================
+
+def _setup_specs_helper(n_rows, seed):
+    from is_gpt_bayesian.testing import synthetic_data
+    # data rows are expanded by models x instructions, so the stage outputs about n_rows specs
+    n_data_rows = -(-n_rows // (len(BENCHMARK_MODELS) * len(BENCHMARK_INSTRUCTIONS)))
+    data_df = synthetic_data.synthetic_eg_data(n_data_rows, seed)
+    return (data_df,)
+
+
+def _run_specs_helper(data_df):
+    from is_gpt_bayesian.processing import specs_processing, prompt_processing
+    return specs_processing._get_specs_df(data_df, 1, 1, BENCHMARK_MODELS, BENCHMARK_INSTRUCTIONS, [], prompt_processing.prompt_eg)
+
+
+def _setup_generate_batch_files_helper(n_rows, seed):
+    from is_gpt_bayesian.model import OpenAISession
+    from is_gpt_bayesian.testing import synthetic_data
+    specs_df = synthetic_data.synthetic_specs_df(n_rows, BENCHMARK_MODELS, BENCHMARK_INSTRUCTIONS, seed=seed)
+    return OpenAISession(BENCHMARK_RUN_NAME), specs_df
+
+
+def _run_generate_batch_files_helper(session, specs_df):
+    return session.generate_batch_files(specs_df)
+
+
+def _setup_completed_jobs_helper(n_rows, seed):
+    # batch files written and answered, with the jobs recorded as completed
+    from is_gpt_bayesian.testing import synthetic_data
+    session, specs_df = _setup_generate_batch_files_helper(n_rows, seed)
+    for job_path in session.generate_batch_files(specs_df):
+        n_requests = synthetic_data.write_synthetic_batch_responses(job_path, seed=seed)
+        session._save_job_info(job_path, {'id': f'batch_{os.path.basename(job_path)}',
+                                          'status': 'completed',
+                                          'request_counts': {'total': n_requests, 'completed': n_requests, 'failed': 0}})
+    return (session,)
+
+
+def _run_process_one_response_helper(session):
+    return [session.process_one_response(job_path) for job_path in session.jobs]
+
+
+def _setup_process_reponses_helper(n_rows, seed):
+    # job results already ingested, the stage is reading them back plus concat / groupby / cumsum
+    session, = _setup_completed_jobs_helper(n_rows, seed)
+    _run_process_one_response_helper(session)
+    return (session,)
+
+
+def _run_process_reponses_helper(session):
+    return session.process_reponses()
+
+
+def _setup_response_eg_helper(n_rows, seed):
+    from is_gpt_bayesian.testing import synthetic_data
+    from is_gpt_bayesian.processing import response_processing
+    return synthetic_data.synthetic_textual_responses(n_rows, 'eg', seed=seed), response_processing.response_eg
+
+
+def _setup_response_hs_helper(n_rows, seed):
+    from is_gpt_bayesian.testing import synthetic_data
+    from is_gpt_bayesian.processing import response_processing
+    return synthetic_data.synthetic_textual_responses(n_rows, 'hs', seed=seed), response_processing.response_hs
+
+
+def _run_parse_responses_helper(textual_responses, response_processing_fnc):
+    from is_gpt_bayesian.processing import response_processing
+    return response_processing.parse_responses(textual_responses, response_processing_fnc)
+
+
+def _setup_results_df_helper(n_rows, seed):
+    from is_gpt_bayesian.testing import synthetic_data
+    return (synthetic_data.synthetic_results_df(n_rows, BENCHMARK_MODELS, BENCHMARK_INSTRUCTIONS, seed=seed),)
+
+
+def _run_posterior_helper(results_df):
+    from is_gpt_bayesian.processing import response_processing
+    return response_processing.eg_posterior_probabilities(results_df)
+
+
+def _run_pivots_helper(results_df):
+    from is_gpt_bayesian.processing import response_processing
+    return response_processing.process_eg_result_df(results_df, response_processing.response_eg, BENCHMARK_RUN_NAME, ungroup_by=['name'])
+
+
+STAGES = {'specs': (_setup_specs_helper, _run_specs_helper),
+          'generate_batch_files': (_setup_generate_batch_files_helper, _run_generate_batch_files_helper),
+          'process_one_response': (_setup_completed_jobs_helper, _run_process_one_response_helper),
+          'process_reponses': (_setup_process_reponses_helper, _run_process_reponses_helper),
+          'response_eg': (_setup_response_eg_helper, _run_parse_responses_helper),
+          'response_hs': (_setup_response_hs_helper, _run_parse_responses_helper),
+          'posterior': (_setup_results_df_helper, _run_posterior_helper),
+          'process_eg_result_df': (_setup_results_df_helper, _run_pivots_helper)}
+
+
+# ===================================
+# Measurement
+# ===================================
+
+def benchmark_stage(stage, n_rows, seed=0) -> dict:
+    """
+    Sets up and times one stage on n_rows synthetic rows, in the current process and working directory.
+    """
+    setup_fnc, stage_fnc = STAGES[stage]
+    stage_args = setup_fnc(n_rows, seed)
+
+    # the peak of the stage alone, not of the setup before it
+    metrics_utils.reset_peak_rss()
+    rss_before_mb = metrics_utils.current_rss_mb()
+    started_at = time.perf_counter()
+    stage_fnc(*stage_args)
+    seconds = time.perf_counter() - started_at
+
+    return {'stage': stage,
+            'n_rows': n_rows,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(n_rows / seconds, 1) if seconds > 0 else None,
+            'rss_before_mb': rss_before_mb,
+            'peak_rss_mb': metrics_utils.peak_rss_mb()}
+
+
+def run_benchmarks(stages, sizes, seed=0) -> list:
+    """
+    Runs every stage x size in a fresh process and an empty working directory, so neither memory
+    nor files of an earlier benchmark leak into the next one. A failed benchmark, e.g. out of
+    memory at the largest size, is reported with its error instead of stopping the suite.
+    """
+    invalid_stages = [stage for stage in stages if stage not in STAGES]
+    if invalid_stages:
+        raise ValueError(f'Invalid stages {invalid_stages}, must be in {list(STAGES)}.')
+
+    results = []
+    for n_rows in sizes:
+        for stage in stages:
+            with tempfile.TemporaryDirectory() as working_path, \
+                 ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    result = executor.submit(_benchmark_in_path_helper, working_path, stage, n_rows, seed).result()
+                except Exception as e:
+                    result = {'stage': stage, 'n_rows': n_rows, 'error': repr(e)}
+            logger.info(f'Benchmark {stage} with {n_rows} rows: {result}.')
+            results.append(result)
+    return results
+
+
+def benchmark_report(results) -> dict:
+    return {'created_at': time_utils.get_unix_utc_timestamp(),
+            'git_commit': _git_commit_helper(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': results}
+
+
+def _benchmark_in_path_helper(working_path, stage, n_rows, seed):
+    os.chdir(working_path)
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark') # the session creates a client, no request is sent
+    return benchmark_stage(stage, n_rows, seed)
+
+
+def _git_commit_helper():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
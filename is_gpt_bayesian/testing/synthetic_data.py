@@ -0,0 +1,151 @@
+import json
+import numpy as np
+import pandas as pd
+from is_gpt_bayesian.utils import path_utils, token_utils
+from is_gpt_bayesian.processing import specs_processing, prompt_processing
+from is_gpt_bayesian.testing.fake_openai_server import chat_completion_body
+
+
+# (nballs, ndraws_from_cage, cage_A_balls_marked_N, cage_B_balls_marked_N, nballs_prior_cage, priors), as in the El-Gamal and Grether designs
+EG_DESIGNS = {'DATA1': (6, 6, 4, 3, 6, [2, 3, 4]),
+              'DATA2': (6, 7, 4, 3, 6, [2, 3, 4]),
+              'DATA3': (10, 7, 4, 6, 10, [3, 4, 6, 7]),
+              'DATA4': (10, 6, 4, 6, 10, [3, 4, 6, 7])}
+EG_TRIALS_PER_SUBJECT = 10
+HS_ROUNDS_PER_SUBJECT = 12
+
+REASONING_WORDS = ("the posterior probability of cage A given the draws follows from bayes rule with the prior of "
+                   "the die and the likelihood of each ball so we compare the two cages step by step").split()
+FINAL_ANSWERS = {'eg': ["Final answer: Cage A.", "Final answer: Cage B.", "Final answer: equal"],
+                 'hs': ["Final answer: \\dfrac{2}{3}", "Final answer: 0.75", "Final answer: 1/2", "Final answer: ½", "Final answer: 1"]}
+
+
+def synthetic_eg_data(n_rows, seed=0) -> pd.DataFrame:
+    """
+    n_rows subject x trial rows shaped like get_wisconsin_data(), with random designs and draws.
+    """
+    rng = np.random.default_rng(seed)
+    n_subjects = -(-n_rows // EG_TRIALS_PER_SUBJECT)
+
+    names = rng.choice(list(EG_DESIGNS), size=n_subjects)
+    data_df = pd.DataFrame({'name': np.repeat(names, EG_TRIALS_PER_SUBJECT),
+                            'subject_num': np.repeat(np.arange(1, n_subjects + 1), EG_TRIALS_PER_SUBJECT),
+                            'trial_num': np.tile(np.arange(1, EG_TRIALS_PER_SUBJECT + 1), n_subjects)}).head(n_rows)
+    designs = pd.DataFrame.from_dict(EG_DESIGNS, orient='index',
+                                     columns=['nballs', 'ndraws_from_cage', 'cage_A_balls_marked_N', 'cage_B_balls_marked_N',
+                                              'nballs_prior_cage', 'prior_choices'])
+    data_df = data_df.join(designs, on='name')
+
+    data_df['state'] = 'synthetic'
+    data_df['trial_id'] = data_df['name'] + ' - Trial ' + data_df['trial_num'].astype(str)
+    data_df['subject_id'] = data_df['name'] + ' - Subject ' + data_df['subject_num'].astype(str)
+    data_df['nsubjects'] = n_subjects
+    data_df['ntrials'] = EG_TRIALS_PER_SUBJECT
+    data_df['pay'] = rng.integers(0, 2, size=len(data_df))
+    prior_idx = (rng.random(len(data_df)) * data_df['prior_choices'].str.len()).astype(int)
+    data_df['priors'] = [choices[i] for choices, i in zip(data_df['prior_choices'], prior_idx)]
+    data_df['ndraws'] = rng.integers(0, data_df['ndraws_from_cage'] + 1)
+    data_df['obs_idx'] = np.arange(len(data_df))
+
+    data_df = data_df[specs_processing.EG_DATA_COLUMNS].copy()
+    data_df['subject_uuid'] = specs_processing._subject_uuid_helper(data_df['subject_id'])
+    return data_df
+
+
+def synthetic_hs_data(n_rows, seed=0) -> pd.DataFrame:
+    """
+    n_rows subject x round rows shaped like get_hs_data(), with random priors and outcomes.
+    """
+    rng = np.random.default_rng(seed)
+    n_subjects = -(-n_rows // HS_ROUNDS_PER_SUBJECT)
+
+    data_df = pd.DataFrame({'sheet_name': np.repeat(rng.choice(specs_processing.HS_SHEET_NAMES, size=n_subjects), HS_ROUNDS_PER_SUBJECT),
+                            'subject_num': np.repeat(np.arange(1, n_subjects + 1), HS_ROUNDS_PER_SUBJECT),
+                            'round': np.tile(np.arange(1, HS_ROUNDS_PER_SUBJECT + 1), n_subjects)}).head(n_rows)
+
+    data_df['trial_id'] = data_df['sheet_name'] + ' - Round ' + data_df['round'].astype(str)
+    data_df['subject_id'] = data_df['sheet_name'] + ' - id ' + data_df['subject_num'].astype(str)
+    data_df['Prior Pr(A)'] = rng.choice(['1/2', '2/3'], size=len(data_df))
+    data_df['prior'] = data_df['Prior Pr(A)'].map({'1/2': 1/2, '2/3': 2/3})
+    data_df['ndraws_from_cage'] = rng.integers(1, 7, size=len(data_df))
+    # each outcome is the first ndraws_from_cage bits of a random 6 bit number, 0 -> D and 1 -> L
+    bits_to_outcome = str.maketrans('01', 'DL')
+    data_df['outcome'] = [f'{bits:06b}'[:n].translate(bits_to_outcome)
+                          for bits, n in zip(rng.integers(0, 2 ** 6, size=len(data_df)), data_df['ndraws_from_cage'])]
+    data_df['D_draws_from_cage'] = data_df['outcome'].str.count('D')
+    data_df['L_draws_from_cage'] = data_df['outcome'].str.count('L')
+    data_df['outcome_expand'] = data_df['outcome'].str.replace('D', 'Dark, ').str.replace('L', 'Light, ').str[:-2]
+    data_df['obs_idx'] = np.arange(len(data_df))
+
+    data_df = data_df[['obs_idx', 'sheet_name', 'trial_id', 'subject_id', 'Prior Pr(A)', 'prior', 'outcome', 'ndraws_from_cage',
+                       'D_draws_from_cage', 'L_draws_from_cage', 'outcome_expand']].copy()
+    data_df['subject_uuid'] = specs_processing._subject_uuid_helper(data_df['subject_id'])
+    return data_df
+
+
+def synthetic_specs_df(n_requests, models, instructions, design='eg', seed=0) -> pd.DataFrame:
+    """
+    About n_requests rows of run specs (data rows x models x instructions), as get_*_specs_df builds them.
+    """
+    n_rows = -(-n_requests // (len(models) * len(instructions)))
+    if design == 'eg':
+        data_df, prompt_fnc = synthetic_eg_data(n_rows, seed), prompt_processing.prompt_eg
+    elif design == 'hs':
+        data_df, prompt_fnc = synthetic_hs_data(n_rows, seed), prompt_processing.prompt_hs
+    else:
+        raise ValueError(f"Invalid design {design}, must be 'eg' or 'hs'.")
+
+    return specs_processing._get_specs_df(data_df, 1, 1, models, instructions, [], prompt_fnc)
+
+
+def synthetic_textual_responses(n_responses, design='eg', reasoning_words=200, seed=0) -> pd.Series:
+    """
+    Reasoning-style responses of about reasoning_words words, each ending in a final answer
+    response_eg / response_hs parse.
+    """
+    rng = np.random.default_rng(seed)
+    # a pool of distinct reasoning paragraphs, long responses are rarely identical
+    paragraphs = [' '.join(rng.choice(REASONING_WORDS, size=reasoning_words)) for _ in range(min(n_responses, 1000))]
+    paragraph_idx = rng.integers(0, len(paragraphs), size=n_responses)
+    answer_idx = rng.integers(0, len(FINAL_ANSWERS[design]), size=n_responses)
+    return pd.Series([f"{paragraphs[i]} {n}\n\n{FINAL_ANSWERS[design][j]}"
+                      for n, (i, j) in enumerate(zip(paragraph_idx, answer_idx))])
+
+
+def write_synthetic_batch_responses(job_path, design='eg', reasoning_words=200, seed=0) -> int:
+    """
+    Writes a batch output file answering every request of the job source file, as a completed batch would.
+    """
+    with open(path_utils.job_source_file_path(job_path), "r") as file:
+        requests = [json.loads(line) for line in file]
+    textual_responses = synthetic_textual_responses(len(requests), design, reasoning_words, seed)
+
+    with open(path_utils.job_response_file_path(job_path), "w") as file:
+        for n, (request, content) in enumerate(zip(requests, textual_responses), start=1):
+            file.write(json.dumps({"id": f"batch_req_{n}",
+                                   "custom_id": request['custom_id'],
+                                   "response": {"status_code": 200,
+                                                "request_id": f"req_{n}",
+                                                "body": chat_completion_body(request['body'], content, n)},
+                                   "error": None}) + '\n')
+    return len(requests)
+
+
+def synthetic_results_df(n_requests, models, instructions, design='eg', reasoning_words=200, seed=0) -> pd.DataFrame:
+    """
+    About n_requests rows shaped like OpenAISession.process_reponses() returns them, one answered query per spec.
+    """
+    results_df = synthetic_specs_df(n_requests, models, instructions, design, seed)
+    n = len(results_df)
+    results_df['batch_id'] = [f"batch_req_{i}" for i in range(1, n + 1)]
+    results_df['request_id'] = [f"req_{i}" for i in range(1, n + 1)]
+    results_df['created_time'] = np.arange(n, dtype=np.int64)
+    results_df['textual_response'] = synthetic_textual_responses(n, design, reasoning_words, seed).to_numpy()
+    results_df['prompt_tokens'] = prompt_processing.materialize_prompts(results_df).str.len() // token_utils.CHARS_PER_TOKEN + 1
+    results_df['completion_tokens'] = results_df['textual_response'].str.len() // token_utils.CHARS_PER_TOKEN + 1
+    results_df['total_tokens'] = results_df['prompt_tokens'] + results_df['completion_tokens']
+    results_df['cached_tokens'] = 0
+    results_df['reasoning_tokens'] = 0
+    results_df['query_idx'] = 1.0
+    results_df['query_total_count'] = 1.0
+    return results_df
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+from contextlib import contextmanager, closing
+from is_gpt_bayesian.utils import path_utils
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache():
+    """
+    Local store of batch responses keyed on a hash of the canonical request body.
+
+    seeded_only:
+        only serve requests carrying a seed, unseeded requests are meant to be fresh samples.
+    max_samples_per_key:
+        # of distinct responses kept and served per request body. Identical requests
+        within one lookup are served different samples, the ones beyond are cache misses.
+    max_age_days / max_size_mb:
+        eviction limits applied by evict(), None to disable.
+    """
+
+    def __init__(self, cache_path, seeded_only=True, max_samples_per_key=1, max_age_days=None, max_size_mb=None):
+        self.cache_path = Path(cache_path)
+        self.seeded_only = seeded_only
+        self.max_samples_per_key = max_samples_per_key
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+
+        path_utils.create_path(self.cache_path.parent)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT NOT NULL, "
+                         "sample_idx INTEGER NOT NULL, "
+                         "response_id TEXT UNIQUE, "
+                         "response TEXT NOT NULL, "
+                         "nbytes INTEGER NOT NULL, "
+                         "created_at INTEGER NOT NULL, "
+                         "PRIMARY KEY (key, sample_idx))")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self.cache_path, timeout=60)) as conn:
+            with conn:
+                yield conn
+
+
+    def honors(self, body) -> bool:
+        return not self.seeded_only or body.get('seed') is not None
+
+
+    def lookup(self, bodies) -> list:
+        keys = [request_key(body) if self.honors(body) else None for body in bodies]
+
+        cached = {}
+        unique_keys = list({key for key in keys if key is not None})
+        with self._connect() as conn:
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i+500]
+                rows = conn.execute(f"SELECT key, response FROM responses "
+                                    f"WHERE key IN ({', '.join('?' * len(chunk))}) ORDER BY key, sample_idx",
+                                    chunk)
+                for key, response in rows:
+                    cached.setdefault(key, []).append(response)
+
+        # the n-th occurrence of a request is served the n-th sample
+        responses = []
+        occurrences = {}
+        for key in keys:
+            samples = cached.get(key, [])[:self.max_samples_per_key]
+            n = occurrences.get(key, 0)
+            occurrences[key] = n + 1
+            responses.append(json.loads(samples[n]) if n < len(samples) else None)
+        return responses
+
+
+    def add(self, body, response) -> bool:
+        response_str = json.dumps(response)
+        key = request_key(body)
+        with self._connect() as conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO responses "
+                                  "SELECT ?, COALESCE(MAX(sample_idx) + 1, 0), ?, ?, ?, ? FROM responses WHERE key = ? HAVING COUNT(*) < ?",
+                                  (key, response.get('id'), response_str, len(response_str), int(time.time()),
+                                   key, self.max_samples_per_key))
+            return cursor.rowcount > 0
+
+
+    def index_job(self, job_path) -> int:
+        job_source_filename = path_utils.job_source_file_path(job_path)
+        job_response_filename = path_utils.job_response_file_path(job_path)
+        if not (os.path.exists(job_source_filename) and os.path.exists(job_response_filename)):
+            return 0
+
+        with open(job_source_filename, "r") as file:
+            bodies = {}
+            for line in file:
+                request = json.loads(line)
+                bodies[request['custom_id']] = request['body']
+
+        n_added = 0
+        with open(job_response_filename, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                response = json.loads(line)
+                # only successful responses are worth serving again
+                if response.get('error') is not None or response['custom_id'] not in bodies:
+                    continue
+                if response['response']['status_code'] not in [200, 'non_batch_chat_completion']:
+                    continue
+                # served from the cache in the first place
+                if str(response.get('id')).startswith('cached_'):
+                    continue
+                n_added += self.add(bodies[response['custom_id']], response)
+
+        logger.info(f'{n_added} responses of {job_path} added to the response cache.')
+        return n_added
+
+
+    def index_runs(self, runs_path="runs") -> int:
+        n_added = 0
+        for run_path in path_utils.get_subdirs(runs_path):
+            for job_path in path_utils.get_subdirs(run_path):
+                n_added += self.index_job(job_path)
+        return n_added
+
+
+    def evict(self) -> int:
+        n_deleted = 0
+        with self._connect() as conn:
+            if self.max_age_days is not None:
+                cutoff = int(time.time() - self.max_age_days * 24 * 3600)
+                n_deleted += conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+
+            if self.max_size_mb is not None:
+                # keep the newest responses that fit in the size limit
+                max_bytes = self.max_size_mb * 1024 ** 2
+                kept_bytes = 0
+                stale_rowids = []
+                for rowid, nbytes in conn.execute("SELECT rowid, nbytes FROM responses ORDER BY created_at DESC"):
+                    kept_bytes += nbytes
+                    if kept_bytes > max_bytes:
+                        stale_rowids.append((rowid,))
+                conn.executemany("DELETE FROM responses WHERE rowid = ?", stale_rowids)
+                n_deleted += len(stale_rowids)
+
+        if n_deleted:
+            logger.info(f'{n_deleted} responses evicted from the response cache.')
+        return n_deleted
+
+
+def request_key(body) -> str:
+    canonical_body = json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical_body.encode('utf-8')).hexdigest()
@@ -0,0 +1,70 @@
+import os
+import pandas as pd
+from is_gpt_bayesian.utils import path_utils, schema_utils
+
+
+# lookup order when reading, a typed columnar copy wins over a csv export of the same artifact
+ARTIFACT_FORMATS = ['parquet', 'csv']
+
+
+def write_frame(df, file_path, artifact_format='csv') -> str:
+    """
+    Writes df as a csv or zstd-compressed parquet artifact, file_path is the csv path from path_utils
+    and gets the suffix of artifact_format. Returns the path written.
+    """
+    file_path = path_utils.artifact_file_path(file_path, artifact_format)
+    if artifact_format == 'csv':
+        df.to_csv(file_path)
+    elif artifact_format == 'parquet':
+        _parquet_safe_helper(df).to_parquet(file_path, compression='zstd')
+    else:
+        raise ValueError(f'Invalid artifact_format {artifact_format}, must be one of {ARTIFACT_FORMATS}.')
+    return file_path
+
+
+def read_frame(file_path) -> pd.DataFrame:
+    # csv does not keep dtypes, and parquet written before the schema may not have them
+    found_path = find_frame(file_path)
+    if found_path is None:
+        raise FileNotFoundError(f"No artifact found for '{file_path}'.")
+    if found_path.endswith('.parquet'):
+        return schema_utils.apply_schema(pd.read_parquet(found_path))
+    return schema_utils.apply_schema(pd.read_csv(found_path, index_col=0))
+
+
+def read_frame_columns(file_path) -> pd.Index:
+    found_path = find_frame(file_path)
+    if found_path is None:
+        raise FileNotFoundError(f"No artifact found for '{file_path}'.")
+    if found_path.endswith('.parquet'):
+        # only the footer is read, the index is stored as columns of its own
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(found_path)
+        index_columns = [col for col in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(col, str)]
+        return pd.Index([col for col in schema.names if col not in index_columns])
+    return pd.read_csv(found_path, index_col=0, nrows=0).columns
+
+
+def find_frame(file_path):
+    for artifact_format in ARTIFACT_FORMATS:
+        candidate_path = path_utils.artifact_file_path(file_path, artifact_format)
+        if os.path.exists(candidate_path):
+            return candidate_path
+    return None
+
+
+def export_csv(file_path) -> str:
+    csv_path = path_utils.artifact_file_path(file_path, 'csv')
+    read_frame(file_path).to_csv(csv_path)
+    return csv_path
+
+
+def _parquet_safe_helper(df):
+    # md5 based ids (subject_uuid) overflow int64, store them as text, which is also what a csv round trip gives
+    overflow_cols = [col for col in df.columns
+                     if df[col].dtype == object and
+                     pd.api.types.infer_dtype(df[col], skipna=True) in ['integer', 'mixed-integer'] and
+                     df[col].map(lambda v: isinstance(v, int) and not -2**63 <= v < 2**63).any()]
+    if not overflow_cols:
+        return df
+    return df.astype({col: str for col in overflow_cols})
@@ -0,0 +1,274 @@
+import os
+import json
+import sqlite3
+import logging
+from pathlib import Path
+from contextlib import contextmanager, closing
+from is_gpt_bayesian.utils import time_utils, path_utils, io_utils, token_utils
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_COLUMNS = ['job_path', 'job_id', 'model', 'status',
+                    'request_total', 'request_completed', 'request_failed', 'request_tokens',
+                    'source_file', 'response_file', 'error_file', 'results_file',
+                    'created_at', 'completed_at', 'aggregated_at', 'updated_at']
+FAILURE_COLUMNS = ['job_path', 'custom_id', 'status_code', 'code', 'message', 'resent_as', 'updated_at']
+
+
+class RunManifest():
+    """
+    Index of the jobs of a run, one row per job directory, so status queries do not list
+    the run directory and parse every job_info_file.json. The info files stay the full
+    record of each job, every write of one is mirrored here in a single transaction.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+
+        path_utils.create_path(self.manifest_path.parent)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "job_path TEXT PRIMARY KEY, "
+                         "job_id TEXT, "
+                         "model TEXT, "
+                         "status TEXT NOT NULL, "
+                         "request_total INTEGER, "
+                         "request_completed INTEGER, "
+                         "request_failed INTEGER, "
+                         "request_tokens INTEGER, "
+                         "source_file TEXT, "
+                         "response_file TEXT, "
+                         "error_file TEXT, "
+                         "results_file TEXT, "
+                         "created_at INTEGER, "
+                         "completed_at INTEGER, "
+                         "aggregated_at INTEGER, "
+                         "updated_at INTEGER NOT NULL)")
+            # manifests created before a column was added
+            existing_columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column in MANIFEST_COLUMNS:
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {'TEXT' if column.endswith('_file') else 'INTEGER'}")
+            # failed requests of the jobs, from their error files, and the job each was resent as
+            conn.execute("CREATE TABLE IF NOT EXISTS failures ("
+                         "job_path TEXT NOT NULL, "
+                         "custom_id TEXT NOT NULL, "
+                         "status_code INTEGER, "
+                         "code TEXT, "
+                         "message TEXT, "
+                         "resent_as TEXT, "
+                         "updated_at INTEGER NOT NULL, "
+                         "PRIMARY KEY (job_path, custom_id))")
+            # state of the incremental run results, responses so far per query group and the file the jobs were folded into
+            conn.execute("CREATE TABLE IF NOT EXISTS query_counts ("
+                         "group_key TEXT PRIMARY KEY, "
+                         "query_count INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS aggregation ("
+                         "results_file TEXT NOT NULL, "
+                         "results_bytes INTEGER NOT NULL, "
+                         "updated_at INTEGER NOT NULL)")
+
+
+    @contextmanager
+    def _connect(self):
+        # one connection per operation, retrieve_batches updates the manifest from several threads
+        with closing(sqlite3.connect(self.manifest_path, timeout=60)) as conn:
+            conn.row_factory = sqlite3.Row
+            with conn:
+                yield conn
+
+
+    def update(self, job_path, **fields):
+        invalid_fields = [field for field in fields if field not in MANIFEST_COLUMNS]
+        if invalid_fields:
+            raise ValueError(f'Invalid manifest fields {invalid_fields}, must be in {MANIFEST_COLUMNS}.')
+
+        fields['updated_at'] = time_utils.get_unix_utc_timestamp()
+        # a new row starts out as created, an existing one only has the given fields overwritten
+        values = {'job_path': job_path, 'status': 'created', **fields}
+        with self._connect() as conn:
+            conn.execute(f"INSERT INTO jobs ({', '.join(values)}) VALUES ({', '.join('?' * len(values))}) "
+                         f"ON CONFLICT (job_path) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in fields)}",
+                         list(values.values()))
+
+
+    def update_from_info(self, job_path, job_info):
+        request_counts = job_info.get('request_counts')
+        # info files written by older versions hold request_counts as a repr string
+        request_counts = request_counts if isinstance(request_counts, dict) else {}
+        fields = {'status': job_info['status'],
+                  'job_id': job_info.get('id'),
+                  'request_total': request_counts.get('total'),
+                  'request_completed': request_counts.get('completed'),
+                  'request_failed': request_counts.get('failed'),
+                  'created_at': job_info.get('created_at'),
+                  'completed_at': job_info.get('completed_at')}
+
+        # files on disk, downloaded batch files are recorded in the info file, non-batch jobs write them directly
+        response_filename = path_utils.job_response_file_path(job_path)
+        error_filename = path_utils.job_error_file_path(job_path)
+        if job_info.get('output_file') or os.path.exists(response_filename):
+            fields['response_file'] = response_filename
+        if job_info.get('error_file') or os.path.exists(error_filename):
+            fields['error_file'] = error_filename
+
+        self.update(job_path, **fields)
+
+
+    def job(self, job_path):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_path = ?", (job_path,)).fetchone()
+        return dict(row) if row is not None else None
+
+
+    def jobs(self) -> list:
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute("SELECT * FROM jobs ORDER BY job_path")]
+
+
+    def job_paths(self) -> list:
+        with self._connect() as conn:
+            return [row['job_path'] for row in conn.execute("SELECT job_path FROM jobs ORDER BY job_path")]
+
+
+    def statuses(self) -> dict:
+        with self._connect() as conn:
+            return {row['job_path']: row['status'] for row in conn.execute("SELECT job_path, status FROM jobs ORDER BY job_path")}
+
+
+    def enqueued_tokens(self, model) -> int:
+        # estimated input tokens of the batches of model the API has not finished
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(request_tokens), 0) FROM jobs "
+                                "WHERE model = ? AND status IN ('validating', 'in_progress', 'finalizing', 'cancelling')", (model,)).fetchone()[0]
+
+
+    def record_failures(self, job_path, failures):
+        # failures are dicts with custom_id, status_code, code and message, recording them again keeps resent_as
+        updated_at = time_utils.get_unix_utc_timestamp()
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO failures (job_path, custom_id, status_code, code, message, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT (job_path, custom_id) DO UPDATE SET "
+                             "status_code = excluded.status_code, code = excluded.code, message = excluded.message, updated_at = excluded.updated_at",
+                             [(job_path, failure['custom_id'], failure.get('status_code'), failure.get('code'), failure.get('message'), updated_at)
+                              for failure in failures])
+
+
+    def replace_failures(self, job_path, failures):
+        # failures of the latest pass of a resumed job, requests answered since are no longer failed
+        with self._connect() as conn:
+            conn.execute("DELETE FROM failures WHERE job_path = ? AND resent_as IS NULL", (job_path,))
+        self.record_failures(job_path, failures)
+
+
+    def delete_failures(self, job_path, custom_ids):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM failures WHERE job_path = ? AND custom_id = ?",
+                             [(job_path, custom_id) for custom_id in custom_ids])
+
+
+    def failures(self, job_path=None, unresent_only=False) -> list:
+        query = "SELECT * FROM failures WHERE (? IS NULL OR job_path = ?)" + (" AND resent_as IS NULL" if unresent_only else "")
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query + " ORDER BY job_path, custom_id", (job_path, job_path))]
+
+
+    def mark_resent(self, job_path, custom_ids, resent_as):
+        updated_at = time_utils.get_unix_utc_timestamp()
+        with self._connect() as conn:
+            conn.executemany("UPDATE failures SET resent_as = ?, updated_at = ? WHERE job_path = ? AND custom_id = ?",
+                             [(resent_as, updated_at, job_path, custom_id) for custom_id in custom_ids])
+
+
+    def query_counts(self, group_keys) -> dict:
+        group_keys = list(group_keys)
+        query_counts = {}
+        with self._connect() as conn:
+            # chunks stay under the limit of variables per statement
+            for start in range(0, len(group_keys), 500):
+                chunk = group_keys[start:start + 500]
+                query_counts.update((row['group_key'], row['query_count'])
+                                    for row in conn.execute(f"SELECT group_key, query_count FROM query_counts "
+                                                            f"WHERE group_key IN ({', '.join('?' * len(chunk))})", chunk))
+        return query_counts
+
+
+    def aggregation(self):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM aggregation").fetchone()
+        return dict(row) if row is not None else None
+
+
+    def record_aggregation(self, job_paths, query_counts, results_file):
+        # after results_file is written, the size tells the next pass whether it is still the file the counters belong to
+        updated_at = time_utils.get_unix_utc_timestamp()
+        with self._connect() as conn:
+            conn.executemany("UPDATE jobs SET aggregated_at = ?, updated_at = ? WHERE job_path = ?",
+                             [(updated_at, updated_at, job_path) for job_path in job_paths])
+            conn.executemany("INSERT INTO query_counts (group_key, query_count) VALUES (?, ?) "
+                             "ON CONFLICT (group_key) DO UPDATE SET query_count = excluded.query_count",
+                             list(query_counts.items()))
+            conn.execute("DELETE FROM aggregation")
+            conn.execute("INSERT INTO aggregation (results_file, results_bytes, updated_at) VALUES (?, ?, ?)",
+                         (results_file, os.path.getsize(results_file), updated_at))
+
+
+    def clear_aggregation(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET aggregated_at = NULL")
+            conn.execute("DELETE FROM query_counts")
+            conn.execute("DELETE FROM aggregation")
+
+
+    def all_completed(self) -> bool:
+        with self._connect() as conn:
+            # salvaged jobs are done once what they did not run is resent as jobs of its own
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status NOT IN ('completed', 'salvaged') "
+                                "OR (status = 'salvaged' AND job_path IN (SELECT job_path FROM failures WHERE resent_as IS NULL))").fetchone()[0] == 0
+
+
+    def is_empty(self) -> bool:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
+
+
+    def rebuild(self, job_paths, skip_indexed=False) -> list:
+        """
+        Re-indexes the given job directories from their files, e.g. for runs started before
+        the manifest existed, and drops rows of directories that are gone. With skip_indexed,
+        directories that already have a row are kept as they are.
+        """
+        indexed_job_paths = set(self.job_paths()) if skip_indexed else set()
+        for job_path in job_paths:
+            if job_path in indexed_job_paths:
+                continue
+            source_filename = path_utils.job_source_file_path(job_path)
+            info_filename = path_utils.job_info_file_path(job_path)
+            fields = {}
+            if os.path.exists(source_filename):
+                fields['source_file'] = source_filename
+                with open(source_filename, "r") as file:
+                    bodies = (json.loads(line)['body'] for line in file if line.strip())
+                    for body in bodies:
+                        fields['model'] = body['model']
+                        fields['request_tokens'] = fields.get('request_tokens', 0) + token_utils.estimate_request_tokens(body)
+            results_filename = io_utils.find_frame(path_utils.job_results_file_path(job_path))
+            if results_filename is not None:
+                fields['results_file'] = results_filename
+            self.update(job_path, **fields)
+
+            if os.path.exists(info_filename):
+                with open(info_filename, "r") as file:
+                    self.update_from_info(job_path, json.load(file))
+
+        stale_job_paths = [(job_path,) for job_path in set(self.job_paths()) - set(job_paths)]
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM jobs WHERE job_path = ?", stale_job_paths)
+            conn.executemany("DELETE FROM failures WHERE job_path = ?", stale_job_paths)
+        # the run results still hold the rows of the jobs that are gone
+        if stale_job_paths:
+            self.clear_aggregation()
+
+        logger.info(f'Run manifest {self.manifest_path} rebuilt from {len(job_paths)} job directories.')
+        return self.job_paths()
@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from is_gpt_bayesian.utils import time_utils, path_utils
+
+logger = logging.getLogger(__name__)
+
+
+PROMETHEUS_PREFIX = 'is_gpt_bayesian'
+
+
+class RunMetrics():
+    """
+    Per stage totals of a run: calls, wall time, errors, any counts a stage adds (bytes, requests, rows)
+    and the peak RSS of the process during the stage, plus plain counters like retries. The peak is
+    reset when a stage starts, which only linux supports, elsewhere it is the lifetime peak. Stages
+    that overlap, nested or in the retrieve threads, each get the peak of the whole time they ran.
+
+    Totals carry over between invocations on the same run, and runs/<run_name>/metrics.json (and
+    metrics.prom in Prometheus text format if export_prometheus) is rewritten at most every
+    save_interval seconds as stages finish, and by save().
+    """
+
+    save_interval = 30
+
+    def __init__(self, run_name, export_prometheus=False):
+        self.run_name = run_name
+        self.metrics_filename = path_utils.run_metrics_file_path(run_name)
+        self.prometheus_filename = path_utils.run_metrics_prometheus_file_path(run_name) if export_prometheus else None
+        self.stages = {}
+        self.counters = {}
+        # stages finish concurrently in the retrieve threads
+        self._lock = threading.Lock()
+        self._saved_at = None
+        # peak RSS of the open stages up to the last reset, by the key start_stage returned
+        self._open_peaks = {}
+
+        path_utils.create_path(path_utils.run_path(run_name))
+
+        if os.path.exists(self.metrics_filename):
+            with open(self.metrics_filename, "r") as file:
+                metrics = json.load(file)
+            self.stages = metrics.get('stages', {})
+            self.counters = metrics.get('counters', {})
+            # lifetime peaks written before the peak was measured per stage
+            for stage in self.stages.values():
+                stage.pop('process_peak_rss_mb', None)
+
+
+    @contextmanager
+    def stage(self, stage_name, **counts):
+        """
+        Times the block as one call of stage_name. Counts are summed into the stage totals, the block
+        may add to them through the yielded dict, e.g. record['bytes'] += n.
+        """
+        record = dict(counts)
+        stage_key = self.start_stage()
+        started_at = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['errors'] = record.get('errors', 0) + 1
+            raise
+        finally:
+            self.add(stage_name, time.perf_counter() - started_at, stage_key=stage_key, **record)
+
+
+    def start_stage(self):
+        """
+        Starts measuring the peak RSS of a stage the caller times itself, the returned key is passed to add.
+        """
+        with self._lock:
+            # the peak so far belongs to the stages already open, the new one starts from the current RSS
+            current_peak = peak_rss_mb() or 0
+            for open_key in self._open_peaks:
+                self._open_peaks[open_key] = max(self._open_peaks[open_key], current_peak)
+            reset_peak_rss()
+            stage_key = object()
+            self._open_peaks[stage_key] = 0
+        return stage_key
+
+
+    def add(self, stage_name, seconds, stage_key=None, **counts):
+        # without a stage_key from start_stage, the peak is the one since the last reset
+        with self._lock:
+            stage = self.stages.setdefault(stage_name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'errors': 0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            for count_name, value in counts.items():
+                stage[count_name] = stage.get(count_name, 0) + value
+            stage['peak_rss_mb'] = max(stage.get('peak_rss_mb', 0), self._open_peaks.pop(stage_key, 0), peak_rss_mb() or 0)
+            # a long watch finishes a poll stage every few seconds, the files need not follow each one
+            if self._saved_at is None or time.monotonic() - self._saved_at >= RunMetrics.save_interval:
+                self._save()
+
+
+    def increment(self, counter_name, value=1):
+        with self._lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+
+    def _save(self):
+        metrics = {'run_name': self.run_name,
+                   'updated_at': time_utils.get_unix_utc_timestamp(),
+                   'stages': self.stages,
+                   'counters': self.counters}
+        _write_atomic_helper(self.metrics_filename, json.dumps(metrics, indent=4))
+        if self.prometheus_filename is not None:
+            _write_atomic_helper(self.prometheus_filename, self.to_prometheus())
+        self._saved_at = time.monotonic()
+
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.extend([f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}',
+                          f'# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}'])
+            lines.extend(f'{PROMETHEUS_PREFIX}_{name}{{{_prometheus_labels_helper(labels)}}} {value}' for labels, value in samples)
+
+        run_label = {'run': self.run_name}
+
+        def stage_samples(field, scale=1):
+            return [({**run_label, 'stage': stage_name}, stage[field] * scale)
+                    for stage_name, stage in sorted(self.stages.items()) if field in stage]
+
+        add_metric('stage_calls_total', 'counter', 'Calls of the stage.', stage_samples('calls'))
+        add_metric('stage_errors_total', 'counter', 'Calls of the stage that raised.', stage_samples('errors'))
+        add_metric('stage_seconds_total', 'counter', 'Wall time of the stage, summed over calls.', stage_samples('seconds'))
+        add_metric('stage_max_seconds', 'gauge', 'Longest call of the stage.', stage_samples('max_seconds'))
+        add_metric('stage_peak_rss_bytes', 'gauge', 'Peak RSS of the process during the stage, over its calls.', stage_samples('peak_rss_mb', 1024 ** 2))
+
+        count_names = sorted({count_name for stage in self.stages.values() for count_name in stage} -
+                             {'calls', 'errors', 'seconds', 'max_seconds', 'peak_rss_mb'})
+        for count_name in count_names:
+            add_metric(f'stage_{count_name}_total', 'counter', f'{count_name.capitalize()} handled by the stage.', stage_samples(count_name))
+        for counter_name, value in sorted(self.counters.items()):
+            add_metric(f'{counter_name}_total', 'counter', f'{counter_name.capitalize()} of the run.', [(run_label, value)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_labels_helper(labels):
+    # JSON string escaping is the label value escaping of the text format (backslash, double quote, newline)
+    return ','.join(f'{key}={json.dumps(str(value), ensure_ascii=False)}' for key, value in labels.items())
+
+
+def _write_atomic_helper(filename, text):
+    # readers, e.g. a node exporter textfile collector, never see a half written file
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as file:
+        file.write(text)
+    os.replace(tmp_filename, filename)
+
+
+# ===================================
+# Memory
+# ===================================
+
+def _proc_status_mb_helper(field):
+    try:
+        with open('/proc/self/status', 'r') as file:
+            match = re.search(rf'^{field}:\s+(\d+) kB', file.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return round(int(match.group(1)) / 1024, 1) if match else None
+
+
+def current_rss_mb():
+    return _proc_status_mb_helper('VmRSS')
+
+
+def peak_rss_mb():
+    peak = _proc_status_mb_helper('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kB on linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = round(max_rss / 1024 ** (2 if sys.platform == 'darwin' else 1), 1)
+    return peak
+
+
+def reset_peak_rss():
+    # linux resets VmHWM to the current RSS on writing 5 to clear_refs, elsewhere the peak stays the lifetime peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
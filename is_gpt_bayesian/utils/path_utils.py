@@ -5,6 +5,16 @@ from is_gpt_bayesian.utils import time_utils
 
 data_eg_path = Path('assets/datastruct_wisconsin.mat')
 data_hs_path = Path('assets/data_holt_and_smith.xlsx')
+response_cache_path = Path('runs/response_cache.sqlite')
+design_cache_path = Path('assets/design_cache')
+
+
+def design_cache_file_path(cache_name, source_hash, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return design_cache_file_path(cache_name, source_hash, return_posix=False).as_posix()
+    else:
+        return design_cache_path / f"{cache_name}__{source_hash}.parquet"
 
 
 def run_path(run_name, return_posix=True):
@@ -39,6 +49,38 @@ def run_specs_file_path(run_name, return_posix=True):
         return run_path(run_name, return_posix=False) / "run_specs_file.csv"
 
 
+def run_prompts_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_prompts_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "run_prompts_file.csv"
+
+
+def run_manifest_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_manifest_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "run_manifest.sqlite"
+
+
+def run_metrics_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_metrics_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "metrics.json"
+
+
+def run_metrics_prometheus_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_metrics_prometheus_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "metrics.prom"
+
+
 def run_results_file_path(run_name, return_posix=True):
     _check_bool(return_posix)
     if return_posix:
@@ -47,6 +89,22 @@ def run_results_file_path(run_name, return_posix=True):
         return run_path(run_name, return_posix=False) / "run_results_file.csv"
 
 
+def run_usage_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_usage_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "run_usage_file.csv"
+
+
+def run_usage_estimate_file_path(run_name, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return run_usage_estimate_file_path(run_name, return_posix=False).as_posix()
+    else:
+        return run_path(run_name, return_posix=False) / "run_usage_estimate_file.csv"
+
+
 def run_final_stacked_file_path(run_name, return_posix=True):
     _check_bool(return_posix)
     if return_posix:
@@ -127,6 +185,14 @@ def job_response_file_path(job_path, return_posix=True):
         return _convert_to_path(job_path) / "job_response_file.jsonl"
 
 
+def job_error_file_path(job_path, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return job_error_file_path(job_path, return_posix=False).as_posix()
+    else:
+        return _convert_to_path(job_path) / "job_error_file.jsonl"
+
+
 def job_results_file_path(job_path, return_posix=True):
     _check_bool(return_posix)
     if return_posix:
@@ -135,6 +201,14 @@ def job_results_file_path(job_path, return_posix=True):
         return _convert_to_path(job_path) / "job_results_file.csv"
 
 
+def artifact_file_path(file_path, artifact_format, return_posix=True):
+    _check_bool(return_posix)
+    if return_posix:
+        return artifact_file_path(file_path, artifact_format, return_posix=False).as_posix()
+    else:
+        return _convert_to_path(file_path).with_suffix(f".{artifact_format}")
+
+
 def create_path(path, exist_ok=True) -> None:
     path = _convert_to_path(path)
     path.mkdir(parents=True, exist_ok=exist_ok)
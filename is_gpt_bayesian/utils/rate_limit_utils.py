@@ -0,0 +1,125 @@
+import re
+import time
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket():
+
+    def __init__(self, capacity_per_minute, max_capacity_per_minute=None):
+        self.max_capacity = max_capacity_per_minute
+        self.capacity = float(capacity_per_minute)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount) -> float:
+        self._refill()
+        # a single request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+    def consume(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def set_capacity(self, capacity_per_minute):
+        self._refill()
+        if self.max_capacity is not None:
+            capacity_per_minute = min(capacity_per_minute, self.max_capacity)
+        self.capacity = float(capacity_per_minute)
+        self.level = min(self.level, self.capacity)
+
+    def set_remaining(self, remaining):
+        # the server knows about traffic we do not (other jobs, other machines on the account)
+        self._refill()
+        self.level = min(self.level, float(remaining))
+
+
+class AsyncRateLimiter():
+    """
+    Requests-per-minute and tokens-per-minute token buckets for the async client.
+
+    requests_per_minute / tokens_per_minute:
+        upper bounds set by the caller, or None to adopt whatever the
+        x-ratelimit-limit-* response headers report for the account.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.buckets = {'requests': _make_bucket(requests_per_minute),
+                        'tokens'  : _make_bucket(tokens_per_minute)}
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        amounts = {'requests': 1, 'tokens': tokens}
+        # one waiter at a time, so requests go out in the order they queued up
+        async with self.lock:
+            while True:
+                wait = max([self.paused_until - time.monotonic()] + \
+                           [bucket.wait_time(amounts[name]) for name, bucket in self.buckets.items() if bucket])
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            for name, bucket in self.buckets.items():
+                if bucket:
+                    bucket.consume(amounts[name])
+
+    def update_from_headers(self, headers):
+        for name in ['requests', 'tokens']:
+            limit = headers.get(f'x-ratelimit-limit-{name}')
+            remaining = headers.get(f'x-ratelimit-remaining-{name}')
+            reset = headers.get(f'x-ratelimit-reset-{name}')
+
+            if limit is not None:
+                if self.buckets[name] is None:
+                    self.buckets[name] = TokenBucket(float(limit))
+                    logger.info(f'Adopted rate limit of {limit} {name} per minute from response headers.')
+                elif self.buckets[name].capacity != float(limit):
+                    self.buckets[name].set_capacity(float(limit))
+
+            if remaining is not None and self.buckets[name] is not None:
+                self.buckets[name].set_remaining(float(remaining))
+                # exhausted, hold everything until the window resets
+                if float(remaining) <= 0 and reset is not None:
+                    self.pause(parse_reset_duration(reset))
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def parse_reset_duration(reset) -> float:
+    """
+    Parses x-ratelimit-reset-* values such as "1s", "6m0s", "20ms" or "1h2m3.5s" into seconds.
+    """
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(value) * units[unit] for value, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', reset))
+
+
+def parse_retry_after(headers) -> float:
+    if headers.get('retry-after-ms') is not None:
+        return float(headers['retry-after-ms']) / 1000
+    try:
+        return float(headers.get('retry-after', 0))
+    except ValueError:
+        return 0.0
+
+
+def backoff_delay(attempt, base_delay, max_delay) -> float:
+    # exponential backoff with full jitter, so retrying workers do not fire in lockstep
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def _make_bucket(capacity_per_minute):
+    if capacity_per_minute is None:
+        return None
+    return TokenBucket(capacity_per_minute, max_capacity_per_minute=capacity_per_minute)
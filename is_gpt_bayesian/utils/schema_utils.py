@@ -0,0 +1,29 @@
+import pandas as pd
+
+
+# string keys of the specs and results frames, a few distinct values repeated over many rows,
+# ids unique to each row (batch_id, request_id) stay strings
+CATEGORICAL_COLUMNS = ['name', 'state', 'sheet_name', 'trial_id', 'subject_id', 'model', 'instruction', 'prompt_template']
+
+# counts that are NaN for queries without a response, float32 holds them exactly up to 2**24, sums of them are taken in float64
+FLOAT32_COLUMNS = ['query_idx', 'query_total_count',
+                   'prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'reasoning_tokens']
+
+
+def apply_schema(df) -> pd.DataFrame:
+    """
+    Casts the columns of a specs or results frame to their declared dtypes: categorical string keys,
+    float32 counts and the smallest integer type for integer columns. Columns the frame does not
+    have are skipped, so frames read back from csv, or concatenated from frames with different
+    categories, get the same dtypes again.
+    """
+    dtypes = {}
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                dtypes[col] = 'category'
+        elif col in FLOAT32_COLUMNS:
+            dtypes[col] = 'float32'
+        elif pd.api.types.is_integer_dtype(df[col].dtype) and len(df) > 0:
+            dtypes[col] = pd.to_numeric(df[col], downcast='integer').dtype
+    return df.astype(dtypes) if dtypes else df
@@ -0,0 +1,62 @@
+import logging
+import functools
+import importlib.util
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+
+# chat format overhead, per message and for priming the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def estimate_tokens(text) -> int:
+    if not isinstance(text, str):
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_request_tokens(body) -> int:
+    # prompt tokens plus any completion budget, which also counts towards the TPM limit
+    prompt_tokens = sum(estimate_tokens(message.get('content')) for message in body.get('messages', []))
+    completion_tokens = body.get('max_completion_tokens') or body.get('max_tokens') or 0
+    return prompt_tokens + completion_tokens
+
+
+def count_tokens(text, model) -> int:
+    """
+    Tokens of text with the tokenizer of model. Without tiktoken installed this falls back to
+    the estimate_tokens heuristic, with a warning the first time.
+    """
+    if not isinstance(text, str):
+        return 0
+    encoding = _encoding_helper(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_prompt_tokens(messages, model) -> int:
+    # prompt_tokens as billed for a chat completion request
+    return sum(count_tokens(message.get('content'), model) + TOKENS_PER_MESSAGE for message in messages) + TOKENS_PER_REPLY
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_installed_helper():
+    if importlib.util.find_spec('tiktoken') is None:
+        logger.warning(f'tiktoken is not installed, tokens are estimated as characters / {CHARS_PER_TOKEN}.')
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding_helper(model):
+    if not _tiktoken_installed_helper():
+        return None
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # models newer than the installed tiktoken, gpt-4o and o1 models share o200k_base
+        return tiktoken.get_encoding('o200k_base' if model.startswith(('gpt-4o', 'o1')) else 'cl100k_base')
@@ -0,0 +1,45 @@
+if __name__ == '__main__':
+
+    # ===================================
+    # Append path
+    # ===================================
+
+    import sys
+    sys.path.append("../is_gpt_bayesian/")
+
+
+    # ===================================
+    # Resovle args and set up logging
+    # ===================================
+
+    import argparse
+    from is_gpt_bayesian.testing import pipeline_benchmark
+
+    parser = argparse.ArgumentParser(description='Times the hot stages of the pipeline on synthetic data of increasing size and reports wall time, peak RSS and rows/sec as JSON.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=pipeline_benchmark.DEFAULT_SIZES, help="# of rows per stage.")
+    parser.add_argument('--stages', type=str, nargs='+', default=list(pipeline_benchmark.STAGES), help=f"Stages can be: {', '.join(pipeline_benchmark.STAGES)}.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="JSON report file, e.g. to compare against the report of another version.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+    logger = logging.getLogger(__name__)
+    logger.info(f'SIZES: {args.sizes}, STAGES: {args.stages}.')
+
+
+    # ===================================
+    # Run benchmarks
+    # ===================================
+
+    import json
+
+    results = pipeline_benchmark.run_benchmarks(args.stages, args.sizes, seed=args.seed)
+    report = pipeline_benchmark.benchmark_report(results)
+
+    # stdout only carries the report, so it can be piped
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+        logger.info(f'Benchmark report saved to {args.output}.')
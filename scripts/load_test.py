@@ -0,0 +1,142 @@
+if __name__ == '__main__':
+
+    # ===================================
+    # Append path
+    # ===================================
+
+    import sys
+    sys.path.append("../is_gpt_bayesian/")
+
+
+    # ===================================
+    # Resovle args and set up logging
+    # ===================================
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs send -> retrieve -> process -> finalize against a local fake OpenAI server and reports the throughput of each stage.')
+    parser.add_argument('-n', '--n_requests', type=int, default=10_000, help="# of requests of the synthetic run.")
+    parser.add_argument('-m', '--models', type=str, nargs='+', default=['gpt-4o-mini'], help="Models, o1 models go through the non-batch dispatcher.")
+    parser.add_argument('-d', '--design', type=str, default='eg', help="Synthetic design, 'eg' or 'hs'.")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds per non-batch completion.")
+    parser.add_argument('--requests_per_minute', type=float, default=None)
+    parser.add_argument('--tokens_per_minute', type=float, default=None)
+    parser.add_argument('--rate_limit_error_rate', type=float, default=0.0)
+    parser.add_argument('--batch_requests_per_second', type=float, default=10_000.0)
+    parser.add_argument('--expire_after_seconds', type=float, default=None)
+    parser.add_argument('--batch_error_rate', type=float, default=0.0)
+    parser.add_argument('--enqueued_token_limit', type=int, default=None, help="Enqueued token limit of the server.")
+    parser.add_argument('--batch_max_requests', type=int, default=None, help="Requests per batch job of the session.")
+    parser.add_argument('--batch_max_enqueued_tokens', type=int, default=None, help="Enqueued token budget of the session, for every model.")
+    parser.add_argument('--incremental_results', action='store_true', help="Fold the job results into the run results incrementally.")
+    args = parser.parse_args()
+
+    from is_gpt_bayesian.utils import time_utils, path_utils
+    import logging.config
+
+    run_name = f"load_test__{time_utils.get_secondstamp()}"
+    run_path = path_utils.run_path(run_name)
+    path_utils.create_path(run_path)
+    log_path = path_utils.log_path(run_name)
+
+    logging.config.fileConfig('logging.conf', defaults={'logfilename': log_path})
+    logging.getLogger('httpx').setLevel(logging.WARNING) # one line per request otherwise
+    logger = logging.getLogger(__name__)
+    logger.info(f'RUN_NAME: {run_name}, N_REQUESTS: {args.n_requests}, MODELS: {args.models}.')
+
+
+    # ===================================
+    # Import modules
+    # ===================================
+
+    import os
+    import json
+    import time
+    from is_gpt_bayesian.testing.fake_openai_server import FakeOpenAIServer, EG_RESPONSE_TEMPLATES, HS_RESPONSE_TEMPLATES
+    from is_gpt_bayesian.testing import synthetic_data
+    from is_gpt_bayesian.processing import response_processing
+
+
+    # ===================================
+    # Fake backend
+    # ===================================
+
+    server = FakeOpenAIServer(latency=args.latency,
+                              requests_per_minute=args.requests_per_minute,
+                              tokens_per_minute=args.tokens_per_minute,
+                              rate_limit_error_rate=args.rate_limit_error_rate,
+                              validating_seconds=1.0,
+                              batch_requests_per_second=args.batch_requests_per_second,
+                              finalizing_seconds=1.0,
+                              expire_after_seconds=args.expire_after_seconds,
+                              batch_error_rate=args.batch_error_rate,
+                              enqueued_token_limit=args.enqueued_token_limit,
+                              response_templates=EG_RESPONSE_TEMPLATES if args.design == 'eg' else HS_RESPONSE_TEMPLATES,
+                              seed=0).start()
+
+    # the client of the session picks these up
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+
+    from is_gpt_bayesian.model import OpenAISession
+    OpenAISession.watch_min_poll_interval = 1
+    OpenAISession.watch_max_poll_interval = 5
+    if args.batch_max_requests is not None:
+        OpenAISession.batch_max_requests = args.batch_max_requests
+    if args.batch_max_enqueued_tokens is not None:
+        OpenAISession.batch_max_enqueued_tokens = {model: args.batch_max_enqueued_tokens for model in args.models}
+
+
+    # ===================================
+    # Run stages
+    # ===================================
+
+    stages = {}
+
+    def run_stage(stage_name, n_requests, fnc, *fnc_args, **fnc_kwargs):
+        started_at = time.perf_counter()
+        result = fnc(*fnc_args, **fnc_kwargs)
+        seconds = time.perf_counter() - started_at
+        stages[stage_name] = {'seconds': round(seconds, 3),
+                              'requests_per_second': round(n_requests / seconds, 1) if seconds > 0 else None}
+        logger.info(f'Stage {stage_name} took {seconds:.2f}s.')
+        return result
+
+    try:
+        instructions = ['reasoning', 'no reasoning']
+        run_specs = run_stage('specs', args.n_requests, synthetic_data.synthetic_specs_df,
+                              args.n_requests, args.models, instructions, design=args.design)
+        n_requests = len(run_specs)
+
+        session = OpenAISession(run_name)
+        run_stage('generate_batch_files', n_requests, session.generate_batch_files, run_specs)
+        run_stage('send', n_requests, session.send_batches)
+        session.load_jobs()
+        run_stage('watch', n_requests, session.watch_batches)
+        results_df = run_stage('process', n_requests, session.process_reponses, incremental=args.incremental_results)
+
+        if args.design == 'eg':
+            final_df_stacked_dict, _ = run_stage('finalize', n_requests, response_processing.process_eg_result_df,
+                                                 results_df, response_processing.response_eg, run_name, ungroup_by=['name'])
+        else:
+            final_df_stacked_dict, _ = run_stage('finalize', n_requests, response_processing.process_hs_result_df,
+                                                 results_df, response_processing.response_hs, run_name, ungroup_by=['sheet_name'])
+        final_df_stacked = list(final_df_stacked_dict.values())[0]
+    finally:
+        server.stop()
+        session.metrics.save()
+
+    report = {'run_name': run_name,
+              'n_requests': n_requests,
+              'models': args.models,
+              'design': args.design,
+              'server': {k: v for k, v in vars(args).items() if k not in ['n_requests', 'models', 'design']},
+              'stages': stages,
+              'all_completed': session.all_completed(),
+              'n_results': len(final_df_stacked),
+              'n_invalid_responses': int(final_df_stacked['processed_response'].isna().sum())}
+    report_filename = os.path.join(run_path, 'load_test_report.json')
+    with open(report_filename, "w") as file:
+        json.dump(report, file, indent=4)
+    logger.info(f'---------- LOAD TEST REPORT\n{json.dumps(report, indent=4)}')
+    logger.info(f'Load test report saved to {report_filename}.')
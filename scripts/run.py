@@ -16,9 +16,10 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     valid_run_names = ['wisconsin', 'wisconsin_flipped', 'california', 'eg', 'hs']
-    valid_task_names = ['send', 'resend_failed', 'resend_invalid', 'retrieve', 'finalize']
+    valid_task_names = ['estimate', 'send', 'resend_failed', 'resend_failed_requests', 'resend_invalid', 'retrieve', 'watch', 'finalize']
     parser.add_argument('-r', '--run_name', type=str, help=f"RUN_NAME can be: {', '.join(valid_run_names)}.", required=True)
     parser.add_argument('-t', '--task_name', type=str, help=f"TASK_NAME can be: {', '.join(valid_task_names)}.", required=True)
+    parser.add_argument('-f', '--finalize', action='store_true', help="With TASK_NAME watch, finalize once no job is in progress.")
     args = parser.parse_args()
 
     run_name = args.run_name
@@ -47,9 +48,12 @@ if __name__ == '__main__':
     import numpy as np
     import pandas as pd
     from is_gpt_bayesian.model import OpenAISession
+    from is_gpt_bayesian.utils.cache_utils import ResponseCache
+    from is_gpt_bayesian.utils import io_utils, metrics_utils
     from is_gpt_bayesian.processing import (specs_processing, 
                                             prompt_processing, 
-                                            response_processing)
+                                            response_processing,
+                                            usage_processing)
 
 
     # ===================================
@@ -78,6 +82,32 @@ if __name__ == '__main__':
     # Model seed
     seeds = []
 
+    # Response cache, identical requests from previous runs are served locally instead of resent
+    response_cache = ResponseCache(path_utils.response_cache_path,
+                                   seeded_only=True,        # unseeded requests are meant to be fresh samples
+                                   max_samples_per_key=1,
+                                   max_age_days=180,
+                                   max_size_mb=2048)
+
+    # Storage of specs and results frames, 'csv' or 'parquet' (typed and compressed, needs pyarrow)
+    artifact_format = 'csv'
+    export_csv = True                   # with parquet, also export the final stacked results as csv
+
+    # Run results are brought up to date with the jobs completed since the last retrieve instead of rebuilt from all jobs
+    incremental_results = True
+
+    # Processes parsing the responses at finalize, None for all cores. Handing a response to another process costs
+    # about as much as parsing it, so more than 1 only pays off for hs runs from ~200k responses on 4+ cores, never for eg runs
+    parse_n_jobs = 1
+
+    # Expected completion tokens per instruction for the estimate task, e.g. the means of a previous run_usage_file
+    estimated_completion_tokens = {'reasoning': 500,
+                                   'no reasoning': 10}
+
+    # Stage timings, sizes and peak memory are kept in runs/<run_name>/metrics.json, optionally also as metrics.prom
+    export_prometheus = False
+    metrics = metrics_utils.RunMetrics(run_name, export_prometheus=export_prometheus)
+
 
     # ===================================
     # Generating specs
@@ -86,38 +116,42 @@ if __name__ == '__main__':
     # El-Gamal and Grether
     if run_name == 'california':
 
-        if task_name in ['send', 'resend_invalid']:
-            run_specs = specs_processing.get_california_specs_df(temperature_lower_bound, temperature_upper_bound,
-                                                                 models,
-                                                                 instructions,
-                                                                 seeds)
+        if task_name in ['estimate', 'send', 'resend_invalid']:
+            with metrics.stage('specs'):
+                run_specs = specs_processing.get_california_specs_df(temperature_lower_bound, temperature_upper_bound,
+                                                                     models,
+                                                                     instructions,
+                                                                     seeds)
         response_fnc = response_processing.response_eg
 
     elif run_name == 'wisconsin':
 
-        if task_name in ['send', 'resend_invalid']:
-            run_specs = specs_processing.get_wisconsin_specs_df(temperature_lower_bound, temperature_upper_bound,
-                                                                models,
-                                                                instructions,
-                                                                seeds)
+        if task_name in ['estimate', 'send', 'resend_invalid']:
+            with metrics.stage('specs'):
+                run_specs = specs_processing.get_wisconsin_specs_df(temperature_lower_bound, temperature_upper_bound,
+                                                                    models,
+                                                                    instructions,
+                                                                    seeds)
         response_fnc = response_processing.response_eg
 
     elif run_name == 'wisconsin_flipped':
 
-        if task_name in ['send', 'resend_invalid']:
-            run_specs = specs_processing.get_wisconsin_flipped_specs_df(temperature_lower_bound, temperature_upper_bound,
-                                                                        models,
-                                                                        instructions,
-                                                                        seeds)
+        if task_name in ['estimate', 'send', 'resend_invalid']:
+            with metrics.stage('specs'):
+                run_specs = specs_processing.get_wisconsin_flipped_specs_df(temperature_lower_bound, temperature_upper_bound,
+                                                                            models,
+                                                                            instructions,
+                                                                            seeds)
         response_fnc = response_processing.response_eg
 
     elif run_name == 'hs':
 
-        if task_name in ['send', 'resend_invalid']:
-            run_specs = specs_processing.get_hs_specs_df(temperature_lower_bound, temperature_upper_bound,
-                                                         models,
-                                                         instructions,
-                                                         seeds)
+        if task_name in ['estimate', 'send', 'resend_invalid']:
+            with metrics.stage('specs'):
+                run_specs = specs_processing.get_hs_specs_df(temperature_lower_bound, temperature_upper_bound,
+                                                             models,
+                                                             instructions,
+                                                             seeds)
 
         response_fnc = response_processing.response_hs
 
@@ -129,62 +163,108 @@ if __name__ == '__main__':
     # ===================================
     # Run task
     # ===================================
-    
-    if task_name == 'send':
 
-        session = OpenAISession(run_name)
+    if task_name == 'watch':
+
+        # poll until no job is in progress, then carry on as retrieve or finalize
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
+        session.load_jobs()
+        session.watch_batches()
+        task_name = 'finalize' if args.finalize else 'retrieve'
+    
+    if task_name == 'estimate':
+
+        # tokens, cost and batch jobs of the run before anything is sent
+        usage_estimate_df = usage_processing.estimate_usage(run_specs, 
+                                                            completion_tokens=estimated_completion_tokens, 
+                                                            non_batch_models=OpenAISession.non_batch_models)
+        batch_jobs = usage_processing.estimate_batch_jobs(usage_estimate_df, 
+                                                          OpenAISession.batch_max_requests, 
+                                                          OpenAISession.batch_max_tokens, 
+                                                          non_batch_models=OpenAISession.non_batch_models)
+        usage_estimate_filename = path_utils.run_usage_estimate_file_path(run_name)
+        usage_estimate_df.to_csv(usage_estimate_filename, index=False)
+        logger.info(f'---------- USAGE ESTIMATE\n{usage_estimate_df.to_string(index=False)}')
+        logger.info(f'---------- BATCH JOBS PER MODEL\n{batch_jobs.to_string()}')
+        logger.info(f"Estimated cost ${usage_estimate_df['cost_usd'].sum():.2f}, saved to {usage_estimate_filename}.")
+
+    elif task_name == 'send':
+
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
         session.generate_batch_files(run_specs)
         session.send_batches()
 
     elif task_name == 'resend_failed':
 
-        session = OpenAISession(run_name)
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
         session.resend_failed_jobs()
 
+    elif task_name == 'resend_failed_requests':
+
+        # only the requests in the error files of completed jobs, as new jobs
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
+        session.load_jobs()
+        session.resend_failed_requests()
+
     elif task_name == 'resend_invalid':
 
-        run_specs = pd.read_csv(path_utils.run_final_stacked_file_path(run_name), index_col=0)
+        run_specs = io_utils.read_frame(path_utils.run_final_stacked_file_path(run_name))
         run_specs = run_specs[(run_specs['processed_response'].isna()) &
                               (run_specs['query_idx'] == run_specs['query_total_count'])]
         
         if len(run_specs) == 0:
             logger.info('ALL JOBS ARE COMPLETED. NO INVALID PROCESSED_RESPONSE.')
         else:
-            specs_cols = pd.read_csv(path_utils.run_specs_file_path(run_name), index_col=0, nrows=0).columns
-            session = OpenAISession(run_name)
-            session.generate_batch_files(run_specs[specs_cols])
+            specs_cols = io_utils.read_frame_columns(path_utils.run_specs_file_path(run_name))
+            session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
+            session.generate_batch_files(run_specs[specs_cols], use_cache=False) # invalid responses need fresh samples
             session.send_batches()
 
     elif task_name == 'retrieve': 
 
-        session = OpenAISession(run_name)
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
         session.load_jobs()
         session.retrieve_batches()
-        session.process_reponses()
+        if incremental_results:
+            session.fold_new_responses()
+        else:
+            session.process_reponses()
 
     elif task_name == 'finalize':
 
-        session = OpenAISession(run_name)
+        session = OpenAISession(run_name, response_cache=response_cache, artifact_format=artifact_format, metrics=metrics)
         session.load_jobs()
         session.retrieve_batches()
-        results_df = session.process_reponses()
-
-        if run_name in ['california', 'wisconsin']:
-            final_df_stacked_dict, final_df_unstacked_ungrouped_dict = response_processing.process_eg_result_df(results_df, response_fnc, run_name, ungroup_by=['name'])
-        elif run_name == 'hs':
-            final_df_stacked_dict, final_df_unstacked_ungrouped_dict = response_processing.process_hs_result_df(results_df, response_fnc, run_name, ungroup_by=['sheet_name'])
+        results_df = session.process_reponses(incremental=incremental_results)
+        if not session.all_completed():
+            logger.warning('NOT ALL JOBS ARE COMPLETED. RESULTS OF UNFINISHED JOBS AND OF REQUESTS SALVAGED JOBS DID NOT RUN ARE MISSING, SEE RESEND_FAILED_REQUESTS.')
+
+        # tokens and cost as billed
+        usage_df = usage_processing.usage_rollup(results_df)
+        usage_filename = path_utils.run_usage_file_path(run_name)
+        usage_df.to_csv(usage_filename, index=False)
+        logger.info(f'---------- USAGE SUMMARY\n{usage_df.to_string(index=False)}')
+        logger.info(f"Run cost ${usage_df['cost_usd'].sum():.2f}, usage saved to {usage_filename}.")
+
+        with metrics.stage('finalize', rows=len(results_df)):
+            if run_name in ['california', 'wisconsin']:
+                final_df_stacked_dict, final_df_unstacked_ungrouped_dict = response_processing.process_eg_result_df(results_df, response_fnc, run_name, ungroup_by=['name'], n_jobs=parse_n_jobs)
+            elif run_name == 'hs':
+                final_df_stacked_dict, final_df_unstacked_ungrouped_dict = response_processing.process_hs_result_df(results_df, response_fnc, run_name, ungroup_by=['sheet_name'], n_jobs=parse_n_jobs)
         
-        for path, final_df in final_df_stacked_dict.items():
-            final_df_stacked = final_df
-            final_df.to_csv(path)
-            logger.info(f'Stacked run results df saved to {path}.')
+            for path, final_df in final_df_stacked_dict.items():
+                final_df_stacked = final_df
+                path = io_utils.write_frame(final_df, path, artifact_format)
+                logger.info(f'Stacked run results df saved to {path}.')
+                if export_csv and artifact_format != 'csv':
+                    logger.info(f'Stacked run results df exported to {io_utils.export_csv(path)}.')
         
-        for path, final_df in final_df_unstacked_ungrouped_dict.items():
-            if isinstance(final_df.index, pd.MultiIndex):
-                final_df.to_csv(path)
-            else:
-                final_df.to_csv(path, index=False)
-            logger.info(f'Processed / unstacked ungrouped run results df saved to {path}.')
+            for path, final_df in final_df_unstacked_ungrouped_dict.items():
+                if isinstance(final_df.index, pd.MultiIndex):
+                    final_df.to_csv(path)
+                else:
+                    final_df.to_csv(path, index=False)
+                logger.info(f'Processed / unstacked ungrouped run results df saved to {path}.')
 
         # check for invalid
         results_df_invalid = final_df_stacked[(final_df_stacked['processed_response'].isna()) &
@@ -198,3 +278,6 @@ if __name__ == '__main__':
     else:
 
         raise ValueError('Invalid task_name argument.')
+
+    # counters incremented after the last stage, and stages since the last rewrite of the metrics files
+    metrics.save()